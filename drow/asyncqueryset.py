@@ -0,0 +1,115 @@
+__author__ = 'max'
+
+from time import time
+
+from pool import Executor
+
+# Runs the calls of every model that doesn't have its own executor
+default_executor = Executor()
+
+
+class AsyncQuerySet(object):
+    """
+    Makes the calls of a model's QuerySet on an Executor, returning a Future
+    for each call right away, so that several calls can be in flight at once
+    (see pool.gather).  Available as the "aobjects" member of every model.
+
+    Every method takes a ``timeout``: a call that cannot be started within
+    that many seconds is not made, and waiting for its result gives up then
+    with DeadlineExceeded.  Calls that haven't started can be cancelled
+    through their Future; calls already running are not interrupted.
+    Calls run on the executor's threads, so writes are not queued by the
+    caller's Session.
+    """
+    def __init__(self, objects):
+        """
+        :param QuerySet objects: The model's QuerySet
+        """
+        self.objects = objects
+
+    @property
+    def executor(self):
+        """
+        :return: The model's executor option, or the default executor
+        :rtype: Executor
+        """
+        executor = self.objects._state.model._meta.executor
+        if executor is None:
+            return default_executor
+        return executor
+
+    def _submit(self, timeout, function, *args, **kwargs):
+        """
+        :param float timeout: The most seconds the call may take, or None
+        :param function function: The QuerySet method to call
+        :return: The future result of the call
+        :rtype: Future
+        """
+        deadline = None if timeout is None else time() + timeout
+        return self.executor.submit_before(deadline, function, *args, **kwargs)
+
+    def get(self, key, must_exist=True, timeout=None):
+        """
+        Retrieve an object from the database, see QuerySet.get.  The object
+        is always fetched actively.
+
+        :rtype: Future<Model>
+        """
+        return self._submit(
+            timeout, self.objects.get, key, active=True,
+            must_exist=must_exist)
+
+    def get_many(self, keys, must_exist=True, concurrency=None,
+                 timeout=None):
+        """
+        Retrieve several objects from the database, see QuerySet.get_many
+
+        :rtype: Future<BulkResults>
+        """
+        return self._submit(
+            timeout, self.objects.get_many, keys, must_exist=must_exist,
+            concurrency=concurrency)
+
+    def put(self, key, data, vclock=None, timeout=None):
+        """
+        Store data at a key, see QuerySet.put
+
+        :rtype: Future<Model>
+        """
+        return self._submit(
+            timeout, self.objects.put, key, data, vclock=vclock)
+
+    def patch(self, key, patch, timeout=None):
+        """
+        Patch the data stored at a key, see QuerySet.patch
+
+        :rtype: Future<Model>
+        """
+        return self._submit(timeout, self.objects.patch, key, patch)
+
+    def create(self, data, timeout=None):
+        """
+        Create an object, see QuerySet.create
+
+        :rtype: Future<Model>
+        """
+        return self._submit(timeout, self.objects.create, data)
+
+    def delete(self, key, timeout=None):
+        """
+        Delete an object, see QuerySet.delete
+
+        :rtype: Future<RiakObject>
+        """
+        return self._submit(timeout, self.objects.delete, key, queue=False)
+
+    def search(self, query, start=0, rows=20, sort=None, cursor=None,
+               fields=None, timeout=None):
+        """
+        Search the model's index, see QuerySet.search
+
+        :rtype: Future<SearchResults>
+        """
+        return self._submit(
+            timeout, self.objects.search, query, start=start, rows=rows,
+            sort=sort, cursor=cursor, fields=fields)
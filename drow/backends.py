@@ -0,0 +1,868 @@
+__author__ = 'max'
+
+import fnmatch
+import json
+import re
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from copy import deepcopy
+from threading import Lock
+from time import sleep
+from time import time
+from uuid import uuid4
+
+from riak import RiakError
+from riak.bucket import BucketType
+from riak.bucket import RiakBucket
+from riak.client import default_encoder
+from riak.client.index_page import IndexPage
+from riak.content import RiakContent
+from riak.resolver import default_resolver
+from riak.riak_object import RiakObject
+from riak.riak_object import VClock
+
+# The properties of buckets in the default bucket type, as in Riak 2
+DEFAULT_PROPS = {'allow_mult': False, 'last_write_wins': False}
+
+# The properties of buckets in any other bucket type
+TYPED_PROPS = {'allow_mult': True, 'last_write_wins': False}
+
+
+class Backend(object):
+    """
+    The part of the Riak client that models use, so that their data can be
+    kept somewhere other than a Riak cluster.  Assign one to the "backend"
+    option of a model's Meta class.
+
+    A backend stands in for a RiakClient: buckets and objects are the Riak
+    client's own, and they call the backend the way they would call the
+    client.  Subclasses implement fetching, storing and deleting objects,
+    listing keys, secondary index queries and searches.
+    """
+    def __init__(self):
+        self.resolver = default_resolver
+        self._encoders = {
+            'application/json': default_encoder,
+            'text/json': default_encoder,
+            'text/plain': str
+        }
+        self._decoders = {
+            'application/json': json.loads,
+            'text/json': json.loads,
+            'text/plain': str
+        }
+        self._buckets = {}
+        self._bucket_types = {}
+        self._lock = Lock()
+
+    def get_encoder(self, content_type):
+        return self._encoders.get(content_type)
+
+    def set_encoder(self, content_type, encoder):
+        self._encoders[content_type] = encoder
+
+    def get_decoder(self, content_type):
+        return self._decoders.get(content_type)
+
+    def set_decoder(self, content_type, decoder):
+        self._decoders[content_type] = decoder
+
+    def bucket_type(self, name):
+        """
+        :param str name: The name of the bucket type
+        :rtype: BucketType
+        """
+        with self._lock:
+            if name not in self._bucket_types:
+                self._bucket_types[name] = BucketType(self, name)
+            return self._bucket_types[name]
+
+    def bucket(self, name, bucket_type='default'):
+        """
+        Buckets are kept for the life of the backend, so that the resolver
+        and codecs set on a model's bucket apply to every fetch
+
+        :param str name: The name of the bucket
+        :param bucket_type: The bucket type, or its name
+        :rtype: RiakBucket
+        """
+        if not isinstance(bucket_type, BucketType):
+            bucket_type = self.bucket_type(bucket_type)
+        with self._lock:
+            ident = (bucket_type.name, name)
+            if ident not in self._buckets:
+                self._buckets[ident] = RiakBucket(self, name, bucket_type)
+            return self._buckets[ident]
+
+    def multiget(self, keys, **options):
+        """
+        Fetch several objects, one after the other
+
+        :param list<tuple> keys: The (bucket type, bucket, key) of each
+                                 object to fetch
+        :return: The RiakObject fetched for each key, or a tuple of the
+                 bucket type, bucket, key and exception if it failed
+        :rtype: list
+        """
+        results = []
+        for type_name, bucket_name, key in keys:
+            try:
+                bucket = self.bucket(bucket_name, type_name)
+                results.append(bucket.get(key, **options))
+            except Exception as e:
+                results.append((type_name, bucket_name, key, e))
+        return results
+
+    def get(self, robj, **options):
+        """
+        Fill in a RiakObject with the siblings stored at its key, leaving it
+        with no siblings if nothing is stored there
+
+        :param RiakObject robj: The object to fetch
+        :rtype: RiakObject
+        """
+        raise NotImplementedError
+
+    def put(self, robj, return_body=True, if_none_match=False, **options):
+        """
+        Store a RiakObject, generating a key for it if it has none
+
+        :param RiakObject robj: The object to store
+        :param bool return_body: Fill in the object with what is now stored
+        :param bool if_none_match: Fail if an object is already stored at
+                                   the key
+        :rtype: RiakObject
+        """
+        raise NotImplementedError
+
+    def delete(self, robj, **options):
+        """
+        :param RiakObject robj: The object to delete
+        :rtype: RiakObject
+        """
+        raise NotImplementedError
+
+    def get_keys(self, bucket, **options):
+        """
+        :param RiakBucket bucket: The bucket to list
+        :return: Every key stored in the bucket
+        :rtype: list<str>
+        """
+        raise NotImplementedError
+
+    def get_index(self, bucket, index, startkey, endkey=None,
+                  return_terms=None, max_results=None, continuation=None,
+                  timeout=None, term_regex=None):
+        """
+        Query a secondary index, see RiakClient.get_index
+
+        :rtype: IndexPage
+        """
+        raise NotImplementedError
+
+    def fulltext_search(self, index, query, **params):
+        """
+        Query a search index, see RiakClient.fulltext_search
+
+        :return: The matching documents ("docs"), the number of documents
+                 found ("num_found") and the best score ("max_score")
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def get_bucket_props(self, bucket):
+        raise NotImplementedError
+
+    def set_bucket_props(self, bucket, props):
+        raise NotImplementedError
+
+    def clear_bucket_props(self, bucket):
+        raise NotImplementedError
+
+    def get_bucket_type_props(self, bucket_type):
+        raise NotImplementedError
+
+    def set_bucket_type_props(self, bucket_type, props):
+        raise NotImplementedError
+
+
+class MemoryBackend(Backend):
+    """
+    Keeps objects in memory, behaving like a single Riak node: objects carry
+    vector clocks, and concurrent writes become siblings in buckets that
+    allow them (all but those of the default bucket type, unless their
+    "allow_mult" property is changed).  Secondary indexes and a subset of
+    Solr queries are supported, for realistic tests and benchmarks without
+    a cluster.
+
+    Every object is indexed for search under the "search_index" property of
+    its bucket (or bucket type), or under the bucket's name if it has none.
+    Riak data types are not supported.
+
+    Every request can be delayed by a given latency, to stand in for the
+    network round trip.  A multiget is a single request.
+    """
+    def __init__(self, actor='memory', latency=0):
+        """
+        :param str actor: The name this backend's writes are recorded under
+                          in vector clocks
+        :param latency: The seconds each request takes, or a function
+                        returning them (e.g. to draw them at random)
+        """
+        super(MemoryBackend, self).__init__()
+        self.actor = actor
+        self.latency = latency
+        # Maps (bucket type, bucket) to the objects stored in the bucket,
+        # each a dict of its vector clock and siblings by key
+        self._store = {}
+        self._props = {}
+        self._type_props = {}
+        self._data_lock = Lock()
+
+    def _round_trip(self):
+        """
+        Wait for as long as a request takes
+        """
+        latency = self.latency
+        if callable(latency):
+            latency = latency()
+        if latency > 0:
+            sleep(latency)
+
+    # ####### Objects #######
+
+    def multiget(self, keys, **options):
+        self._round_trip()
+        results = []
+        for type_name, bucket_name, key in keys:
+            bucket = self.bucket(bucket_name, type_name)
+            try:
+                results.append(self._fetch(RiakObject(self, bucket, key)))
+            except Exception as e:
+                results.append((type_name, bucket_name, key, e))
+        return results
+
+    def get(self, robj, **options):
+        self._round_trip()
+        return self._fetch(robj)
+
+    def _fetch(self, robj):
+        """
+        :param RiakObject robj: The object to fill in with what is stored at
+                                its key
+        :rtype: RiakObject
+        """
+        with self._data_lock:
+            stored = self._objects(robj.bucket).get(robj.key)
+            if stored is not None:
+                stored = (stored['clock'], list(stored['siblings']))
+
+        if stored is None:
+            robj.siblings = []
+        else:
+            self._load(robj, *stored)
+        return robj
+
+    def put(self, robj, return_body=True, if_none_match=False, **options):
+        if len(robj.siblings) != 1:
+            raise RiakError('Cannot store an object with siblings')
+        content = robj.siblings[0]
+        sibling = {
+            'encoded_data': content.encoded_data,
+            'content_type': content.content_type,
+            'charset': content.charset,
+            'usermeta': dict(content.usermeta),
+            'links': list(content.links),
+            'indexes': set(content.indexes),
+            'last_modified': time()
+        }
+        for field, _ in sibling['indexes']:
+            if not field.endswith(('_bin', '_int')):
+                raise RiakError(
+                    'Invalid index name {}, it must end with _bin or '
+                    '_int'.format(field))
+
+        self._round_trip()
+        if robj.key is None:
+            robj.key = uuid4().hex
+        context = self._decode_clock(robj.vclock)
+        allow_mult = self.get_bucket_props(robj.bucket)['allow_mult']
+
+        with self._data_lock:
+            objects = self._objects(robj.bucket, create=True)
+            stored = objects.get(robj.key)
+            if stored is None:
+                stored = {'clock': {}, 'siblings': []}
+            elif if_none_match:
+                raise RiakError('match_found')
+
+            # Siblings the writer had seen are replaced, the others are kept
+            # alongside the new value
+            counter = stored['clock'].get(self.actor, 0) + 1
+            sibling['dot'] = counter
+            if allow_mult:
+                siblings = [
+                    s for s in stored['siblings']
+                    if s['dot'] > context.get(self.actor, 0)
+                ]
+            else:
+                siblings = []
+            siblings.append(sibling)
+
+            clock = dict(stored['clock'])
+            clock[self.actor] = counter
+            objects[robj.key] = {'clock': clock, 'siblings': siblings}
+
+        if return_body:
+            self._load(robj, clock, siblings)
+        return robj
+
+    def delete(self, robj, **options):
+        self._round_trip()
+        with self._data_lock:
+            self._objects(robj.bucket).pop(robj.key, None)
+        robj.siblings = []
+        return robj
+
+    def _objects(self, bucket, create=False):
+        """
+        Must be called holding the data lock
+
+        :param RiakBucket bucket: A bucket
+        :param bool create: Create the bucket's storage if it doesn't exist
+        :return: The objects stored in the bucket by key
+        :rtype: dict
+        """
+        ident = (bucket.bucket_type.name, bucket.name)
+        if create:
+            return self._store.setdefault(ident, {})
+        return self._store.get(ident, {})
+
+    def _load(self, robj, clock, siblings):
+        """
+        Fill in a RiakObject the way the Riak client decodes a response,
+        resolving its siblings if it has more than one
+
+        :param RiakObject robj: The object to fill in
+        :param dict clock: The vector clock of the stored object
+        :param list<dict> siblings: The stored siblings
+        """
+        robj.vclock = self._encode_clock(clock)
+        robj.siblings = [
+            RiakContent(
+                robj,
+                encoded_data=s['encoded_data'],
+                charset=s['charset'],
+                content_type=s['content_type'],
+                last_modified=s['last_modified'],
+                usermeta=dict(s['usermeta']),
+                links=list(s['links']),
+                indexes=set(s['indexes']),
+                exists=True)
+            for s in siblings
+        ]
+        if len(robj.siblings) > 1 and robj.resolver is not None:
+            robj.resolver(robj)
+
+    @staticmethod
+    def _encode_clock(clock):
+        """
+        :param dict clock: The counter of each actor
+        :rtype: VClock
+        """
+        return VClock(json.dumps(clock, sort_keys=True), 'binary')
+
+    @staticmethod
+    def _decode_clock(vclock):
+        """
+        :param VClock vclock: A vector clock sent by the client, or None
+        :return: The counter of each actor, empty if the vector clock wasn't
+                 made by a MemoryBackend
+        :rtype: dict
+        """
+        if vclock is None:
+            return {}
+        try:
+            clock = json.loads(vclock.encode('binary'))
+        except ValueError:
+            return {}
+        if not isinstance(clock, dict):
+            return {}
+        return clock
+
+    # ####### Keys and secondary indexes #######
+
+    def get_keys(self, bucket, **options):
+        self._round_trip()
+        with self._data_lock:
+            return sorted(self._objects(bucket))
+
+    def get_index(self, bucket, index, startkey, endkey=None,
+                  return_terms=None, max_results=None, continuation=None,
+                  timeout=None, term_regex=None):
+        self._round_trip()
+        if endkey is None:
+            endkey = startkey
+        integer = index.endswith('_int')
+        if integer:
+            startkey, endkey = int(startkey), int(endkey)
+
+        with self._data_lock:
+            objects = self._objects(bucket).items()
+
+        matches = set()
+        for key, stored in objects:
+            if index == '$bucket':
+                terms = [bucket.name]
+            elif index == '$key':
+                terms = [key]
+            else:
+                terms = [
+                    value for s in stored['siblings']
+                    for field, value in s['indexes'] if field == index
+                ]
+            for term in terms:
+                if integer:
+                    term = int(term)
+                if not startkey <= term <= endkey:
+                    continue
+                if term_regex is not None and \
+                        not re.search(term_regex, unicode(term)):
+                    continue
+                matches.add((term, key))
+        matches = sorted(matches)
+
+        if continuation is not None:
+            after = tuple(json.loads(urlsafe_b64decode(str(continuation))))
+            matches = [m for m in matches if m > after]
+
+        next_continuation = None
+        if max_results is not None and len(matches) > max_results:
+            matches = matches[:max_results]
+            next_continuation = urlsafe_b64encode(json.dumps(matches[-1]))
+
+        page = IndexPage(self, bucket, index, startkey, endkey,
+                         return_terms, max_results, term_regex)
+        if return_terms:
+            page.results = matches
+        else:
+            page.results = [key for _, key in matches]
+        page.continuation = next_continuation
+        return page
+
+    # ####### Search #######
+
+    def fulltext_search(self, index, query, **params):
+        self._round_trip()
+        matcher = SolrQuery(query)
+        filters = params.get('filter') or params.get('fq')
+        if filters is not None:
+            filter_matcher = SolrQuery(filters)
+        else:
+            filter_matcher = None
+
+        docs = []
+        found = False
+        for bucket, objects in self._indexed(index):
+            found = True
+            for key, stored in objects:
+                for sibling in stored['siblings']:
+                    doc = self._document(bucket, key, sibling)
+                    if not matcher.matches(doc):
+                        continue
+                    if filter_matcher is not None and \
+                            not filter_matcher.matches(doc):
+                        continue
+                    docs.append(doc)
+        if not found:
+            raise RiakError('No index {} found.'.format(index))
+
+        sort = params.get('sort')
+        if sort:
+            for clause in reversed(sort.split(',')):
+                field, direction = clause.split()
+                docs.sort(key=lambda d: _sort_key(d.get(field)),
+                          reverse=direction.lower() == 'desc')
+
+        num_found = len(docs)
+        start = int(params.get('start') or 0)
+        rows = params.get('rows')
+        rows = 10 if rows is None else int(rows)
+        docs = docs[start:start + rows]
+
+        fl = params.get('fl')
+        if fl and isinstance(fl, basestring):
+            fl = fl.replace(',', ' ').split()
+        if not fl or '*' in fl:
+            fl = None
+
+        # Values are returned as strings, as they are by Riak
+        docs = [
+            dict((f, _texts(v)) for f, v in d.iteritems()
+                 if fl is None or f in fl)
+            for d in docs
+        ]
+
+        return {
+            'docs': docs,
+            'num_found': num_found,
+            'max_score': 1.0 if num_found else 0.0
+        }
+
+    def _indexed(self, index):
+        """
+        :param str index: The name of a search index
+        :return: The (bucket, objects) of each bucket indexed under the
+                 index, where objects is a list of (key, stored object)
+        :rtype: list<tuple>
+        """
+        with self._data_lock:
+            stored = [(i, objects.items()) for i, objects in
+                      self._store.items()]
+
+        indexed = []
+        for (type_name, bucket_name), objects in stored:
+            bucket = self.bucket(bucket_name, type_name)
+            props = self.get_bucket_props(bucket)
+            if props.get('search_index', bucket_name) == index:
+                indexed.append((bucket, objects))
+        return indexed
+
+    def _document(self, bucket, key, sibling):
+        """
+        Build the Solr document indexing a sibling: nested values are
+        flattened into dotted field names, and lists into multiple values.
+        Siblings are never changed once stored, so the document is only
+        built the first time it is searched.
+
+        :param RiakBucket bucket: The bucket of the object
+        :param str key: The key of the object
+        :param dict sibling: The stored sibling
+        :rtype: dict
+        """
+        doc = sibling.get('document')
+        if doc is not None:
+            return doc
+
+        doc = {}
+        decoder = bucket.get_decoder(sibling['content_type'])
+        if decoder is not None and \
+                'json' in (sibling['content_type'] or ''):
+            try:
+                _flatten(decoder(sibling['encoded_data']), '', doc)
+            except ValueError:
+                pass
+        doc.update({
+            '_yz_rk': key,
+            '_yz_rb': bucket.name,
+            '_yz_rt': bucket.bucket_type.name,
+            '_yz_id': '{}/{}/{}/{}'.format(
+                bucket.bucket_type.name, bucket.name, key, sibling['dot']),
+            'score': 1.0
+        })
+        sibling['document'] = doc
+        return doc
+
+    # ####### Properties #######
+
+    def get_bucket_props(self, bucket):
+        if bucket.bucket_type.is_default():
+            props = dict(DEFAULT_PROPS)
+        else:
+            props = dict(TYPED_PROPS)
+        props.update(self.get_bucket_type_props(bucket.bucket_type))
+        props.update(self._props.get(
+            (bucket.bucket_type.name, bucket.name), {}))
+        props['name'] = bucket.name
+        return props
+
+    def set_bucket_props(self, bucket, props):
+        self._props.setdefault(
+            (bucket.bucket_type.name, bucket.name), {}).update(props)
+
+    def clear_bucket_props(self, bucket):
+        self._props.pop((bucket.bucket_type.name, bucket.name), None)
+        return True
+
+    def get_bucket_type_props(self, bucket_type):
+        return deepcopy(self._type_props.get(bucket_type.name, {}))
+
+    def set_bucket_type_props(self, bucket_type, props):
+        if 'datatype' in props:
+            raise RiakError('Riak data types are not supported')
+        self._type_props.setdefault(bucket_type.name, {}).update(props)
+
+
+def _flatten(value, prefix, doc):
+    """
+    Add a decoded value to a Solr document
+
+    :param value: The value to add
+    :param str prefix: The field name of the value
+    :param dict doc: The document, values of the same field are collected
+                     into a list
+    """
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            _flatten(item, prefix + '.' + key if prefix else key, doc)
+    elif isinstance(value, list):
+        for item in value:
+            _flatten(item, prefix, doc)
+    elif prefix and value is not None:
+        if prefix not in doc:
+            doc[prefix] = value
+        elif isinstance(doc[prefix], list):
+            doc[prefix].append(value)
+        else:
+            doc[prefix] = [doc[prefix], value]
+
+
+def _sort_key(value):
+    """
+    Order documents missing a field after the others, and multi-valued
+    fields by their first value
+
+    :param value: The value of the sort field, or None
+    :rtype: tuple
+    """
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return (value is None, value)
+
+
+class SolrQuery(object):
+    """
+    Matches Solr documents against the subset of the Solr query syntax used
+    with drow: field:value terms (with * and ? wildcards, and quoted
+    phrases), [a TO b] and {a TO b} ranges, *:*, AND, OR, NOT, - and
+    parentheses.  Adjacent terms are ORed, as in Solr.  Values match
+    exactly, they are not analysed.
+    """
+    TOKEN = re.compile(r'''
+        \s*(?:
+            (?P<open>\()
+          | (?P<close>\))
+          | (?P<op>AND\b|OR\b|NOT\b|&&|\|\||-)
+          | (?P<field>[^\s():"\[\]{}]+):
+            (?:
+                (?P<range>[\[{])\s*
+                (?P<low>"(?:\\.|[^"\\])*"|[^\s\]}]+)\s+TO\s+
+                (?P<high>"(?:\\.|[^"\\])*"|[^\s\]}]+)\s*
+                (?P<range_end>[\]}])
+              | (?P<phrase>"(?:\\.|[^"\\])*")
+              | (?P<word>(?:\\.|[^\s()\\])+)
+            )
+        )''', re.VERBOSE)
+
+    def __init__(self, query):
+        """
+        :param str query: The Solr query text
+        :raises RiakError: If the query can't be parsed
+        """
+        self.query = query
+        self._tokens = self._tokenize(query)
+        self._position = 0
+        self._tree = self._parse_or()
+        if self._position != len(self._tokens):
+            self._fail()
+
+    def _fail(self):
+        raise RiakError(
+            'Query unsuccessful check the logs: {}'.format(self.query))
+
+    def _tokenize(self, query):
+        tokens = []
+        position = 0
+        query = query.strip()
+        while position < len(query):
+            match = self.TOKEN.match(query, position)
+            if match is None or match.end() == position:
+                self._fail()
+            position = match.end()
+            if match.group('open'):
+                tokens.append(('(', None))
+            elif match.group('close'):
+                tokens.append((')', None))
+            elif match.group('op'):
+                tokens.append((
+                    {'&&': 'AND', '||': 'OR', '-': 'NOT'}.get(
+                        match.group('op'), match.group('op')), None))
+            elif match.group('range'):
+                tokens.append(('range', (
+                    match.group('field'),
+                    _unquote(match.group('low')),
+                    _unquote(match.group('high')),
+                    match.group('range') == '[',
+                    match.group('range_end') == ']')))
+            elif match.group('phrase'):
+                tokens.append(('term', (
+                    match.group('field'),
+                    _unquote(match.group('phrase')), False)))
+            else:
+                word = match.group('word')
+                tokens.append(('term', (
+                    match.group('field'),
+                    re.sub(r'\\(.)', r'\1', word),
+                    re.search(r'(?<!\\)[*?]', word) is not None)))
+        return tokens
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position][0]
+        return None
+
+    def _next(self):
+        token = self._tokens[self._position]
+        self._position += 1
+        return token
+
+    def _parse_or(self):
+        clauses = [self._parse_and()]
+        while self._peek() not in (None, ')'):
+            if self._peek() == 'OR':
+                self._next()
+            clauses.append(self._parse_and())
+        return ('or', clauses) if len(clauses) > 1 else clauses[0]
+
+    def _parse_and(self):
+        clauses = [self._parse_not()]
+        while self._peek() == 'AND':
+            self._next()
+            clauses.append(self._parse_not())
+        return ('and', clauses) if len(clauses) > 1 else clauses[0]
+
+    def _parse_not(self):
+        kind = self._peek()
+        if kind == 'NOT':
+            self._next()
+            return ('not', self._parse_not())
+        if kind == '(':
+            self._next()
+            clause = self._parse_or()
+            if self._peek() != ')':
+                self._fail()
+            self._next()
+            return clause
+        if kind in ('term', 'range'):
+            return self._next()
+        self._fail()
+
+    def matches(self, doc):
+        """
+        :param dict doc: A Solr document
+        :return: True if the document matches the query
+        :rtype: bool
+        """
+        return self._match(self._tree, doc)
+
+    def _match(self, clause, doc):
+        kind, value = clause
+        if kind == 'or':
+            return any(self._match(c, doc) for c in value)
+        if kind == 'and':
+            return all(self._match(c, doc) for c in value)
+        if kind == 'not':
+            return not self._match(value, doc)
+
+        field = value[0]
+        if field == '*':
+            return True
+        values = doc.get(field)
+        if values is None:
+            return False
+        if not isinstance(values, list):
+            values = [values]
+
+        if kind == 'range':
+            _, low, high, low_inclusive, high_inclusive = value
+            return any(
+                _in_range(v, low, high, low_inclusive, high_inclusive)
+                for v in values
+            )
+
+        _, term, wildcard = value
+        if wildcard:
+            if term == '*':
+                return True
+            return any(
+                fnmatch.fnmatchcase(_text(v), term) for v in values)
+        return any(_equal(v, term) for v in values)
+
+
+def _unquote(text):
+    """
+    :param str text: A query value, possibly a quoted phrase
+    :return: The value without quotes or escapes
+    :rtype: unicode
+    """
+    if text.startswith('"'):
+        text = text[1:-1]
+    return re.sub(r'\\(.)', r'\1', text)
+
+
+def _text(value):
+    """
+    :param value: A document value
+    :return: The value as Solr would show it
+    :rtype: unicode
+    """
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    return unicode(value)
+
+
+def _texts(value):
+    """
+    :param value: A document value, or list of values
+    :return: The value(s) as Solr would show them
+    :rtype: unicode or list<unicode>
+    """
+    if isinstance(value, list):
+        return [_text(v) for v in value]
+    return _text(value)
+
+
+def _coerce(value, term):
+    """
+    :param value: A document value
+    :param unicode term: A query value
+    :return: The query value converted to the type of the document value
+    :raises ValueError: If it can't be converted
+    """
+    if isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool):
+        return float(term)
+    return term
+
+
+def _equal(value, term):
+    """
+    :param value: A document value
+    :param unicode term: A query value
+    :rtype: bool
+    """
+    try:
+        coerced = _coerce(value, term)
+    except ValueError:
+        return False
+    if coerced is term:
+        return _text(value) == term
+    return value == coerced
+
+
+def _in_range(value, low, high, low_inclusive, high_inclusive):
+    try:
+        if not isinstance(value, (int, long, float)) or \
+                isinstance(value, bool):
+            value = _text(value)
+        if low != '*':
+            low = _coerce(value, low)
+            if value < low or (value == low and not low_inclusive):
+                return False
+        if high != '*':
+            high = _coerce(value, high)
+            if value > high or (value == high and not high_inclusive):
+                return False
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,150 @@
+__author__ = 'max'
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class ObjectCache(object):
+    """
+    A thread-safe, in-process, least recently used cache with optional limits
+    on the number of entries, their total size and their age.  Assign one to
+    the "cache" option of a model's Meta class to have reads of that model
+    served from memory, or to the "negative_cache" option to remember which
+    keys do not exist.
+    """
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None,
+                 revalidate=False):
+        """
+        :param int max_entries: The most entries to hold at once, None for no
+                                limit
+        :param int max_bytes: The most encoded bytes to hold at once, None
+                              for no limit
+        :param float ttl: The number of seconds an entry may be served for,
+                          None for no limit
+        :param bool revalidate: Rather than discarding entries once they are
+                                older than the ttl, check their vclock against
+                                the one stored in Riak and keep them if it is
+                                unchanged
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.revalidate = revalidate
+
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def hit_rate(self):
+        """
+        :return: The fraction of lookups that found an entry
+        :rtype: float
+        """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def get(self, key, include_expired=False):
+        """
+        Look up an entry, marking it as the most recently used
+
+        :param str key: The key to look up
+        :param bool include_expired: Return entries older than the ttl rather
+                                     than discarding them
+        :return: A tuple of (value, expired), or None if there is no entry
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, expires = entry
+            expired = expires is not None and expires <= time()
+            if expired and not include_expired:
+                self.size -= size
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self.hits += 1
+            return value, expired
+
+    def set(self, key, value, size=0):
+        """
+        Add or replace an entry, evicting the least recently used entries
+        if the cache is full
+
+        :param str key: The key to store the value under
+        :param value: The value to store
+        :param int size: The number of bytes the value is counted as
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.invalidate(key)
+            return
+
+        expires = None
+        if self.ttl is not None:
+            expires = time() + self.ttl
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self._entries[key] = (value, size, expires)
+            self.size += size
+
+            while self._entries and (
+                    (self.max_entries is not None and
+                     len(self._entries) > self.max_entries) or
+                    (self.max_bytes is not None and
+                     self.size > self.max_bytes)):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def touch(self, key):
+        """
+        Restart the ttl of an existing entry
+
+        :param str key: The key of the entry
+        """
+        if self.ttl is None:
+            return
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], time() + self.ttl)
+
+    def invalidate(self, key):
+        """
+        Remove an entry, if it exists
+
+        :param str key: The key to remove
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
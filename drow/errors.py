@@ -16,3 +16,41 @@ class SearchError(Exception):
 
 class CannotResolveSiblings(Exception):
     pass
+
+
+class WriteConflict(Exception):
+    pass
+
+
+class BulkError(Exception):
+    def __init__(self, message, errors):
+        """
+        :param str message: A description of the failure
+        :param dict errors: Maps the key of each failed object to the
+                            exception it raised
+        """
+        super(BulkError, self).__init__(message)
+        self.errors = errors
+
+
+class InvalidMapData(Exception):
+    pass
+
+
+class CancelledError(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, message, tracker):
+        """
+        :param str message: A description of the requests made
+        :param RoundTripTracker tracker: The tracker whose budget was
+                                         exceeded
+        """
+        super(BudgetExceeded, self).__init__(message)
+        self.tracker = tracker
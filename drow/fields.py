@@ -13,8 +13,97 @@ def solr_now():
     return datetime.utcnow().isoformat() + 'Z'
 
 
+# The storage operations field constraints are enforced for
+FIELD_OPERATIONS = ('create', 'put', 'patch')
+
+
 class ModelField(object):
-    pass
+    # Whether new_value depends on the old value (or on whether the object
+    # is being created).  If no field of a model does, the model can be put
+    # without first fetching the stored object.
+    needs_old_value = True
+
+    # The Riak data type the field is stored as by models stored as maps,
+    # None if it can't be.  Patches sent to such maps without reading them
+    # only set the fields that need the operation's time (see needs_time).
+    map_type = None
+
+    def compile(self, operation):
+        """
+        Return a function computing the field's value for a given storage
+        operation, so that the decisions that only depend on the operation
+        are made once rather than for every object stored.  Fields only need
+        to override this to be faster than new_value.
+
+        :param str operation: One of "patch", "create", "put"
+        :return: A function taking the proposed value, the old value and the
+                 operation's timestamp (see needs_time) and returning the
+                 value to be stored, or None if the field leaves the data
+                 alone for this operation
+        :rtype: function
+        """
+        def rule(proposed_value, old_value, now):
+            return self.new_value(operation, proposed_value, old_value)
+        return rule
+
+    def needs_time(self, operation):
+        """
+        :param str operation: One of "patch", "create", "put"
+        :return: True if the field's value for this operation is the time
+                 of the operation
+        :rtype: bool
+        """
+        return False
+
+
+class FieldPlan(object):
+    """
+    The field constraints a model enforces for one storage operation,
+    compiled ahead of time
+    """
+    def __init__(self, fields, operation):
+        """
+        :param dict fields: The model's fields, by name
+        :param str operation: One of "patch", "create", "put"
+        """
+        self.operation = operation
+        rules = []
+        for name in sorted(fields):
+            rule = fields[name].compile(operation)
+            if rule is not None:
+                rules.append((name, rule))
+        self.rules = tuple(rules)
+        self.needs_time = any(
+            fields[name].needs_time(operation) for name, _ in self.rules)
+
+    def timestamp(self):
+        """
+        :return: A timestamp to share between every object the operation is
+                 applied to, or None if no field needs one
+        :rtype: str
+        """
+        if self.needs_time:
+            return solr_now()
+        return None
+
+    def apply(self, data, old_values=None, now=None):
+        """
+        Enforce the field constraints on data in place
+
+        :param dict data: The data about to be stored
+        :param dict old_values: The values the fields previously held, by
+                                name
+        :param str now: The timestamp of the operation, a new one is made if
+                        it is needed but not provided
+        """
+        if not self.rules:
+            return
+        if now is None and self.needs_time:
+            now = solr_now()
+        if old_values is None:
+            old_values = {}
+        for name, rule in self.rules:
+            data[name] = rule(data.get(name), old_values.get(name), now)
 
 
 class AutoDateField(ModelField):
@@ -23,6 +112,8 @@ class AutoDateField(ModelField):
     If any part of a request wants to overwrite this data, that part of the
     request will be ignored.
     """
+    map_type = 'register'
+
     def __init__(self, name=None, only_on_creation=False):
         """
         :param str name: The name of the JSON field to store the data under
@@ -31,8 +122,10 @@ class AutoDateField(ModelField):
         self.name = name
         self.apply_on_create = True
         self.apply_on_update = not only_on_creation
+        self.needs_old_value = only_on_creation
 
-    def new_value(self, operation, proposed_value=None, old_value=None):
+    def new_value(self, operation, proposed_value=None, old_value=None,
+                  now=None):
         """
         Return the computed value for a given storage operation based on
         the value of the old field.
@@ -40,17 +133,30 @@ class AutoDateField(ModelField):
         :param str operation: One of "patch", "create", "put"
         :param proposed_value: The value proposed by the save operation
         :param old_value: The original value
+        :param str now: The timestamp of the operation, defaults to the
+                        current time
         :return: The value to be stored
         """
         if not self.apply_on_update and operation != 'create':
             return old_value
-        return solr_now()
+        return now or solr_now()
+
+    def compile(self, operation):
+        if not self.apply_on_update and operation != 'create':
+            return lambda proposed_value, old_value, now: old_value
+        return lambda proposed_value, old_value, now: now
+
+    def needs_time(self, operation):
+        return self.apply_on_update or operation == 'create'
 
 
 class DefaultFalseField(ModelField):
     """
     A field that will default to False if not otherwise declared
     """
+    needs_old_value = False
+    map_type = 'flag'
+
     def __init__(self, name=None):
         """
         :param str name: The name of the JSON field to store the data under
@@ -71,3 +177,7 @@ class DefaultFalseField(ModelField):
             return proposed_value
         else:
             return False
+
+    def compile(self, operation):
+        return lambda proposed_value, old_value, now: \
+            False if proposed_value is None else proposed_value
@@ -0,0 +1,442 @@
+__author__ = 'max'
+
+from copy import deepcopy
+
+from errors import InvalidConfig
+from errors import InvalidMapData
+from errors import InvalidPatch
+from patch import apply_patch
+from patch import parse_pointer
+from queryset import QuerySet
+from session import current_session
+
+# The Riak data types the keys of a map schema may be stored as.  Nested
+# maps are declared as a dict (their own schema) rather than by name.
+MAP_TYPES = ('register', 'flag', 'counter', 'set')
+
+
+class NeedsRead(Exception):
+    """
+    Raised when a patch cannot be sent to Riak without the current value of
+    the map (e.g. removals, which need the map's context)
+    """
+    pass
+
+
+def check_schema(schema, path=''):
+    """
+    :param dict schema: Maps each key of a document to the Riak data type it
+                        is stored as, or to the schema of a nested map
+    :param str path: Where the schema is nested in the document
+    :raises InvalidConfig: If the schema names an unknown data type
+    """
+    if not isinstance(schema, dict):
+        raise InvalidConfig('A map schema must be a dict')
+    for name, kind in schema.iteritems():
+        if isinstance(kind, dict):
+            check_schema(kind, '{}/{}'.format(path, name))
+        elif kind not in MAP_TYPES:
+            raise InvalidConfig('Unknown map type for {}/{}: {!r}'.format(
+                path, name, kind))
+
+
+def _kind(schema_type):
+    """
+    :param schema_type: A data type name or the schema of a nested map
+    :return: The Riak data type name
+    :rtype: str
+    """
+    return 'map' if isinstance(schema_type, dict) else schema_type
+
+
+def _check_value(kind, value, path):
+    """
+    :param str kind: The Riak data type the value will be stored as
+    :param value: A value from a document
+    :param str path: Where the value is in the document
+    :raises InvalidMapData: If the value can't be stored as the data type
+    """
+    if kind == 'register':
+        valid = isinstance(value, basestring)
+    elif kind == 'flag':
+        valid = isinstance(value, bool)
+    elif kind == 'counter':
+        valid = isinstance(value, (int, long)) and \
+            not isinstance(value, bool)
+    elif kind == 'set':
+        valid = isinstance(value, list) and \
+            all(isinstance(e, basestring) for e in value)
+    else:
+        valid = isinstance(value, dict)
+    if not valid:
+        raise InvalidMapData('{} must be stored as a {}, not {!r}'.format(
+            path, kind, value))
+
+
+def to_data(value, schema):
+    """
+    Present the value of a Riak map as a JSON document: registers become
+    strings, flags booleans (False if absent), counters integers, sets
+    sorted lists and nested maps dicts
+
+    :param dict value: The map's value, keyed by (name, data type)
+    :param dict schema: The map's schema
+    :return: The document
+    :rtype: dict
+    """
+    data = {}
+    for (name, kind), item in value.iteritems():
+        schema_type = schema.get(name)
+        if schema_type is not None and _kind(schema_type) != kind:
+            continue
+        if kind == 'map':
+            item = to_data(
+                item, schema_type if isinstance(schema_type, dict) else {})
+        elif kind == 'set':
+            item = sorted(item)
+        data[name] = item
+    for name, schema_type in schema.iteritems():
+        if schema_type == 'flag':
+            data.setdefault(name, False)
+    return data
+
+
+def stage_changes(riak_map, schema, old, new, path=''):
+    """
+    Stage the map operations that turn one version of a document into
+    another on a Riak map.  Removals need the map to have been fetched.
+
+    :param Map riak_map: The map the old version was read from
+    :param dict schema: The map's schema
+    :param dict old: The document as read from the map
+    :param dict new: The document to store
+    :param str path: Where the map is nested in the document
+    :raises InvalidMapData: If the new document doesn't fit the schema
+    """
+    for name in set(old) | set(new):
+        item_path = '{}/{}'.format(path, name)
+        previous = old.get(name)
+        value = new.get(name)
+        if name in new and name in old and value == previous:
+            continue
+
+        schema_type = schema.get(name)
+        if schema_type is None:
+            raise InvalidMapData(
+                '{} is not in the map schema'.format(item_path))
+        kind = _kind(schema_type)
+
+        if name not in new:
+            if kind != 'flag' or previous:
+                del riak_map[(name, kind)]
+            continue
+
+        _check_value(kind, value, item_path)
+        if kind == 'register':
+            riak_map.registers[name].assign(value)
+        elif kind == 'flag':
+            # Absent flags are disabled
+            if value and not previous:
+                riak_map.flags[name].enable()
+            elif previous and not value:
+                riak_map.flags[name].disable()
+        elif kind == 'counter':
+            riak_map.counters[name].increment(value - (previous or 0))
+        elif kind == 'set':
+            previous = set(previous or [])
+            value = set(value)
+            for element in value - previous:
+                riak_map.sets[name].add(element)
+            for element in previous - value:
+                riak_map.sets[name].discard(element)
+        else:
+            stage_changes(riak_map.maps[name], schema_type, previous or {},
+                          value, item_path)
+
+
+def stage_patch(riak_map, schema, operations):
+    """
+    Stage the map operations equivalent to a JSON patch on a Riak map that
+    hasn't been fetched, so the patch can be sent as a delta.  Only these
+    operations can be sent that way:
+
+        * "replace" of a register, or of a flag with true
+        * "add" of an element to a set, at the path "/set/-"
+        * "increment" of a counter by a value (an operation only map models
+          understand)
+
+    :param Map riak_map: A new map, for the key being patched
+    :param dict schema: The map's schema
+    :param list operations: The JSON patch operations
+    :raises NeedsRead: If any operation needs the map to be fetched first
+    :raises InvalidPatch: If the patch is malformed
+    :raises InvalidMapData: If the patch doesn't fit the schema
+    """
+    for operation in operations:
+        try:
+            op = operation['op']
+            path = operation['path']
+        except KeyError:
+            raise InvalidPatch('Missing required jsonpatch parameter')
+        except TypeError:
+            raise InvalidPatch('Not a JSON patch: {!r}'.format(operations))
+
+        tokens = parse_pointer(path)
+        if not tokens:
+            raise NeedsRead()
+
+        parent = riak_map
+        parent_schema = schema
+        depth = 0
+        while depth < len(tokens) - 1 and \
+                isinstance(parent_schema.get(tokens[depth][0]), dict):
+            parent = parent.maps[tokens[depth][0]]
+            parent_schema = parent_schema[tokens[depth][0]]
+            depth += 1
+
+        name = tokens[depth][0]
+        kind = parent_schema.get(name)
+        if kind is None:
+            raise InvalidMapData('{} is not in the map schema'.format(path))
+
+        value = operation.get('value')
+        rest = tokens[depth + 1:]
+        if rest:
+            if kind != 'set' or op != 'add' or rest != (('-', None),):
+                raise NeedsRead()
+            _check_value(kind, [value], path)
+            parent.sets[name].add(value)
+        elif kind == 'register' and op == 'replace':
+            _check_value(kind, value, path)
+            parent.registers[name].assign(value)
+        elif kind == 'flag' and op == 'replace' and value is True:
+            parent.flags[name].enable()
+        elif kind == 'counter' and op == 'increment':
+            _check_value(kind, value, path)
+            parent.counters[name].increment(value)
+        else:
+            raise NeedsRead()
+
+
+def apply_map_patch(operations, data):
+    """
+    Apply a JSON patch, which may include "increment" operations, to a
+    document read from a map
+
+    :param list operations: The JSON patch operations
+    :param dict data: The document, which is left alone
+    :return: The patched document
+    :rtype: dict
+    :raises InvalidPatch: If the patch is invalid or cannot be applied
+    """
+    data = deepcopy(data)
+    pending = []
+    for operation in operations:
+        if not isinstance(operation, dict) or \
+                operation.get('op') != 'increment':
+            pending.append(operation)
+            continue
+
+        data = apply_patch(pending, data)
+        pending = []
+
+        path = operation.get('path')
+        parent = data
+        tokens = parse_pointer(path)
+        try:
+            for token in tokens[:-1]:
+                parent = parent[token[0]]
+        except (KeyError, TypeError):
+            raise InvalidPatch('Path does not exist: {}'.format(path))
+        if not tokens or not isinstance(parent, dict):
+            raise InvalidPatch('Cannot increment: {}'.format(path))
+
+        try:
+            parent[tokens[-1][0]] = \
+                parent.get(tokens[-1][0], 0) + operation['value']
+        except KeyError:
+            raise InvalidPatch('Missing required jsonpatch parameter')
+        except TypeError:
+            raise InvalidPatch('Cannot increment: {}'.format(path))
+
+    return apply_patch(pending, data)
+
+
+class MapObject(object):
+    """
+    Holds a Riak map in place of a RiakObject, presenting the map's value as
+    a JSON document (see to_data) and storing the changes made to the
+    document as map operations
+    """
+    vclock = None
+
+    def __init__(self, riak_map, schema, data=None):
+        """
+        :param Map riak_map: The map, fetched or new
+        :param dict schema: The map's schema
+        :param dict data: The document to store, if the map is new
+        """
+        self.riak_map = riak_map
+        self.schema = schema
+        self.content_type = None
+        self._data = data
+
+    @property
+    def key(self):
+        return self.riak_map.key
+
+    @property
+    def exists(self):
+        return bool(self.riak_map.context) or len(self.riak_map) > 0
+
+    @property
+    def siblings(self):
+        return [self]
+
+    @property
+    def data(self):
+        if self._data is None and self.exists:
+            self._data = to_data(self.riak_map.value, self.schema)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def store(self, **kwargs):
+        """
+        Send the changes made to the document since it was read to Riak
+
+        :return: The MapObject itself, holding the updated map
+        :rtype: MapObject
+        """
+        loaded = {}
+        if self.exists:
+            loaded = to_data(self.riak_map.value, self.schema)
+
+        self.riak_map.clear()
+        stage_changes(self.riak_map, self.schema, loaded, self.data or {})
+        if self.riak_map.modified:
+            self.riak_map.update(include_context=True)
+            self._data = None
+        return self
+
+
+class MapQuerySet(QuerySet):
+    """
+    Queries the database for models stored as Riak maps (see the map_schema
+    option).  Objects are read and written through MapObjects, and patches
+    are sent to Riak as map operations, without fetching the map first if
+    possible.
+    """
+    def _wrap(self, riak_map):
+        """
+        :param Map riak_map: A map fetched from Riak
+        :return: The map, wrapped for use by a model instance
+        :rtype: MapObject
+        """
+        return MapObject(riak_map, self._state.model._meta.map_schema)
+
+    def _fetch(self, key, expired_entry=None):
+        return self._wrap(
+            super(MapQuerySet, self)._fetch(key, expired_entry))
+
+    def _share(self, riak_object):
+        # Every caller wraps the shared map, so gets its own document
+        return riak_object
+
+    def _multiget(self, keys, concurrency=None):
+        fetched = super(MapQuerySet, self)._multiget(keys, concurrency)
+        for key, riak_object in fetched.items():
+            if not isinstance(riak_object, (Exception, MapObject)):
+                fetched[key] = self._wrap(riak_object)
+        return fetched
+
+    def _same_version(self, current, loaded):
+        # Maps carry an opaque causal context rather than a vclock
+        context = loaded.riak_map.context
+        return context is not None and current.context == context
+
+    def _new_riak_object(self, data, now=None):
+        self._state.model._meta.field_plans['create'].apply(data, now=now)
+        return MapObject(
+            self._state.bucket.new(), self._state.model._meta.map_schema,
+            data)
+
+    def patch(self, key, patch):
+        """
+        Apply the provided patch to the map stored at the given key
+
+        If every operation of the patch can be sent to Riak as a delta (see
+        stage_patch), and the model has no storage validator to run against
+        the whole document, the patch is sent without fetching the map.  In
+        that case the key is created if it doesn't exist, and a lazy
+        instance is returned.  Otherwise the map is fetched, patched and the
+        changes are stored.
+
+        :param str key: The key in Riak to be patched
+        :param patch: A JsonPatch, or a list of JSON patch operations, which
+                      may include "increment" operations on counters
+        :return: A Model instance
+        :rtype: Model
+        """
+        operations = getattr(patch, 'patch', patch)
+        meta = self._state.model._meta
+        if meta.storage_validator is None and current_session() is None:
+            riak_map = self._state.bucket.new(key)
+            try:
+                stage_patch(riak_map, meta.map_schema, operations)
+            except NeedsRead:
+                pass
+            else:
+                now = self._timestamp('patch')
+                for name, field in meta.fields.iteritems():
+                    if field.needs_time('patch'):
+                        riak_map.registers[name].assign(now)
+                if riak_map.modified:
+                    self._instrumented(
+                        'store', lambda: riak_map.update(return_body=False))
+                return self._state.model(key)
+
+        instance = self.get(key, active=True)
+        self._patch_instance(instance, operations)
+        return instance
+
+    def _patch_instance(self, instance, patch, check_conflict=None):
+        old_values = instance._field_values()
+        data = apply_map_patch(getattr(patch, 'patch', patch), instance.data)
+        instance._state.riak_object.data = data
+
+        self._state.model._meta.field_plans['patch'].apply(data, old_values)
+
+        self._store_instance(instance, check_conflict)
+
+    def delete(self, key, queue=True):
+        riak_map = super(MapQuerySet, self).delete(key, queue)
+        if riak_map is None:
+            return None
+        return self._wrap(riak_map)
+
+
+def map_schema(meta):
+    """
+    Combine a model's map_schema option with the data types of its fields
+
+    :param Options meta: The model's options, with its fields
+    :return: The schema of the model's maps
+    :rtype: dict
+    :raises InvalidConfig: If the model can't be stored as a map
+    """
+    for option in ('cache', 'negative_cache', 'write_behind'):
+        if getattr(meta, option) is not None:
+            raise InvalidConfig(
+                "Models stored as maps can't use {}".format(option))
+
+    schema = dict(meta.map_schema)
+    for name, field in meta.fields.iteritems():
+        if field.map_type is None:
+            raise InvalidConfig(
+                "The {} field can't be stored in a map".format(name))
+        schema.setdefault(name, field.map_type)
+    check_schema(schema)
+    return schema
@@ -0,0 +1,289 @@
+__author__ = 'max'
+
+from bisect import bisect_left
+from threading import Lock
+from time import time
+
+# The upper bounds, in seconds, of the latency histogram buckets: 50
+# microseconds doubling up to about 52 seconds
+LATENCY_BUCKETS = tuple(0.00005 * 2 ** i for i in xrange(21))
+
+
+class Event(object):
+    """
+    Describes one call a model made: a request to Riak ("get", "multiget",
+    "store", "delete", "search", "keys", "index"), a sibling resolution
+    ("resolve") or a run of a validator ("validate_creation",
+    "validate_storage")
+    """
+    __slots__ = ('model', 'operation', 'keys', 'seconds', 'encoded_bytes',
+                 'siblings', 'outcome', 'error')
+
+    def __init__(self, model, operation, keys, seconds, encoded_bytes=None,
+                 siblings=None, outcome='ok', error=None):
+        """
+        :param str model: The name of the model
+        :param str operation: The kind of call
+        :param int keys: The number of keys (or search results) involved
+        :param float seconds: How long the call took
+        :param int encoded_bytes: The size of the encoded objects sent or
+                                  received, if it is known
+        :param int siblings: The number of siblings received, if any
+        :param str outcome: "ok", "not_found" or "error"
+        :param Exception error: The exception raised, if any
+        """
+        self.model = model
+        self.operation = operation
+        self.keys = keys
+        self.seconds = seconds
+        self.encoded_bytes = encoded_bytes
+        self.siblings = siblings
+        self.outcome = outcome
+        self.error = error
+
+    def __repr__(self):
+        return '<Event {}.{} {} keys {:.6f}s {}>'.format(
+            self.model, self.operation, self.keys, self.seconds,
+            self.outcome)
+
+
+class Histogram(object):
+    """
+    Counts values in exponentially growing buckets, so that percentiles can
+    be estimated in constant memory.  Not thread safe by itself.
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        :param tuple bounds: The upper bound of each bucket, in order, values
+                             above the last go in an overflow bucket
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """
+        :param float value: The value to count
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        :param float fraction: The fraction of values at or below the result
+        :return: The upper bound of the bucket holding the percentile (the
+                 largest value, for the overflow bucket), None if empty
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return min(bound, self.max)
+        return self.max
+
+
+class OperationMetrics(object):
+    """
+    The running totals of one operation of one model
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.not_found = 0
+        self.keys = 0
+        self.encoded_bytes = 0
+        self.siblings = 0
+        self.max_siblings = 0
+        self.latency = Histogram()
+
+    def record(self, event):
+        """
+        :param Event event: An event of the operation
+        """
+        self.calls += 1
+        if event.outcome == 'error':
+            self.errors += 1
+        elif event.outcome == 'not_found':
+            self.not_found += 1
+        self.keys += event.keys
+        if event.encoded_bytes is not None:
+            self.encoded_bytes += event.encoded_bytes
+        if event.siblings is not None:
+            self.siblings += event.siblings
+            self.max_siblings = max(self.max_siblings, event.siblings)
+        self.latency.add(event.seconds)
+
+    def as_dict(self):
+        """
+        :return: The totals, with the mean, median, 99th percentile and
+                 largest latencies in seconds
+        :rtype: dict
+        """
+        latency = self.latency
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'not_found': self.not_found,
+            'keys': self.keys,
+            'encoded_bytes': self.encoded_bytes,
+            'siblings': self.siblings,
+            'max_siblings': self.max_siblings,
+            'seconds': latency.total,
+            'mean': latency.total / latency.count if latency.count else None,
+            'p50': latency.percentile(0.5),
+            'p99': latency.percentile(0.99),
+            'max': latency.max
+        }
+
+
+class MetricsAggregator(object):
+    """
+    Collects the events of one or more models in memory, keeping running
+    totals and a latency histogram per model and operation.  Assign one to
+    the "instrumentation" option of models' Meta classes.
+
+    Any object with a ``record(event)`` method can be used as
+    instrumentation instead, e.g. to forward events to a metrics service.
+    It is called on the thread that made the call, so it should be quick.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def record(self, event):
+        """
+        :param Event event: The event to count
+        """
+        key = (event.model, event.operation)
+        with self._lock:
+            metrics = self._metrics.get(key)
+            if metrics is None:
+                metrics = self._metrics[key] = OperationMetrics()
+            metrics.record(event)
+
+    def snapshot(self, model=None):
+        """
+        :param str model: Only include the operations of this model
+        :return: The totals (see OperationMetrics.as_dict) of each operation,
+                 keyed by (model, operation)
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(
+                (key, metrics.as_dict())
+                for key, metrics in self._metrics.iteritems()
+                if model is None or key[0] == model
+            )
+
+    def reset(self):
+        """
+        Forget every event recorded so far
+        """
+        with self._lock:
+            self._metrics.clear()
+
+
+def encoded_size(riak_object):
+    """
+    :param RiakObject riak_object: An object sent to or received from Riak
+    :return: The total size of its siblings' encoded data, if they haven't
+             been decoded yet, otherwise None
+    :rtype: int
+    """
+    size = None
+    for sibling in getattr(riak_object, 'siblings', ()):
+        encoded_data = getattr(sibling, '_encoded_data', None)
+        if isinstance(encoded_data, basestring):
+            size = (size or 0) + len(encoded_data)
+    return size
+
+
+def _exists(riak_object):
+    """
+    :param riak_object: A RiakObject, or a Riak data type such as a Map
+    :return: Whether it was found
+    :rtype: bool
+    """
+    exists = getattr(riak_object, 'exists', None)
+    if exists is None:
+        # Data types have neither siblings nor "exists", only a context
+        return bool(getattr(riak_object, 'context', None))
+    return exists
+
+
+def _siblings(riak_object):
+    """
+    :param riak_object: A RiakObject, or a Riak data type such as a Map
+    :return: The number of siblings received, None for data types
+    :rtype: int
+    """
+    siblings = getattr(riak_object, 'siblings', None)
+    if siblings is None:
+        return None
+    return len(siblings)
+
+
+def measure_object(riak_object):
+    """
+    :param riak_object: A RiakObject (or Riak data type) received from Riak
+    :return: The keys, encoded bytes, siblings and outcome of fetching it
+    :rtype: tuple
+    """
+    outcome = 'ok' if _exists(riak_object) else 'not_found'
+    return (1, encoded_size(riak_object), _siblings(riak_object), outcome)
+
+
+def measure_objects(results):
+    """
+    :param list results: The results of a multiget, RiakObjects (or Riak
+                         data types) or tuples describing failed fetches
+    :return: The keys, encoded bytes, siblings and outcome of the multiget
+    :rtype: tuple
+    """
+    size = None
+    siblings = None
+    outcome = 'ok'
+    for result in results:
+        if isinstance(result, tuple):
+            outcome = 'error'
+            continue
+        object_size = encoded_size(result)
+        if object_size is not None:
+            size = (size or 0) + object_size
+        object_siblings = _siblings(result)
+        if object_siblings is not None:
+            siblings = (siblings or 0) + object_siblings
+    return len(results), size, siblings, outcome
+
+
+def instrument_resolver(resolver, instrumentation, model):
+    """
+    :param function resolver: A sibling resolver
+    :param instrumentation: Where to record the resolutions
+    :param str model: The name of the model
+    :return: A resolver recording a "resolve" event for every resolution
+    :rtype: function
+    """
+    def resolve(riak_object):
+        siblings = len(riak_object.siblings)
+        size = encoded_size(riak_object)
+        start = time()
+        try:
+            resolver(riak_object)
+        except Exception as e:
+            instrumentation.record(Event(
+                model, 'resolve', 1, time() - start, size, siblings,
+                'error', e))
+            raise
+        instrumentation.record(Event(
+            model, 'resolve', 1, time() - start, size, siblings))
+    return resolve
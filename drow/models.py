@@ -1,13 +1,33 @@
 __author__ = 'max'
 
+import hashlib
+import json
+from asyncqueryset import AsyncQuerySet
 from conf import settings
 from queryset import QuerySet
 from queryset import QuerySetState
+from queryset import SearchStats
+from repair import ReadRepair
+from metrics import instrument_resolver
+from pool import SingleFlight
+from maps import MapQuerySet
+from maps import map_schema
+from resolvers import JsonResolver
+from resolvers import ResolverStats
+from resolvers import resolve_json
+# resolve_json_as_set is re-exported for callers importing it from here
+from resolvers import resolve_json_as_set  # noqa: F401
 from errors import InvalidConfig
 from errors import DoesNotExist
 from errors import InvalidPatch
 from errors import SearchError
+from errors import BulkError
+from errors import WriteConflict
+from fields import FIELD_OPERATIONS
+from fields import FieldPlan
 from fields import ModelField
+from pool import DEFAULT_CONCURRENCY
+from session import current_session
 
 DEFAULT_CONTENT_TYPE = 'application/json'
 
@@ -17,102 +37,24 @@ REQUIRED_SETTINGS = [
 ]
 
 
-def resolve_json_as_set(riak_object):
+def fingerprint(data):
     """
-    Like the resolve_json, except lists are treated like sets such
-    that the result of list resolution is union of all lists.
-
-    Do not use this resolver if your JSON has a list of anything other than
-    primitives (int, string, float, bool, etc.), the result of merging such
-    data models would be unpredictable.
-
-    :param RiakObject riak_object: The riak object to resolve
+    Digest data so that changes to it can be detected without holding on to
+    a copy of it.  Dictionaries are digested key by key, so that the keys
+    that changed can be told apart.
+
+    :param data: The decoded data of an object
+    :return: A digest of every top-level value by key if data is a
+             dictionary, otherwise a single digest of data
+    :rtype: dict or str
     """
-    def recursive_update(resolution, sibling):
-        """
-        This sub-function does the actual merging.
-
-        :param dict resolution: The dictionary into which the results will
-                                be merged
-        :param dict sibling: The dictionary to be integrated into the results
-        """
-        resolution_keys = set(resolution.keys())
-        sibling_keys = set(sibling.keys())
-        new_keys = sibling_keys - resolution_keys
-
-        # deep copy is not necessary here as the siblings will be destroyed
-        # anyways
-        for key in new_keys:
-            resolution[key] = sibling[key]
-
-        overlapping_keys = resolution_keys.intersection(sibling_keys)
-
-        for key in overlapping_keys:
-            if isinstance(resolution[key], dict):
-                recursive_update(resolution[key], sibling[key])
-            elif isinstance(resolution[key], list):
-                list_resolution = set(resolution[key])
-                list_resolution.update(sibling[key])
-                resolution[key] = list(list_resolution)
-            else:
-                resolution[key] = sibling[key]
-
-    oldest_version_first = sorted(
-        riak_object.siblings, key=lambda s: s.last_modified)
-
-    resolution = oldest_version_first[0]
-    for sibling in oldest_version_first[1:]:
-        recursive_update(resolution.data, sibling.data)
-
-    riak_object.siblings = [resolution]
-
-
-def resolve_json(riak_object):
-    """
-    This is a Riak sibling resolver that tries to merge dictionaries with
-    the following logic:
-
-        1) For any value other than a dictionary, the most recent version
-           of that value wins.
-        2) For dictionaries, all keys will be merged.  In the case of key
-           conflicts, rule (1) will apply for non-dictionary values.  For
-           dictionary values, rule (2) will be recursively applied.
-
-    :param RiakObject riak_object: The Riak object to resolve
-    """
-    def recursive_update(resolution, sibling):
-        """
-        This sub-function does the actual merging.
+    def digest(value):
+        encoded = json.dumps(value, sort_keys=True, default=repr)
+        return hashlib.sha1(encoded).digest()
 
-        :param dict resolution: The dictionary into which the results will
-                                be merged
-        :param dict sibling: The dictionary to be integrated into the results
-        """
-        resolution_keys = set(resolution.keys())
-        sibling_keys = set(sibling.keys())
-        new_keys = sibling_keys - resolution_keys
-
-        # deep copy is not necessary here as the siblings will be destroyed
-        # anyways
-        for key in new_keys:
-            resolution[key] = sibling[key]
-
-        overlapping_keys = resolution_keys.intersection(sibling_keys)
-
-        for key in overlapping_keys:
-            if isinstance(resolution[key], dict):
-                recursive_update(resolution[key], sibling[key])
-            else:
-                resolution[key] = sibling[key]
-
-    oldest_version_first = sorted(
-        riak_object.siblings, key=lambda s: s.last_modified)
-
-    resolution = oldest_version_first[0]
-    for sibling in oldest_version_first[1:]:
-        recursive_update(resolution.data, sibling.data)
-
-    riak_object.siblings = [resolution]
+    if isinstance(data, dict):
+        return dict((key, digest(value)) for key, value in data.iteritems())
+    return digest(data)
 
 
 class ModelState(object):
@@ -162,12 +104,18 @@ class Options(object):
         :return: A Riak bucket
         :rtype: RiakBucket
         """
-        bucket_type = settings.RIAK_CLIENT.bucket_type(self.bucket_type_name)
+        client = self.backend
+        if client is None:
+            client = settings.RIAK_CLIENT
+        bucket_type = client.bucket_type(self.bucket_type_name)
         return bucket_type.bucket(self.bucket_name)
 
     # abstract classes are inheritable, not full Riak models
     abstract = False
 
+    # Backend holding the model's data, None for settings.RIAK_CLIENT
+    backend = None
+
     # the content type of serialized data
     content_type = DEFAULT_CONTENT_TYPE
 
@@ -189,6 +137,47 @@ class Options(object):
     # function that validates the correct data is being stored in Riak
     storage_validator = None
 
+    # maximum number of simultaneous requests made by bulk operations
+    concurrency = DEFAULT_CONCURRENCY
+
+    # ObjectCache that reads are served from
+    cache = None
+
+    # ObjectCache remembering which keys do not exist
+    negative_cache = None
+
+    # share a single fetch between callers asking for the same key at once
+    coalesce_fetches = False
+
+    # give each caller sharing a fetch its own copy of the fetched object
+    copy_coalesced_fetches = False
+
+    # make instance saves/patches fail if the object changed since loading
+    check_conflicts = False
+
+    # fingerprint loaded data so that saving unchanged objects is skipped
+    track_changes = True
+
+    # put without fetching even when the vclock being replaced is unknown,
+    # only safe where the last write wins (allow_mult is False)
+    blind_puts = False
+
+    # WriteBehind buffering patches made through QuerySet.patch
+    write_behind = None
+
+    # ReadRepair (or True) writing objects back once their siblings resolve
+    write_back_resolved = False
+
+    # the Riak data type of each key, if objects are stored as Riak maps
+    map_schema = None
+
+    # Executor running the calls made through aobjects, None for the default
+    executor = None
+
+    # MetricsAggregator (or anything with a record method) given an Event for
+    # every call to Riak, resolution and validation, None to record nothing
+    instrumentation = None
+
 
 class ModelMetaclass(type):
     """
@@ -224,10 +213,16 @@ class ModelMetaclass(type):
         """
         if not getattr(cls._meta, 'abstract', False):
             if not hasattr(cls, 'objects'):
-                cls.objects = QuerySet()
+                if cls._meta.map_schema is not None:
+                    cls.objects = MapQuerySet()
+                else:
+                    cls.objects = QuerySet()
+            cls.aobjects = AsyncQuerySet(cls.objects)
             cls.objects._state = QuerySetState()
             cls.objects._state.model = cls
             cls.objects._state.bucket = cls._meta.get_bucket()
+            cls.objects._state.search_stats = SearchStats()
+            cls.objects._state.single_flight = SingleFlight()
 
             # Set encoder/decoder if content type is non-standard
             if cls._meta.content_type != DEFAULT_CONTENT_TYPE:
@@ -258,10 +253,26 @@ class ModelMetaclass(type):
                 # return the raw function.  The disadvantage of this is it
                 # does not work with inheritance as __dict__ does not resolve
                 # attributes of parent classes.
-                cls.objects._state.bucket.resolver = \
-                    cls._meta.__dict__['resolver']
+                resolver = cls._meta.__dict__['resolver']
             else:
-                cls.objects._state.bucket.resolver = resolve_json
+                resolver = resolve_json
+
+            # JSON resolutions are counted per model
+            cls.objects._state.resolver_stats = ResolverStats()
+            if isinstance(resolver, JsonResolver):
+                resolver = resolver.with_stats(
+                    cls.objects._state.resolver_stats)
+
+            if cls._meta.instrumentation is not None:
+                resolver = instrument_resolver(
+                    resolver, cls._meta.instrumentation, cls.__name__)
+
+            if cls._meta.write_back_resolved is True:
+                cls._meta.write_back_resolved = ReadRepair(
+                    concurrency=cls._meta.concurrency)
+            if isinstance(cls._meta.write_back_resolved, ReadRepair):
+                resolver = cls._meta.write_back_resolved.wrap(resolver)
+            cls.objects._state.bucket.resolver = resolver
 
             cls._meta.fields = {}
             for name in dir(cls):
@@ -274,8 +285,36 @@ class ModelMetaclass(type):
 
                 cls._meta.fields[attribute.name] = attribute
 
+            cls._meta.put_needs_read = any(
+                f.needs_old_value for f in cls._meta.fields.values())
+            if cls._meta.map_schema is not None:
+                cls._meta.map_schema = map_schema(cls._meta)
+                # Replacing a map removes the keys missing from the new
+                # data, which needs the map's context
+                cls._meta.put_needs_read = True
+            cls._meta.field_plans = dict(
+                (operation, FieldPlan(cls._meta.fields, operation))
+                for operation in FIELD_OPERATIONS)
+
+            write_behind = cls._meta.write_behind
+            if write_behind is not None:
+                if write_behind.bound:
+                    raise InvalidConfig(
+                        "A write_behind buffer can't be shared by models")
+                write_behind.bind(cls.objects._apply_patches)
+
         super(ModelMetaclass, cls).__init__(name, bases, dct)
 
+    def __call__(cls, key, riak_object=None):
+        """
+        Create an instance of the model, or, while a Session is open, return
+        the session's instance for the key
+        """
+        session = current_session()
+        if session is None:
+            return super(ModelMetaclass, cls).__call__(key, riak_object)
+        return session.instance(cls, key, riak_object)
+
 
 class Model(object):
     """
@@ -289,6 +328,8 @@ class Model(object):
     DoesNotExist = DoesNotExist
     InvalidPatch = InvalidPatch
     SearchError = SearchError
+    BulkError = BulkError
+    WriteConflict = WriteConflict
 
     def __init__(self, key, riak_object=None):
         """
@@ -301,11 +342,14 @@ class Model(object):
         self._state = ModelState()
         self._state.riak_object = riak_object
         self._state.key = key
+        self._state.field_values = None
+        self._state.fingerprints = None
 
         # hide the objects manager, as it should not be accessed from an
         # active instance
         self._state.objects = self.objects
         self.objects = None
+        self.aobjects = None
 
     def __repr__(self):
         """
@@ -337,7 +381,9 @@ class Model(object):
         :rtype: dict
         """
         if not self._state.riak_object:
-            self._state.objects._active_get(self)
+            self._state.objects._active_get(self, lazy=True)
+        if self._state.field_values is None:
+            self._remember_loaded()
         return self._state.riak_object.data
 
     @data.setter
@@ -348,9 +394,47 @@ class Model(object):
         :param value: The value with which to replace the data dict
         """
         if not self._state.riak_object:
-            self._state.objects._active_get(self, must_exist=False)
+            self._state.objects._active_get(
+                self, must_exist=False, lazy=True)
+        if self._state.field_values is None:
+            self._remember_loaded()
         self._state.riak_object.data = value
 
+    def _remember_loaded(self):
+        """
+        Remember the values of the model's fields and the fingerprints of
+        the data as loaded.  This happens the first time the data is
+        accessed, and again once it has been stored, so that saving can
+        enforce the field constraints against the loaded values and tell
+        what changed no matter how the data was modified since.
+        """
+        data = self._state.riak_object.data
+        field_data = {}
+        if self._meta.fields and data:
+            field_data = data
+        self._state.field_values = dict(
+            (name, field_data.get(name, None)) for name in self._meta.fields)
+
+        if self._meta.track_changes:
+            self._state.fingerprints = fingerprint(data)
+
+    def _loaded(self):
+        """
+        Forget what was remembered about the loaded data, after it has been
+        replaced, so that it is remembered afresh on the next access
+        """
+        self._state.field_values = None
+        self._state.fingerprints = None
+
+    def _field_values(self):
+        """
+        :return: The loaded value of every field, by field name
+        :rtype: dict
+        """
+        if self._state.field_values is None:
+            self._remember_loaded()
+        return self._state.field_values
+
     @property
     def key(self):
         """
@@ -360,21 +444,116 @@ class Model(object):
         """
         return self._state.key
 
-    def save(self):
+    @property
+    def is_dirty(self):
+        """
+        Whether saving the object would change what is stored, i.e. the
+        object doesn't exist yet or its data was modified since it was
+        loaded.  Always True if the model doesn't track changes.
+
+        :rtype: bool
         """
-        Save an object to the database, Model.objects.patch is the preferred
-        method for swapping data that doesn't need to be examined beforehand
-        as it requires one query of the database as opposed to two.
+        riak_object = self._state.riak_object
+        if not riak_object:
+            return False
+        if not riak_object.exists or not self._meta.track_changes:
+            return True
+        if self._state.field_values is None:
+            return False
+        return fingerprint(riak_object.data) != self._state.fingerprints
+
+    @property
+    def changed_keys(self):
         """
-        return self._state.objects.put(self.key, self.data)
+        The top-level keys of the data that were added, removed or modified
+        since it was loaded
 
-    def patch(self, patch_data):
+        :rtype: set<str>
         """
-        Patch an object that already exists in the database.
+        if self._state.fingerprints is None:
+            return set()
+
+        loaded = self._state.fingerprints
+        current = fingerprint(self._state.riak_object.data)
+        if not isinstance(loaded, dict) or not isinstance(current, dict):
+            if loaded == current:
+                return set()
+            keys = set()
+            for fingerprints in (loaded, current):
+                if isinstance(fingerprints, dict):
+                    keys.update(fingerprints)
+            return keys
+
+        return set(key for key in set(loaded) | set(current)
+                   if loaded.get(key) != current.get(key))
+
+    def changes(self):
+        """
+        The modifications made to the data since it was loaded, as a JSON
+        patch replacing each changed top-level key.  The result can be given
+        to jsonpatch.JsonPatch and passed to patch.
+
+        :return: A list of JSON patch operations
+        :rtype: list<dict>
+        """
+        loaded = self._state.fingerprints
+        if not isinstance(loaded, dict):
+            loaded = {}
+        data = self._state.riak_object.data if self._state.riak_object else {}
+
+        operations = []
+        for key in sorted(self.changed_keys):
+            path = '/' + key.replace('~', '~0').replace('/', '~1')
+            if key not in data:
+                operations.append({'op': 'remove', 'path': path})
+            elif key in loaded:
+                operations.append(
+                    {'op': 'replace', 'path': path, 'value': data[key]})
+            else:
+                operations.append(
+                    {'op': 'add', 'path': path, 'value': data[key]})
+        return operations
+
+    def save(self, check_conflict=None, force=False):
+        """
+        Save an object to the database.  The object is only fetched if it
+        hasn't been loaded yet, the loaded object is otherwise stored with
+        the vclock it was loaded with.  Nothing is stored if the object
+        exists and its data hasn't changed since it was loaded.
+
+        :param bool check_conflict: Raise WriteConflict rather than saving if
+                                    the object was changed since it was
+                                    loaded, defaults to the model's
+                                    check_conflicts setting
+        :param bool force: Store the object even if nothing changed
+        :return: The instance itself
+        :rtype: Model
+        """
+        if not self._state.riak_object:
+            self._state.objects._active_get(
+                self, must_exist=False, lazy=True)
+        if force or self.is_dirty:
+            self._state.objects._save_instance(self, check_conflict)
+        return self
+
+    def patch(self, patch_data, check_conflict=None):
+        """
+        Patch an object that already exists in the database.  The patch is
+        applied to the data as loaded, so any unsaved modifications are
+        saved along with it.
 
         :param str patch_data: The patch to be applied
+        :param bool check_conflict: Raise WriteConflict rather than saving if
+                                    the object was changed since it was
+                                    loaded, defaults to the model's
+                                    check_conflicts setting
+        :return: The instance itself
+        :rtype: Model
         """
-        return self._state.objects.patch(self.key, patch_data)
+        if not self._state.riak_object:
+            self._state.objects._active_get(self, lazy=True)
+        self._state.objects._patch_instance(self, patch_data, check_conflict)
+        return self
 
     def delete(self):
         """
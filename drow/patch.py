@@ -0,0 +1,343 @@
+__author__ = 'max'
+
+from copy import deepcopy
+
+from errors import InvalidPatch
+
+# The most patch shapes (the operations and paths of a patch, without the
+# values) kept compiled at once
+MAX_COMPILED_SHAPES = 1024
+
+# The operations a JSON patch may contain, and whether they take a value
+OPERATIONS = {
+    'add': True,
+    'remove': False,
+    'replace': True,
+    'move': False,
+    'copy': False,
+    'test': True
+}
+
+_compiled_shapes = {}
+
+# Stands in for a value that doesn't exist
+_MISSING = object()
+
+
+def parse_pointer(pointer):
+    """
+    Split a JSON pointer into its (unescaped) reference tokens
+
+    :param str pointer: The JSON pointer, e.g. "/a/b~1c/0"
+    :return: A tuple of (key, index) pairs, one per token, where index is the
+             token as a list index (or None if it isn't one)
+    :rtype: tuple
+    """
+    if pointer == '':
+        return ()
+    if not pointer.startswith('/'):
+        raise InvalidPatch('Invalid JSON pointer: {!r}'.format(pointer))
+
+    tokens = []
+    for token in pointer.split('/')[1:]:
+        token = token.replace('~1', '/').replace('~0', '~')
+        index = None
+        if token.isdigit() and (token == '0' or not token.startswith('0')):
+            index = int(token)
+        tokens.append((token, index))
+    return tuple(tokens)
+
+
+def compile_patch(patch):
+    """
+    Compile a JSON patch for validating and applying.  The paths of patches
+    with the same operations and paths are only parsed once.
+
+    :param patch: A JsonPatch, or a list of JSON patch operations
+    :return: The compiled patch
+    :rtype: CompiledPatch
+    :raises InvalidPatch: If the patch is malformed
+    """
+    if isinstance(patch, CompiledPatch):
+        return patch
+
+    operations = getattr(patch, 'patch', patch)
+    try:
+        shape = tuple(
+            (o['op'], o['path'], o.get('from')) for o in operations)
+        values = [o['value'] if OPERATIONS.get(o['op']) else None
+                  for o in operations]
+    except KeyError:
+        raise InvalidPatch('Missing required jsonpatch parameter')
+    except (TypeError, AttributeError):
+        raise InvalidPatch('Not a JSON patch: {!r}'.format(patch))
+
+    steps = _compiled_shapes.get(shape)
+    if steps is None:
+        steps = []
+        for op, path, from_path in shape:
+            if op not in OPERATIONS:
+                raise InvalidPatch(
+                    'Unknown jsonpatch operation: {}'.format(op))
+            from_tokens = None
+            if op in ('move', 'copy'):
+                if from_path is None:
+                    raise InvalidPatch('Missing required jsonpatch parameter')
+                from_tokens = parse_pointer(from_path)
+            steps.append(
+                (op, path, parse_pointer(path), from_path, from_tokens))
+        steps = tuple(steps)
+
+        if len(_compiled_shapes) >= MAX_COMPILED_SHAPES:
+            _compiled_shapes.clear()
+        _compiled_shapes[shape] = steps
+
+    return CompiledPatch(steps, values)
+
+
+def validate_patch(patch, data):
+    """
+    We don't want to allow the "add" operation to replace existing elements
+    as this could clobber data that gets out of sync, clients should use the
+    "replace" operation to signify intent.
+
+    :param JsonPatch patch: The JsonPatch object to validate
+    :param data: The data the JsonPatch will be applied to
+    :raises InvalidPatch: If an "add" operation in the patch would clobber data
+    """
+    compile_patch(patch).validate(data)
+
+
+def apply_patch(patch, data):
+    """
+    Validate a patch (see validate_patch) and apply it to data in place, in
+    a single pass.  If any operation fails, the ones before it are undone.
+
+    :param patch: A JsonPatch, or a list of JSON patch operations
+    :param data: The data to patch
+    :return: The patched data, which is only a different object than data if
+             the patch replaced the whole document
+    :raises InvalidPatch: If the patch is invalid or cannot be applied
+    """
+    return compile_patch(patch).apply(data)
+
+
+def _child(container, token):
+    """
+    :param container: A dict or list
+    :param tuple token: The (key, index) pair to look up
+    :return: The value in container at the token
+    :raises KeyError: If there is no such value
+    """
+    if isinstance(container, list):
+        if token[1] is None or token[1] >= len(container):
+            raise KeyError(token[0])
+        return container[token[1]]
+    if isinstance(container, dict):
+        return container[token[0]]
+    raise KeyError(token[0])
+
+
+def _error(message, path):
+    """
+    :param str message: A description of the problem
+    :param str path: The path of the operation with the problem
+    :return: An error for the operation
+    :rtype: InvalidPatch
+    """
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return InvalidPatch('{}: {}'.format(message, path))
+
+
+class CompiledPatch(object):
+    """
+    A JSON patch whose paths have been parsed ahead of time
+    """
+    __slots__ = ('steps', 'values')
+
+    def __init__(self, steps, values):
+        """
+        :param tuple steps: The (op, path, tokens, from_path, from_tokens) of
+                            each operation
+        :param list values: The value of each operation
+        """
+        self.steps = steps
+        self.values = values
+
+    def validate(self, data):
+        """
+        Check that no "add" operation would replace an existing key
+
+        :param data: The data the patch will be applied to
+        :raises InvalidPatch: If an "add" operation would clobber data
+        """
+        for op, path, tokens, _, _ in self.steps:
+            if op != 'add':
+                continue
+            if not tokens:
+                raise _error('Cannot add a JSON key that already exists', path)
+            # Adding to a list inserts, which doesn't clobber anything
+            parent = data
+            try:
+                for token in tokens[:-1]:
+                    parent = _child(parent, token)
+            except KeyError:
+                continue
+            if isinstance(parent, dict) and tokens[-1][0] in parent:
+                raise _error('Cannot add a JSON key that already exists', path)
+
+    def apply(self, data):
+        """
+        Validate and apply the patch to data in place, undoing everything
+        if any operation fails
+
+        :param data: The data to patch
+        :return: The patched data, which is only a different object than
+                 data if the patch replaced the whole document
+        :raises InvalidPatch: If the patch is invalid or cannot be applied
+        """
+        # Each change made is recorded as (container, key or index, old
+        # value, what was done) so that it can be undone
+        undo = []
+        document = data
+        try:
+            for (op, path, tokens, from_path, from_tokens), value in \
+                    zip(self.steps, self.values):
+                if op == 'move':
+                    value = self._remove(
+                        self._get(document, from_tokens[:-1], from_path),
+                        from_tokens, from_path, undo)
+                elif op == 'copy':
+                    value = deepcopy(
+                        self._get(document, from_tokens, from_path))
+
+                if not tokens:
+                    if op == 'replace' or op == 'move' or op == 'copy':
+                        document = value
+                    elif op == 'test':
+                        if document != value:
+                            raise _error('Test failed', path)
+                    else:
+                        raise _error(
+                            'Cannot {} the whole document'.format(op), path)
+                    continue
+
+                parent = self._get(document, tokens[:-1], path)
+                if op == 'add':
+                    self._add(parent, tokens[-1], value, path, undo)
+                elif op == 'remove':
+                    self._remove(parent, tokens, path, undo)
+                elif op == 'test':
+                    try:
+                        current = _child(parent, tokens[-1])
+                    except KeyError:
+                        current = _MISSING
+                    if current != value:
+                        raise _error('Test failed', path)
+                else:
+                    # replace requires the target to exist, move and copy
+                    # may also create it
+                    self._set(parent, tokens[-1], value, path, undo,
+                              must_exist=op == 'replace')
+        except Exception as e:
+            for container, token, old, existed in reversed(undo):
+                if isinstance(container, list):
+                    if existed == 'inserted':
+                        del container[token]
+                    elif existed == 'removed':
+                        container.insert(token, old)
+                    else:
+                        container[token] = old
+                elif existed:
+                    container[token] = old
+                else:
+                    del container[token]
+            if isinstance(e, InvalidPatch):
+                raise
+            raise InvalidPatch('Cannot apply patch: {!r}'.format(e))
+
+        return document
+
+    @staticmethod
+    def _get(document, tokens, path):
+        """
+        :return: The value in document at the tokens
+        :raises InvalidPatch: If there is no such value
+        """
+        ref = document
+        try:
+            for token in tokens:
+                ref = _child(ref, token)
+        except KeyError:
+            raise _error('Path does not exist', path)
+        return ref
+
+    @staticmethod
+    def _add(parent, token, value, path, undo):
+        """
+        Add a new value, which may not replace an existing one
+        """
+        if isinstance(parent, list):
+            if token[0] == '-':
+                index = len(parent)
+            elif token[1] is None or token[1] > len(parent):
+                raise _error('Invalid list index', path)
+            else:
+                index = token[1]
+            parent.insert(index, value)
+            undo.append((parent, index, None, 'inserted'))
+        elif isinstance(parent, dict):
+            if token[0] in parent:
+                raise _error('Cannot add a JSON key that already exists', path)
+            parent[token[0]] = value
+            undo.append((parent, token[0], None, False))
+        else:
+            raise _error('Cannot add to a scalar', path)
+
+    @staticmethod
+    def _set(parent, token, value, path, undo, must_exist):
+        """
+        Set a value, replacing the existing one if there is one
+        """
+        if isinstance(parent, list):
+            if token[0] == '-' and not must_exist:
+                parent.append(value)
+                undo.append((parent, len(parent) - 1, None, 'inserted'))
+                return
+            if token[1] is None or token[1] >= len(parent):
+                raise _error('Invalid list index', path)
+            undo.append((parent, token[1], parent[token[1]], 'replaced'))
+            parent[token[1]] = value
+        elif isinstance(parent, dict):
+            existed = token[0] in parent
+            if must_exist and not existed:
+                raise _error('Path does not exist', path)
+            undo.append((parent, token[0], parent.get(token[0]), existed))
+            parent[token[0]] = value
+        else:
+            raise _error('Cannot set in a scalar', path)
+
+    @staticmethod
+    def _remove(parent, tokens, path, undo):
+        """
+        Remove a value
+
+        :return: The removed value
+        """
+        if not tokens:
+            raise _error('Cannot remove the whole document', path)
+        token = tokens[-1]
+        if isinstance(parent, list):
+            if token[1] is None or token[1] >= len(parent):
+                raise _error('Invalid list index', path)
+            old = parent.pop(token[1])
+            undo.append((parent, token[1], old, 'removed'))
+        elif isinstance(parent, dict):
+            if token[0] not in parent:
+                raise _error('Path does not exist', path)
+            old = parent.pop(token[0])
+            undo.append((parent, token[0], old, True))
+        else:
+            raise _error('Cannot remove from a scalar', path)
+        return old
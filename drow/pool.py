@@ -0,0 +1,470 @@
+__author__ = 'max'
+
+from Queue import Queue
+from Queue import Empty
+from threading import Condition
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import time
+import sys
+
+from errors import CancelledError
+from errors import DeadlineExceeded
+
+# The number of worker threads used by bulk operations when the model does
+# not specify its own value
+DEFAULT_CONCURRENCY = 8
+
+
+def run_concurrently(function, items, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Call function once for every item, using at most ``concurrency`` worker
+    threads.  Failures do not stop the remaining items from being processed.
+
+    :param function function: A function taking a single item
+    :param list items: The items to process
+    :param int concurrency: The maximum number of simultaneous calls
+    :return: A list of (result, exception) tuples in the same order as items,
+             exactly one member of each tuple will be None
+    :rtype: list<tuple>
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    def call(index):
+        try:
+            results[index] = (function(items[index]), None)
+        except Exception as e:
+            results[index] = (None, e)
+
+    # No point in paying for threads if they can't run anything in parallel
+    if concurrency is None or concurrency <= 1 or len(items) <= 1:
+        for index in xrange(len(items)):
+            call(index)
+        return results
+
+    work = Queue()
+    for index in xrange(len(items)):
+        work.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = work.get_nowait()
+            except Empty:
+                return
+            call(index)
+
+    threads = [Thread(target=worker)
+               for _ in xrange(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+class BackgroundTask(object):
+    """
+    Runs a function on its own thread so that its result can be collected
+    later, allowing work (such as fetching the next page of results) to
+    overlap with whatever the caller is doing in the meantime.
+    """
+    def __init__(self, function, *args, **kwargs):
+        """
+        Start running the function immediately
+
+        :param function function: The function to run
+        :param args: Positional arguments for the function
+        :param kwargs: Keyword arguments for the function
+        """
+        self._result = None
+        self._exc_info = None
+
+        def run():
+            try:
+                self._result = function(*args, **kwargs)
+            except Exception:
+                self._exc_info = sys.exc_info()
+
+        self._thread = Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def result(self):
+        """
+        Wait for the function to finish and return its result
+
+        :return: The value returned by the function
+        :raises Exception: Whatever exception the function raised
+        """
+        self._thread.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls made for the same key, so that only the first
+    caller (the leader) does the work and everyone else waits for, and
+    shares, its result.
+    """
+    class Call(object):
+        """
+        A call in flight for a single key
+        """
+        def __init__(self):
+            self.done = Event()
+            self.result = None
+            self.error = None
+
+        def wait(self):
+            """
+            Wait for the leader to finish and return its result
+
+            :return: The leader's result
+            :raises Exception: Whatever exception the leader raised
+            """
+            self.done.wait()
+            if self.error is not None:
+                raise self.error
+            return self.result
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = Lock()
+
+    def claim(self, key):
+        """
+        Join the call in flight for key, or start a new one
+
+        :param key: The key the call is for
+        :return: A tuple of (call, leader), if leader is True the caller must
+                 do the work and hand its outcome to finish
+        :rtype: tuple
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                return call, False
+
+            call = self._calls[key] = SingleFlight.Call()
+            return call, True
+
+    def finish(self, key, call, result=None, error=None):
+        """
+        Complete a call, releasing everyone waiting for it
+
+        :param key: The key the call is for
+        :param Call call: The call returned by claim
+        :param result: The result of the call
+        :param Exception error: The exception raised by the call, if any
+        """
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.result = result
+        call.error = error
+        call.done.set()
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Call function, unless a call for the same key is already in flight,
+        in which case wait for that call's result instead
+
+        :param key: The key the call is for
+        :param function function: The function to call
+        :return: A tuple of (result, shared), shared is True if the result
+                 came from another caller's call
+        :rtype: tuple
+        """
+        call, leader = self.claim(key)
+        if not leader:
+            return call.wait(), True
+
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result, False
+
+
+class Future(object):
+    """
+    The eventual result of a call submitted to an Executor
+    """
+    def __init__(self, deadline=None):
+        """
+        :param float deadline: The time by which the call must be done, if
+                               any.  The call is not started after it, and
+                               waiting for the result stops at it.
+        """
+        self.deadline = deadline
+        self._state = 'pending'
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._condition = Condition(Lock())
+
+    def cancel(self):
+        """
+        Cancel the call, unless it has already started
+
+        :return: True if the call is cancelled
+        :rtype: bool
+        """
+        with self._condition:
+            if self._state != 'pending':
+                return self._state == 'cancelled'
+            self._state = 'cancelled'
+            self._condition.notify_all()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        """
+        :rtype: bool
+        """
+        return self._state == 'cancelled'
+
+    def running(self):
+        """
+        :rtype: bool
+        """
+        return self._state == 'running'
+
+    def done(self):
+        """
+        :return: True if the call finished or was cancelled
+        :rtype: bool
+        """
+        return self._state in ('finished', 'cancelled')
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return its result
+
+        :param float timeout: The most seconds to wait, the wait also ends
+                              at the future's deadline
+        :return: The value returned by the call
+        :raises CancelledError: If the call was cancelled
+        :raises DeadlineExceeded: If the call didn't finish in time
+        :raises Exception: Whatever exception the call raised
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the call to finish and return the exception it raised
+
+        :param float timeout: The most seconds to wait, see result
+        :return: The exception raised by the call, or None
+        :raises CancelledError: If the call was cancelled
+        :raises DeadlineExceeded: If the call didn't finish in time
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, function):
+        """
+        Call function with the future once the call finishes or is
+        cancelled, or right away if it already has
+
+        :param function function: A function taking the future
+        """
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(function)
+                return
+        function(self)
+
+    def _wait(self, timeout):
+        """
+        Wait for the call to finish
+
+        :param float timeout: The most seconds to wait
+        :raises CancelledError: If the call was cancelled
+        :raises DeadlineExceeded: If the call didn't finish in time
+        """
+        until = self.deadline
+        if timeout is not None:
+            until = time() + timeout if until is None else \
+                min(until, time() + timeout)
+
+        with self._condition:
+            while not self.done():
+                if until is None:
+                    self._condition.wait()
+                    continue
+                remaining = until - time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+        if self.cancelled():
+            raise CancelledError('The call was cancelled')
+        if not self.done():
+            # Don't start a call nobody will wait for any more
+            if self.deadline is not None and time() >= self.deadline:
+                self.cancel()
+            raise DeadlineExceeded('The call did not finish in time')
+
+    def _start(self):
+        """
+        Mark the call as running, unless it was cancelled or missed its
+        deadline
+
+        :return: True if the call should be made
+        :rtype: bool
+        """
+        with self._condition:
+            if self._state != 'pending':
+                return False
+            if self.deadline is None or time() < self.deadline:
+                self._state = 'running'
+                return True
+            self._exc_info = (DeadlineExceeded, DeadlineExceeded(
+                'The call was not started in time'), None)
+            self._state = 'finished'
+            self._condition.notify_all()
+        self._run_callbacks()
+        return False
+
+    def _finish(self, result=None, exc_info=None):
+        """
+        Record the outcome of the call
+
+        :param result: The value returned by the call
+        :param tuple exc_info: The exception raised by the call, if any, as
+                               returned by sys.exc_info
+        """
+        with self._condition:
+            self._result = result
+            self._exc_info = exc_info
+            self._state = 'finished'
+            self._condition.notify_all()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        with self._condition:
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class Executor(object):
+    """
+    Runs submitted calls on a bounded pool of worker threads, which are
+    started as they are needed and kept for the life of the process
+    """
+    def __init__(self, max_workers=DEFAULT_CONCURRENCY):
+        """
+        :param int max_workers: The most calls run at once
+        """
+        self.max_workers = max_workers
+        self._work = Queue()
+        self._threads = []
+        self._idle = 0
+        self._lock = Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) on a worker thread
+
+        :param function function: The function to call
+        :return: The future result of the call
+        :rtype: Future
+        """
+        return self.submit_before(None, function, *args, **kwargs)
+
+    def submit_before(self, deadline, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) on a worker thread, unless no worker
+        is free to start the call before the deadline
+
+        :param float deadline: The time by which the call must be done, or
+                               None
+        :param function function: The function to call
+        :return: The future result of the call
+        :rtype: Future
+        """
+        future = Future(deadline)
+        self._work.put((future, function, args, kwargs))
+        with self._lock:
+            if self._idle < self._work.qsize() and \
+                    len(self._threads) < self.max_workers:
+                thread = Thread(target=self._worker)
+                thread.daemon = True
+                self._threads.append(thread)
+                self._idle += 1
+                thread.start()
+        return future
+
+    def _worker(self):
+        """
+        Run submitted calls, forever
+        """
+        while True:
+            future, function, args, kwargs = self._work.get()
+            with self._lock:
+                self._idle -= 1
+            if future._start():
+                try:
+                    result = function(*args, **kwargs)
+                except Exception:
+                    future._finish(exc_info=sys.exc_info())
+                else:
+                    future._finish(result)
+            with self._lock:
+                self._idle += 1
+
+
+def gather(futures, timeout=None, return_exceptions=False):
+    """
+    Wait for several futures
+
+    :param list futures: The futures to wait for
+    :param float timeout: The most seconds to wait for all of them
+    :param bool return_exceptions: Return the exception raised by a call in
+                                   place of its result, rather than raising
+                                   it
+    :return: The results of the futures, in order
+    :rtype: list
+    :raises DeadlineExceeded: If the futures didn't all finish in time, in
+                              which case those not yet started are cancelled
+    :raises Exception: The first exception raised by a call, unless
+                       return_exceptions is True, in which case those not
+                       yet started are cancelled
+    """
+    futures = list(futures)
+    deadline = None if timeout is None else time() + timeout
+
+    results = []
+    for future in futures:
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time(), 0)
+        try:
+            results.append(future.result(remaining))
+        except Exception as e:
+            if future.done() and return_exceptions:
+                results.append(e)
+                continue
+            for other in futures:
+                other.cancel()
+            raise
+    return results
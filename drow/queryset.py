@@ -1,34 +1,316 @@
 __author__ = 'max'
 
+import base64
+import json
+from collections import OrderedDict
+from copy import deepcopy
+from math import ceil
+from threading import Lock
+from time import time
 from riak import RiakError
 
-from errors import InvalidPatch
 from errors import DoesNotExist
 from errors import SearchError
+from errors import BulkError
+from errors import WriteConflict
+from metrics import Event
+from metrics import encoded_size
+from metrics import measure_object
+from metrics import measure_objects
+from pool import run_concurrently
+from pool import BackgroundTask
+from patch import apply_patch
+# validate_patch is re-exported for callers importing it from here
+from patch import validate_patch  # noqa: F401
+from roundtrips import ROUND_TRIPS
+from roundtrips import current_trackers
+from session import current_session
+
+# The most Solr results that will be requested per unique result wanted
+MAX_OVERFETCH = 4
+
+# The most Solr queries a single search will make to fill a page
+MAX_SEARCH_ROUNDS = 3
 
 
 class QuerySet(object):
     """
     Queries the database and returns instances of the associated Model
     """
-    def search(self, query, start=0, rows=20):
+    @property
+    def resolver_stats(self):
+        """
+        :return: The counters of the sibling resolutions done for the model
+                 by its JSON resolver
+        :rtype: ResolverStats
+        """
+        return self._state.resolver_stats
+
+    def _instrumented(self, operation, call, keys=1, measure=None):
+        """
+        Make a call, recording an Event for it if the model is instrumented
+        and counting it in the open RoundTripTrackers if it is a request
+
+        :param str operation: The kind of call, see Event
+        :param function call: The call to make
+        :param int keys: The number of keys involved, unless measured
+        :param function measure: Given the result, returns its keys, encoded
+                                 bytes, siblings and outcome
+        :return: The result of the call
+        """
+        model = self._state.model.__name__
+        if operation in ROUND_TRIPS:
+            for tracker in current_trackers():
+                tracker.round_trip(model, operation)
+
+        instrumentation = self._state.model._meta.instrumentation
+        if instrumentation is None:
+            return call()
+
+        start = time()
+        try:
+            result = call()
+        except Exception as e:
+            instrumentation.record(Event(
+                model, operation, keys, time() - start, outcome='error',
+                error=e))
+            raise
+        seconds = time() - start
+
+        encoded_bytes = siblings = None
+        outcome = 'ok'
+        if measure is not None:
+            keys, encoded_bytes, siblings, outcome = measure(result)
+        instrumentation.record(Event(
+            model, operation, keys, seconds, encoded_bytes, siblings,
+            outcome))
+        return result
+
+    def search(self, query, start=0, rows=20, sort=None, cursor=None,
+               fields=None):
         """
         Search the Solr index using the given query, return the results
 
+        Riak search returns one result per sibling, so objects with siblings
+        are returned by Solr more than once.  To still fill the page, more
+        results than needed are requested from Solr (based on how many
+        duplicates this model's searches have seen so far), and Solr is
+        queried again if there are still too few unique results.
+
+        If a sort is given, the results will carry a cursor that can be
+        passed back to fetch the page that follows them.  Paging by cursor
+        costs the same no matter how deep the page is, and is not thrown off
+        by objects being added or removed between pages.
+
+        If fields are given, the objects are not fetched from Riak at all.
+        Instead, read-only SearchRows are built from the values stored in
+        the Solr index.
+
         :param str query: The Solr query text
         :param int start: The index at which to start returning results
-        :param int rows: The number of rows to return **NOTE** if there are any
-                     siblings, fewer rows than requested will be returned,
-                     as siblings are de-duplicated
+        :param int rows: The number of unique results to return, fewer will
+                         only be returned if the results are exhausted
+        :param str sort: The Solr sort specification, e.g. "createdTs desc".
+                         Every field used must be stored in the index
+        :param str cursor: The cursor of the previous page of results, only
+                           valid with the same query and sort
+        :param list<str> fields: The stored Solr fields to return
         :return: The search results
-        :rtype: SearchResults<Model>
+        :rtype: SearchResults<Model> or SearchResults<SearchRow>
+        """
+        params = {}
+        fl = None
+        if fields is not None:
+            fl = ['_yz_rk'] + list(fields)
+
+        sort_fields = None
+        cursor_values = None
+        if sort is not None:
+            sort_fields = parse_sort(sort)
+            params['sort'] = format_sort(sort_fields)
+            if cursor is not None:
+                if start:
+                    raise SearchError('Cannot page by both start and cursor')
+                cursor_values = decode_cursor(cursor, sort_fields)
+            if fl is not None:
+                fl.extend(f for f, _ in sort_fields if f not in fl)
+        elif cursor is not None:
+            raise SearchError('A cursor can only be used with a sort')
+
+        if fl is not None:
+            params['fl'] = ','.join(fl)
+
+        stats = self._state.search_stats
+        unique_docs = OrderedDict()
+        num_found = None
+        consumed = 0
+        last_doc = None
+        exhausted = False
+
+        for _ in xrange(MAX_SEARCH_ROUNDS):
+            # Later rounds also take into account the duplicates seen so far
+            docs_per_key = None
+            if unique_docs:
+                docs_per_key = float(consumed) / len(unique_docs)
+            params['rows'] = stats.overfetch(
+                rows - len(unique_docs), docs_per_key)
+            # Later rounds continue from the last result consumed
+            if sort_fields is not None and last_doc is not None:
+                cursor_values = sort_values(last_doc, sort_fields)
+            if cursor_values is not None:
+                params.pop('start', None)
+                params['filter'] = cursor_filter(sort_fields, cursor_values)
+            else:
+                params['start'] = start + consumed
+
+            solr_results = self._search(query, **params)
+            docs = solr_results['docs']
+            if num_found is None:
+                num_found = solr_results['num_found']
+
+            # Riak search will return multiple results for a given key if it
+            # has siblings, whereas we want unique results
+            round_consumed = 0
+            for doc in docs:
+                if doc['_yz_rk'] not in unique_docs:
+                    if len(unique_docs) == rows:
+                        break
+                    unique_docs[doc['_yz_rk']] = doc
+                round_consumed += 1
+                last_doc = doc
+            consumed += round_consumed
+
+            # Solr has no more results only if every one it returned was used
+            exhausted = (len(docs) < params['rows'] and
+                         round_consumed == len(docs))
+            if exhausted or len(unique_docs) == rows:
+                break
+
+        stats.record(consumed, len(unique_docs))
+
+        if fields is not None:
+            objects = [
+                SearchRow(key, doc, fields, self._state.model)
+                for key, doc in unique_docs.items()
+            ]
+        else:
+            fetched = self._multiget(list(unique_docs))
+            objects = []
+            for key in unique_docs:
+                if isinstance(fetched[key], Exception):
+                    raise fetched[key]
+                objects.append(self._state.model(key, fetched[key]))
+
+        next_cursor = None
+        if sort_fields is not None and not exhausted and last_doc is not None:
+            next_cursor = encode_cursor(
+                sort_values(last_doc, sort_fields))
+
+        return SearchResults(
+            objects, start, num_found, self._state.model, next_cursor,
+            start + consumed)
+
+    def count(self, query):
+        """
+        Count the objects matching a Solr query without retrieving them
+
+        :param str query: The Solr query text
+        :return: The number of matching objects
+        :rtype: int
+        """
+        return self._search(query, rows=0)['num_found']
+
+    def keys(self):
+        """
+        List every key in the model's bucket.  This traverses every key
+        stored in the cluster, so it is only suitable for small buckets and
+        tests.
+
+        :return: The keys
+        :rtype: list<str>
+        """
+        return self._instrumented(
+            'keys', self._state.bucket.get_keys,
+            measure=lambda r: (len(r), None, None, 'ok'))
+
+    def index_keys(self, index, startkey, endkey=None, max_results=None,
+                   continuation=None):
+        """
+        Query a secondary index for the keys of the objects whose index
+        value is startkey, or between startkey and endkey
+
+        :param str index: The name of the index, e.g. "email_bin"
+        :param startkey: The value, or the start of the range of values
+        :param endkey: The end of the range of values, inclusive
+        :param int max_results: The most keys to return
+        :param str continuation: The continuation of the previous page
+        :return: A page of keys, with the continuation of the next page (if
+                 there may be one) as its "continuation" attribute
+        :rtype: IndexPage
+        """
+        return self._instrumented(
+            'index', lambda: self._state.bucket.get_index(
+                index, startkey, endkey, max_results=max_results,
+                continuation=continuation),
+            measure=lambda r: (len(r.results), None, None, 'ok'))
+
+    def search_iter(self, query, page_size=100, concurrency=None):
+        """
+        Lazily iterate over every object matching a Solr query.  Pages of
+        results are fetched as they are needed, and the next page (both the
+        Solr query and the multiget) is fetched in the background while the
+        current one is being consumed, so at most two pages are held in
+        memory at once.
+
+        Objects are returned in key order, and each object is returned only
+        once, regardless of whether it has siblings.  Objects that are
+        indexed but no longer stored in Riak are skipped.
+
+        :param str query: The Solr query text
+        :param int page_size: The number of Solr results to fetch at a time
+        :param int concurrency: The number of simultaneous fetches, defaults
+                                to the Riak client's multiget pool size
+        :return: A generator of Model instances
+        """
+        pages = self._iter_search_pages(query, page_size)
+
+        def fetch_page():
+            keys = next(pages, None)
+            if keys is None:
+                return None
+            return self.get_many(keys, concurrency=concurrency)
+
+        pending = BackgroundTask(fetch_page)
+        while True:
+            results = pending.result()
+            if results is None:
+                return
+
+            pending = BackgroundTask(fetch_page)
+
+            for error in results.errors.values():
+                if not isinstance(error, DoesNotExist):
+                    raise error
+
+            for instance in results:
+                yield instance
+
+    def _search(self, query, **params):
+        """
+        Central access point for querying the model's Solr index
+
+        :param str query: The Solr query text
+        :param params: Additional Solr parameters (start, rows, sort, fl...)
+        :return: The raw Solr results
+        :rtype: dict
         """
         bucket = self._state.bucket
         index = self._state.model._meta.index
 
         try:
-            solr_results = bucket.search(
-                query, index=index, start=start, rows=rows)
+            return self._instrumented(
+                'search', lambda: bucket.search(query, index=index, **params),
+                measure=lambda r: (len(r['docs']), None, None, 'ok'))
 
         except RiakError as e:
             if isinstance(e.value, basestring) and \
@@ -37,38 +319,158 @@ class QuerySet(object):
             else:
                 raise
 
-        # set() is needed here as Riak search will return multiple results for
-        # a given key if it has siblings, whereas we want unique results
-        keys = {r['_yz_rk'] for r in solr_results['docs']}
+    def _iter_search_pages(self, query, page_size):
+        """
+        Lazily yield the unique keys matching a query, one page at a time.
+        Rather than paging by offset, each page asks for the keys that sort
+        after the last key seen, so objects that are deleted or added while
+        the pages are being consumed do not cause others to be skipped.
+
+        :param str query: The Solr query text
+        :param int page_size: The number of Solr results to fetch at a time
+        :return: A generator of lists of keys
+        """
+        sort_fields = [('_yz_rk', 'asc')]
+        params = {
+            'rows': page_size,
+            'sort': format_sort(sort_fields),
+            'fl': '_yz_rk'
+        }
 
-        objects = [self._state.model(o.key, o) for o in bucket.multiget(keys)]
+        while True:
+            docs = self._search(query, **params)['docs']
 
-        return SearchResults(
-            objects, start, solr_results['num_found'], self._state.model)
+            # Siblings sort next to each other, so only the neighbouring
+            # key needs to be checked to remove duplicates
+            keys = []
+            for doc in docs:
+                if not keys or doc['_yz_rk'] != keys[-1]:
+                    keys.append(doc['_yz_rk'])
 
-    def _store(self, riak_object):
+            if keys:
+                yield keys
+
+            if len(docs) < page_size:
+                return
+
+            params['filter'] = cursor_filter(
+                sort_fields, [docs[-1]['_yz_rk']])
+
+    def _store(self, riak_object, if_none_match=False):
         """
         Central access point for writing to the Riak bucket
 
         :param RiakObject riak_object: The Riak object to be saved
+        :param bool if_none_match: Only store the object if nothing is stored
+                                   at its key yet
         :return: RiakObject
         """
         validator = self._state.model._meta.storage_validator
         if validator is not None:
-            validator(riak_object.data)
+            self._instrumented(
+                'validate_storage', lambda: validator(riak_object.data))
+
+        if if_none_match:
+            store = lambda: riak_object.store(if_none_match=True)
+        else:
+            store = riak_object.store
+        riak_object = self._instrumented(
+            'store', store,
+            measure=lambda r: (1, encoded_size(r), None, 'ok'))
+        self._cache_update(riak_object)
+        return riak_object
+
+    def _cache_lookup(self, key):
+        """
+        Look a key up in the model's caches
+
+        :param str key: The key to look up
+        :return: A tuple of (RiakObject, entry), the RiakObject is None unless
+                 it can be served from the cache, the entry is an expired
+                 entry in need of revalidation (if any)
+        :rtype: tuple
+        """
+        negative_cache = self._state.model._meta.negative_cache
+        if negative_cache is not None and negative_cache.get(key):
+            return self._state.bucket.new(key), None
+
+        cache = self._state.model._meta.cache
+        if cache is None:
+            return None, None
+
+        cached = cache.get(key, include_expired=cache.revalidate)
+        if cached is None:
+            return None, None
+
+        entry, expired = cached
+        if expired:
+            return None, entry
+
+        encoded_data, content_type, vclock = entry
+        riak_object = self._state.bucket.new(
+            key, content_type=content_type, encoded_data=encoded_data)
+        riak_object.vclock = vclock
+        riak_object.siblings[0].exists = True
+        return riak_object, None
 
-        return riak_object.store()
+    def _cache_update(self, riak_object, expired_entry=None):
+        """
+        Bring the model's caches up to date with an object that has been
+        fetched from/stored to Riak
 
-    def _active_get(self, instance, must_exist=True):
+        :param RiakObject riak_object: The current version of the object
+        :param tuple expired_entry: The expired cache entry for the object,
+                                    if it is being revalidated
+        """
+        negative_cache = self._state.model._meta.negative_cache
+        if negative_cache is not None:
+            if riak_object.exists:
+                negative_cache.invalidate(riak_object.key)
+            else:
+                negative_cache.set(riak_object.key, True)
+
+        cache = self._state.model._meta.cache
+        if cache is None:
+            return
+
+        if not riak_object.exists or len(riak_object.siblings) != 1:
+            cache.invalidate(riak_object.key)
+            return
+
+        if expired_entry is not None and \
+                same_vclock(expired_entry[2], riak_object.vclock):
+            cache.touch(riak_object.key)
+            return
+
+        encoder = self._state.bucket.get_encoder(riak_object.content_type)
+        if encoder is None:
+            cache.invalidate(riak_object.key)
+            return
+
+        encoded_data = encoder(riak_object.data)
+        cache.set(
+            riak_object.key,
+            (encoded_data, riak_object.content_type, riak_object.vclock),
+            len(encoded_data)
+        )
+
+    def _active_get(self, instance, must_exist=True, lazy=False):
         """
         Fill the instance with riak_object data
 
         :param Model instance: An instance of the Model class
         :param bool must_exist: True if a missing object should be an error,
                                 default is True
+        :param bool lazy: True if the data is being loaded on first access,
+                          rather than asked for, default is False
         """
-        bucket = self._state.bucket
-        instance._state.riak_object = bucket.get(instance._state.key)
+        riak_object, expired_entry = self._cache_lookup(instance._state.key)
+        if riak_object is None:
+            if lazy:
+                for tracker in current_trackers():
+                    tracker.lazy_load(self._state.model.__name__)
+            riak_object = self._fetch(instance._state.key, expired_entry)
+        instance._state.riak_object = riak_object
 
         if must_exist and not instance._state.riak_object.exists:
             raise DoesNotExist('{} "{}" does not exist!'.format(
@@ -76,6 +478,192 @@ class QuerySet(object):
                 instance._state.key
             ))
 
+    def _share(self, riak_object):
+        """
+        Prepare a RiakObject fetched by another caller for use by this one
+
+        :param RiakObject riak_object: The object fetched by the other caller
+        :return: The object itself, or an independent copy of it if the model
+                 is configured to copy coalesced fetches
+        :rtype: RiakObject
+        """
+        if not self._state.model._meta.copy_coalesced_fetches:
+            return riak_object
+
+        copy = self._state.bucket.new(
+            riak_object.key,
+            data=deepcopy(riak_object.data),
+            content_type=riak_object.content_type
+        )
+        copy.vclock = riak_object.vclock
+        copy.siblings[0].exists = riak_object.exists
+        return copy
+
+    def _fetch(self, key, expired_entry=None):
+        """
+        Central access point for fetching a single key from the Riak bucket.
+        If the model coalesces fetches, callers asking for a key that is
+        already being fetched wait for and share that fetch.
+
+        :param str key: The key to fetch
+        :param tuple expired_entry: The expired cache entry for the key, if
+                                    it is being revalidated
+        :return: The fetched object
+        :rtype: RiakObject
+        """
+        def fetch():
+            riak_object = self._instrumented(
+                'get', lambda: self._state.bucket.get(key),
+                measure=measure_object)
+            self._cache_update(riak_object, expired_entry)
+            return riak_object
+
+        if not self._state.model._meta.coalesce_fetches:
+            return fetch()
+
+        riak_object, shared = self._state.single_flight.do(key, fetch)
+        if shared:
+            return self._share(riak_object)
+        return riak_object
+
+    def _multiget(self, keys, concurrency=None):
+        """
+        Central access point for fetching several keys from the Riak bucket
+
+        :param list keys: The keys to fetch, must not contain duplicates
+        :param int concurrency: If provided, fetch the keys using this many
+                                drow worker threads instead of the Riak
+                                client's multiget pool
+        :return: A dict mapping every key to either its RiakObject or the
+                 exception raised while fetching it
+        :rtype: dict
+        """
+        bucket = self._state.bucket
+        fetched = {}
+
+        session = current_session()
+        if session is not None:
+            for key in keys:
+                riak_object = session.loaded(self._state.model, key)
+                if riak_object:
+                    fetched[key] = riak_object
+            keys = [k for k in keys if k not in fetched]
+
+        expired_entries = {}
+        missed = []
+        for key in keys:
+            riak_object, expired_entry = self._cache_lookup(key)
+            if riak_object is not None:
+                fetched[key] = riak_object
+            else:
+                expired_entries[key] = expired_entry
+                missed.append(key)
+
+        if not missed:
+            return fetched
+
+        if concurrency is not None:
+            results = run_concurrently(
+                lambda k: self._fetch(k, expired_entries[k]),
+                missed,
+                concurrency
+            )
+            for key, (riak_object, error) in zip(missed, results):
+                fetched[key] = riak_object if error is None else error
+            return fetched
+
+        # Only fetch the keys nobody else is already fetching, the rest are
+        # shared once the other callers are done
+        single_flight = self._state.single_flight
+        coalesce = self._state.model._meta.coalesce_fetches
+        calls = {}
+        leaders = missed
+        if coalesce:
+            leaders = []
+            for key in missed:
+                calls[key], leader = single_flight.claim(key)
+                if leader:
+                    leaders.append(key)
+
+        # Keys left without a result when the fetch fails get its error
+        failure = RiakError('No result returned for key')
+        try:
+            if leaders:
+                results = self._instrumented(
+                    'multiget', lambda: bucket.multiget(leaders),
+                    len(leaders), measure_objects)
+                for result in results:
+                    # Riak reports failed fetches as a tuple of
+                    # (bucket_type, bucket, key, exception)
+                    if isinstance(result, tuple):
+                        fetched[result[2]] = result[3]
+                    else:
+                        fetched[result.key] = result
+
+            for key in leaders:
+                if key not in fetched:
+                    fetched[key] = failure
+                elif not isinstance(fetched[key], Exception):
+                    self._cache_update(fetched[key], expired_entries[key])
+        except BaseException as e:
+            failure = e
+            raise
+        finally:
+            # Whatever happened, the callers waiting on these keys must be
+            # released, or they would wait forever
+            if coalesce:
+                for key in leaders:
+                    result = fetched.get(key, failure)
+                    if isinstance(result, BaseException):
+                        single_flight.finish(key, calls[key], error=result)
+                    else:
+                        single_flight.finish(key, calls[key], result)
+
+        for key in missed:
+            if key not in fetched:
+                try:
+                    fetched[key] = self._share(calls[key].wait())
+                except Exception as e:
+                    fetched[key] = e
+
+        return fetched
+
+    def get_many(self, keys, must_exist=True, concurrency=None):
+        """
+        Retrieve several objects from the database using a single multiget.
+        A failure to fetch any one key does not prevent the others from being
+        returned; failures are reported in the ``errors`` member of the
+        results.
+
+        :param list keys: The database keys to retrieve.  Duplicate keys are
+                          only fetched (and returned) once
+        :param bool must_exist: True if a missing object should be reported
+                                as a DoesNotExist error, otherwise an empty
+                                instance is returned for it. Default is True
+        :param int concurrency: The number of simultaneous fetches, defaults
+                                to the Riak client's multiget pool size
+        :return: The retrieved objects, in the order their keys were given
+        :rtype: BulkResults<Model>
+        """
+        unique_keys = list(OrderedDict.fromkeys(keys))
+        fetched = self._multiget(unique_keys, concurrency)
+
+        objects = []
+        errors = OrderedDict()
+        for key in unique_keys:
+            riak_object = fetched[key]
+            if isinstance(riak_object, Exception):
+                errors[key] = riak_object
+            elif must_exist and not riak_object.exists:
+                errors[key] = DoesNotExist('{} "{}" does not exist!'.format(
+                    self._state.model.__name__,
+                    key
+                ))
+            else:
+                objects.append(self._state.model(key, riak_object))
+
+        return BulkResults(objects, errors, self._state.model)
+
     def get(self, key, active=False, must_exist=True):
         """
         Retrieve an object from the database
@@ -90,120 +678,618 @@ class QuerySet(object):
         instance = self._state.model(key)
 
         if active:
-            self._active_get(instance, must_exist)
+            if not instance._state.riak_object:
+                self._active_get(instance, must_exist)
+            elif must_exist and not instance._state.riak_object.exists:
+                raise DoesNotExist('{} "{}" does not exist!'.format(
+                    self._state.model.__name__, key))
 
         return instance
 
-    def create(self, data):
+    def _validate_creation(self, data):
         """
-        Create/store an instance of Model with the given data, relying on
-        Riak to provide the object's key
+        Run the model's creation validator, if any, against the given data
 
-        :param data: The data to be stored under the object
-        :return: A Model instance
-        :rtype: Model
+        :param data: The data provided to a creation method
         """
-        bucket = self._state.bucket
-
         creation_validator = self._state.model._meta.creation_validator
         if creation_validator is not None:
-            creation_validator(data)
+            self._instrumented(
+                'validate_creation', lambda: creation_validator(data))
 
-        fields = self._state.model._meta.fields
-        for field_name in fields:
-            data[field_name] = fields[field_name].new_value(
-                'create', data.get(field_name, None))
+    def _timestamp(self, *operations):
+        """
+        :param operations: The operations about to be applied
+        :return: A timestamp to share between every object the operations
+                 are applied to, or None if no field needs one
+        :rtype: str
+        """
+        plans = self._state.model._meta.field_plans
+        for operation in operations:
+            if plans[operation].needs_time:
+                return plans[operation].timestamp()
+        return None
 
-        riak_object = bucket.new(
+    def _new_riak_object(self, data, now=None):
+        """
+        Apply the creation field constraints to data and wrap it in a new,
+        unsaved, RiakObject whose key will be provided by Riak
+
+        :param data: The (already validated) data to be stored
+        :param str now: The timestamp of the operation, if it is shared
+        :return: A RiakObject ready to be stored
+        :rtype: RiakObject
+        """
+        self._state.model._meta.field_plans['create'].apply(data, now=now)
+
+        return self._state.bucket.new(
             data=data,
             content_type=self._state.model._meta.content_type
         )
 
+    def _store_many(self, riak_objects, concurrency=None):
+        """
+        Store several Riak objects using a bounded pool of worker threads
+
+        :param list riak_objects: The Riak objects to be saved
+        :param int concurrency: The maximum number of simultaneous stores,
+                                defaults to the model's concurrency setting
+        :return: A list of (RiakObject, exception) tuples, in order
+        :rtype: list<tuple>
+        """
+        if concurrency is None:
+            concurrency = self._state.model._meta.concurrency
+
+        return run_concurrently(self._store, riak_objects, concurrency)
+
+    def create(self, data):
+        """
+        Create/store an instance of Model with the given data, relying on
+        Riak to provide the object's key.  As the key is only known once the
+        object is stored, creates are never queued by a Session.
+
+        :param data: The data to be stored under the object
+        :return: A Model instance
+        :rtype: Model
+        """
+        self._validate_creation(data)
+
+        riak_object = self._new_riak_object(data)
+
         self._store(riak_object)
 
-        return self._state.model(riak_object.key, riak_object)
+        instance = self._state.model(riak_object.key, riak_object)
+        instance._remember_loaded()
+        return instance
+
+    def create_many(self, data_list, concurrency=None):
+        """
+        Create/store several instances of Model, relying on Riak to provide
+        the objects' keys.  All of the data is validated before anything is
+        stored, then the stores are run in parallel.  A failure for any one
+        object does not prevent the others from being stored.  Like create,
+        the stores are never queued by a Session.
+
+        :param list data_list: The data to be stored, one entry per object
+        :param int concurrency: The maximum number of simultaneous stores,
+                                defaults to the model's concurrency setting
+        :return: The created objects.  As no key exists for objects that
+                 could not be created, errors are keyed by the position of
+                 the offending data in data_list
+        :rtype: BulkResults<Model>
+        """
+        errors = {}
+        pending = []
+        for position, data in enumerate(data_list):
+            try:
+                self._validate_creation(data)
+            except Exception as e:
+                errors[position] = e
+            else:
+                pending.append((position, data))
+
+        riak_objects = []
+        positions = []
+        now = self._timestamp('create')
+        for position, data in pending:
+            try:
+                riak_objects.append(self._new_riak_object(data, now))
+            except Exception as e:
+                errors[position] = e
+            else:
+                positions.append(position)
+
+        stored = {}
+        results = self._store_many(riak_objects, concurrency)
+        for position, riak_object, (_, error) in \
+                zip(positions, riak_objects, results):
+            if error is not None:
+                errors[position] = error
+            else:
+                stored[position] = riak_object
+
+        objects = [
+            self._state.model(stored[p].key, stored[p]) for p in sorted(stored)
+        ]
+        for instance in objects:
+            instance._remember_loaded()
+        return BulkResults(
+            objects,
+            OrderedDict((p, errors[p]) for p in sorted(errors)),
+            self._state.model
+        )
 
     def patch(self, key, patch):
         """
         Apply the provided patch to the data stored at the given key
 
+        If the model has a write_behind buffer, the patch is only buffered,
+        to be applied along with the other patches made to the key shortly.
+
         :param str key: The key in Riak to be patched
-        :param patch: The patch obj to be applied (must have apply method)
-        :return: A Model instance
+        :param patch: A JsonPatch, or a list of JSON patch operations
+        :return: A Model instance, or None if the patch was buffered
         :rtype: Model
         """
+        write_behind = self._state.model._meta.write_behind
+        if write_behind is not None:
+            write_behind.add(key, patch)
+            return None
+
         instance = self.get(key, active=True)
+        self._patch_instance(instance, patch)
+        return instance
 
-        old_values = {}
-        fields = self._state.model._meta.fields
-        for field_name in self._state.model._meta.fields:
-            old_values[field_name] = instance.data.get(field_name, None)
-
-        validate_patch(patch, instance.data)
-        patch.apply(instance._state.riak_object.data, in_place=True)
-
-        # Enforce field constraints
-        for field_name in fields:
-            instance._state.riak_object.data[field_name] = \
-                fields[field_name].new_value(
-                    'patch',
-                    instance._state.riak_object.data.get(field_name, None),
-                    old_values[field_name]
-            )
+    def _apply_patches(self, key, patches):
+        """
+        Apply several patches to the data stored at the given key, in order,
+        with a single fetch and store.  A patch that cannot be applied is
+        skipped without affecting the others.
 
-        self._store(instance._state.riak_object)
-        return instance
+        :param str key: The key in Riak to be patched
+        :param list patches: The patch objs to be applied
+        :return: The exceptions raised by the patches that were skipped
+        :rtype: list<Exception>
+        """
+        instance = self.get(key, active=True)
+        data = instance.data
+        old_values = instance._field_values()
 
-    def put(self, key, data):
+        applied = 0
+        errors = []
+        for patch in patches:
+            # A patch that fails is undone by apply_patch
+            try:
+                data = apply_patch(patch, data)
+            except Exception as e:
+                errors.append(e)
+            else:
+                applied += 1
+        instance._state.riak_object.data = data
+
+        if not applied:
+            return errors
+
+        self._state.model._meta.field_plans['patch'].apply(data, old_values)
+
+        self._store_instance(instance, queue=False)
+        return errors
+
+    def _patch_instance(self, instance, patch, check_conflict=None):
         """
-        Update an existing object/create a new object at the specified key
+        Apply a patch to the data an instance has already loaded and store
+        it, without fetching the object again
 
-        :param str key: The key at which data will be stored
-        :param data: The data to be stored
-        :return: A Model instance
-        :rtype: Model
+        :param Model instance: An instance holding an existing RiakObject
+        :param patch: A JsonPatch, or a list of JSON patch operations
+        :param bool check_conflict: Refuse to store the object if it was
+                                    changed since it was loaded, defaults to
+                                    the model's check_conflicts setting
         """
-        instance = self.get(key, active=True, must_exist=False)
+        old_values = instance._field_values()
+        data = apply_patch(patch, instance.data)
+        instance._state.riak_object.data = data
 
-        creation_validator = self._state.model._meta.creation_validator
+        self._state.model._meta.field_plans['patch'].apply(data, old_values)
 
-        if creation_validator is not None:
-            creation_validator(data)
+        self._store_instance(instance, check_conflict)
 
+    def _save_instance(self, instance, check_conflict=None):
+        """
+        Store the data an instance has already loaded (and possibly
+        modified), without fetching the object again
+
+        :param Model instance: An instance holding a RiakObject (which need
+                               not exist)
+        :param bool check_conflict: Refuse to store the object if it was
+                                    changed since it was loaded, defaults to
+                                    the model's check_conflicts setting
+        """
+        riak_object = instance._state.riak_object
+        if riak_object.data is None:
+            instance.data = {}
+        data = instance.data
+        old_values = instance._field_values()
+
+        self._validate_creation(data)
+
+        method = 'put'
+        if not riak_object.exists:
+            method = 'create'
+            riak_object.content_type = self._state.model._meta.content_type
+
+        self._state.model._meta.field_plans[method].apply(data, old_values)
+
+        self._store_instance(instance, check_conflict)
+
+    def _store_instance(self, instance, check_conflict=None, queue=True):
+        """
+        Store the RiakObject held by an instance with the vclock it was
+        loaded with, optionally making sure nobody else has written to it
+        since.  Riak cannot make the check atomic for existing objects, so
+        it only narrows the window for a conflicting write down to the time
+        between the check and the store.
+
+        :param Model instance: An instance holding a RiakObject
+        :param bool check_conflict: Refuse to store the object if it was
+                                    changed since it was loaded, defaults to
+                                    the model's check_conflicts setting
+        :param bool queue: Queue the store until the open Session (if any)
+                           is flushed
+        :raises WriteConflict: If the object was changed since it was loaded
+        """
+        session = current_session()
+        if queue and session is not None:
+            session.store(instance, check_conflict)
+            return
+
+        if check_conflict is None:
+            check_conflict = self._state.model._meta.check_conflicts
+
+        riak_object = instance._state.riak_object
+        creating = not riak_object.exists
+        if check_conflict and not creating:
+            current = self._instrumented(
+                'get', lambda: self._state.bucket.get(riak_object.key),
+                measure=measure_object)
+            if not self._same_version(current, riak_object):
+                raise WriteConflict(
+                    '{} "{}" was changed since it was loaded'.format(
+                        self._state.model.__name__, instance.key))
+
+        try:
+            self._store(riak_object, if_none_match=check_conflict and creating)
+        except RiakError:
+            if not (check_conflict and creating):
+                raise
+            raise WriteConflict(
+                '{} "{}" was created since it was loaded'.format(
+                    self._state.model.__name__, instance.key))
+
+        instance._remember_loaded()
+
+    def _same_version(self, current, loaded):
+        """
+        :param RiakObject current: The object as it is currently stored
+        :param RiakObject loaded: The object as it was loaded
+        :return: True if nothing was written to the object since it was loaded
+        :rtype: bool
+        """
+        return same_vclock(current.vclock, loaded.vclock)
+
+    def _apply_put(self, instance, data, now=None):
+        """
+        Replace the data held by a fetched instance, enforcing the field
+        constraints against the values it previously held
+
+        :param Model instance: An instance holding the currently stored
+                               RiakObject (which need not exist)
+        :param data: The (already validated) data to be stored
+        :param str now: The timestamp of the operation, if it is shared
+        """
+        method = 'put'
         if not instance._state.riak_object.exists:
+            method = 'create'
             instance._state.riak_object.content_type = \
                 instance._meta.content_type
 
         if instance.data is None:
             instance.data = {}
-
-        old_values = {}
-        fields = self._state.model._meta.fields
-        for field_name in self._state.model._meta.fields:
-            old_values[field_name] = instance.data.get(field_name, None)
+        old_values = instance._field_values()
 
         instance._state.riak_object.data = data
+        instance._loaded()
 
-        # Enforce field constraints
-        method = 'put'
-        if not instance._state.riak_object.exists:
-            method = 'create'
-        for field_name in fields:
-            instance._state.riak_object.data[field_name] = \
-                fields[field_name].new_value(
-                    method, data.get(field_name, None), old_values[field_name])
+        self._state.model._meta.field_plans[method].apply(
+            data, old_values, now)
+
+    def _blind_riak_object(self, key, data, vclock=None, now=None):
+        """
+        Apply the put field constraints to data and wrap it in a new RiakObject
+        without first fetching the object stored at the key.  Only valid for
+        models whose fields do not depend on the values previously stored.
+
+        :param str key: The key at which data will be stored
+        :param data: The (already validated) data to be stored
+        :param VClock vclock: The vclock of the version being replaced, if
+                              known
+        :param str now: The timestamp of the operation, if it is shared
+        :return: A RiakObject ready to be stored
+        :rtype: RiakObject
+        """
+        self._state.model._meta.field_plans['put'].apply(data, now=now)
 
-        self._store(instance._state.riak_object)
+        riak_object = self._state.bucket.new(
+            key,
+            data=data,
+            content_type=self._state.model._meta.content_type
+        )
+        if vclock is not None:
+            riak_object.vclock = vclock
+        return riak_object
+
+    def _loaded_vclock(self, key):
+        """
+        :param str key: The key of an object
+        :return: The vclock of the object as already loaded by the open
+                 Session, or as held in the model's cache, if either has it
+        :rtype: VClock
+        """
+        session = current_session()
+        if session is not None:
+            riak_object = session.loaded(self._state.model, key)
+            if riak_object:
+                return riak_object.vclock
+
+        riak_object, _ = self._cache_lookup(key)
+        if riak_object is not None:
+            return riak_object.vclock
+        return None
+
+    def _puts_blind(self, vclock):
+        """
+        :param VClock vclock: The vclock of the version being replaced, if
+                              known
+        :return: True if a put can be written without fetching first
+        :rtype: bool
+        """
+        meta = self._state.model._meta
+        if meta.put_needs_read:
+            return False
+        return vclock is not None or meta.blind_puts
+
+    def _replacing_instance(self, key, riak_object):
+        """
+        Create an instance holding a RiakObject that replaces whatever is
+        stored at its key.  While a Session is open, the session's instance
+        for the key is made to hold it instead.
+
+        :param str key: The key of the instance
+        :param RiakObject riak_object: The replacement object
+        :return: A Model instance
+        :rtype: Model
+        """
+        instance = self._state.model(key, riak_object)
+        if instance._state.riak_object is not riak_object:
+            instance._state.riak_object = riak_object
+            instance._loaded()
         return instance
 
-    def delete(self, key):
+    def put(self, key, data, vclock=None):
+        """
+        Update an existing object/create a new object at the specified key
+
+        If none of the model's fields depend on the previously stored values
+        and the vclock of the version being replaced is known (it is given,
+        or the open Session or the cache has the object), the data is
+        written without first fetching the stored object.  Models with the
+        blind_puts option also skip the fetch when the vclock is unknown.
+
+        While a Session is open, the write is queued like a save of the
+        session's instance for the key, replacing any write already queued.
+
+        :param str key: The key at which data will be stored
+        :param data: The data to be stored
+        :param VClock vclock: The vclock of the version being replaced, only
+                              used if no fetch is needed
+        :return: A Model instance
+        :rtype: Model
+        """
+        if vclock is None and not self._state.model._meta.put_needs_read:
+            vclock = self._loaded_vclock(key)
+
+        if self._puts_blind(vclock):
+            self._validate_creation(data)
+            instance = self._replacing_instance(
+                key, self._blind_riak_object(key, data, vclock))
+        else:
+            instance = self.get(key, active=True, must_exist=False)
+
+            self._validate_creation(data)
+
+            self._apply_put(instance, data)
+
+        session = current_session()
+        if session is not None:
+            session.store(instance, check_conflict=False)
+        else:
+            self._store(instance._state.riak_object)
+            instance._remember_loaded()
+        return instance
+
+    def put_many(self, items, concurrency=None):
+        """
+        Update existing objects/create new objects at the specified keys.
+        All of the data is validated before anything is fetched, the
+        existing objects are then fetched with a single multiget (except
+        those that can be written without, see put) and the stores are run
+        in parallel.  A failure for any one key does not prevent the others
+        from being stored.  While a Session is open, the
+        stores are queued instead (see put), and their failures are raised
+        when the session is flushed.
+
+        :param items: A dict mapping keys to the data to be stored under
+                      them, or an iterable of (key, data) pairs
+        :param int concurrency: The maximum number of simultaneous fetches
+                                and stores.  Fetches default to the Riak
+                                client's multiget pool size, stores to the
+                                model's concurrency setting
+        :return: The stored objects, in the order their keys were given
+        :rtype: BulkResults<Model>
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        items = OrderedDict(items)
+
+        errors = {}
+        for key, data in items.items():
+            try:
+                self._validate_creation(data)
+            except Exception as e:
+                errors[key] = e
+
+        keys = [k for k in items if k not in errors]
+        vclocks = {}
+        if not self._state.model._meta.put_needs_read:
+            vclocks = dict((k, self._loaded_vclock(k)) for k in keys)
+        blind = set(k for k in keys if self._puts_blind(vclocks.get(k)))
+        fetched = {}
+        if len(blind) < len(keys):
+            fetched = self._multiget(
+                [k for k in keys if k not in blind], concurrency)
+
+        instances = []
+        now = self._timestamp('put', 'create')
+        for key in keys:
+            try:
+                if key in blind:
+                    instance = self._replacing_instance(
+                        key, self._blind_riak_object(
+                            key, items[key], vclocks[key], now))
+                else:
+                    if isinstance(fetched[key], Exception):
+                        raise fetched[key]
+                    instance = self._state.model(key, fetched[key])
+                    self._apply_put(instance, items[key], now)
+            except Exception as e:
+                errors[key] = e
+            else:
+                instances.append(instance)
+
+        session = current_session()
+        if session is not None:
+            for instance in instances:
+                session.store(instance, check_conflict=False)
+        else:
+            results = self._store_many(
+                [i._state.riak_object for i in instances], concurrency)
+            for instance, (_, error) in zip(instances, results):
+                if error is not None:
+                    errors[instance.key] = error
+                else:
+                    instance._remember_loaded()
+
+        return BulkResults(
+            [i for i in instances if i.key not in errors],
+            OrderedDict((k, errors[k]) for k in items if k in errors),
+            self._state.model
+        )
+
+    def delete(self, key, queue=True):
         """
         Delete an existing object from Riak
 
         :param str key: The key to delete
+        :param bool queue: Queue the delete until the open Session (if any)
+                           is flushed, in which case None is returned
         """
+        session = current_session()
+        if queue and session is not None:
+            session.delete(self, key)
+            return None
+
         bucket = self._state.bucket
-        return bucket.new(key).delete()
+        riak_object = self._instrumented(
+            'delete', lambda: bucket.new(key).delete())
+
+        cache = self._state.model._meta.cache
+        if cache is not None:
+            cache.invalidate(key)
+        negative_cache = self._state.model._meta.negative_cache
+        if negative_cache is not None:
+            negative_cache.set(key, True)
+        return riak_object
+
+    def delete_many(self, keys, concurrency=None):
+        """
+        Delete several existing objects from Riak in parallel.  A failure to
+        delete any one key does not prevent the others from being deleted.
+        While a Session is open, every delete is queued instead (see delete)
+        and lazy instances are returned for the keys; failures are raised
+        when the session is flushed.
+
+        :param list keys: The keys to delete
+        :param int concurrency: The maximum number of simultaneous deletes,
+                                defaults to the model's concurrency setting
+        :return: The deleted objects, in the order their keys were given
+        :rtype: BulkResults<Model>
+        """
+        if concurrency is None:
+            concurrency = self._state.model._meta.concurrency
+
+        keys = list(OrderedDict.fromkeys(keys))
+        session = current_session()
+        if session is not None:
+            for key in keys:
+                session.delete(self, key)
+            return BulkResults(
+                [self._state.model(key) for key in keys], OrderedDict(),
+                self._state.model)
+
+        results = run_concurrently(
+            lambda key: self.delete(key, queue=False), keys, concurrency)
+
+        objects = []
+        errors = OrderedDict()
+        for key, (riak_object, error) in zip(keys, results):
+            if error is not None:
+                errors[key] = error
+            else:
+                objects.append(self._state.model(key, riak_object))
+
+        return BulkResults(objects, errors, self._state.model)
+
+    def delete_where(self, query, page_size=100, concurrency=None):
+        """
+        Delete every object matching a Solr query.  Matching keys are
+        streamed from Solr and deleted a page at a time, so the full set of
+        matching keys is never held in memory.
+
+        :param str query: The Solr query text
+        :param int page_size: The number of keys to delete at a time
+        :param int concurrency: The maximum number of simultaneous deletes,
+                                defaults to the model's concurrency setting
+        :return: The number of objects deleted
+        :rtype: int
+        :raises BulkError: Once every page has been processed, if any of the
+                           deletes failed
+        """
+        deleted = 0
+        errors = OrderedDict()
+
+        for keys in self._iter_search_pages(query, page_size):
+            results = self.delete_many(keys, concurrency)
+            deleted += len(results)
+            errors.update(results.errors)
+
+        if errors:
+            raise BulkError(
+                '{} {} objects could not be deleted'.format(
+                    len(errors), self._state.model.__name__),
+                errors
+            )
+
+        return deleted
 
 
 class SearchResults(object):
@@ -212,17 +1298,27 @@ class SearchResults(object):
     the vital statistics and displays them in the Python shell with little
     work.
     """
-    def __init__(self, objects, start, num_found, model):
+    def __init__(self, objects, start, num_found, model, cursor=None,
+                 next_start=None):
         """
         :param list<Model> objects: The objects returned by the search
         :param int start: The index at which results began to return
-        :param int num_found: The total number of objects found in the list
+        :param int num_found: The total number of objects found in the list,
+                              for a page fetched by cursor this is the number
+                              of objects from the cursor onwards
         :param Type model: The Model class these instances belong to
+        :param str cursor: The cursor for the following page of results, if
+                           there may be one
+        :param int next_start: The start value for the following page of
+                               results, this may be more than start plus the
+                               number of results as siblings are skipped
         """
         self.objects = objects
         self.start = start
         self.num_found = num_found
         self.model = model
+        self.cursor = cursor
+        self.next_start = next_start
 
     def __iter__(self):
         """
@@ -258,6 +1354,154 @@ class SearchResults(object):
         )
 
 
+class SearchRow(object):
+    """
+    A lightweight, read-only, search result built from the values stored in
+    the Solr index rather than from the object stored in Riak.  Values are
+    accessed like a dict, though note that Solr returns values as strings
+    (or lists of strings for multi-valued fields).
+    """
+    __slots__ = ('key', 'model', '_values')
+
+    def __init__(self, key, doc, fields, model):
+        """
+        :param str key: The object's Riak key
+        :param dict doc: The Solr document returned by the search
+        :param list<str> fields: The fields to keep from the document
+        :param Type model: The Model class this row belongs to
+        """
+        self.key = key
+        self.model = model
+        self._values = dict((f, doc[f]) for f in fields if f in doc)
+
+    def __getitem__(self, field):
+        return self._values[field]
+
+    def __contains__(self, field):
+        return field in self._values
+
+    def __iter__(self):
+        return self._values.__iter__()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, field, default=None):
+        return self._values.get(field, default)
+
+    def keys(self):
+        return self._values.keys()
+
+    def items(self):
+        return self._values.items()
+
+    def __repr__(self):
+        """
+        Display rows by class name and key, like Model instances
+        """
+        try:
+            u = unicode(self.key)
+        except UnicodeDecodeError:
+            u = '[BAD UNICODE]'
+        return u'<{} row: {}>'.format(self.model.__name__, u).encode('utf-8')
+
+
+class BulkResults(object):
+    """
+    Wraps the results of an operation on many objects at once.  Successful
+    results are kept in order, failures are collected by key so that one bad
+    object does not hide the outcome of the others.
+    """
+    def __init__(self, objects, errors, model):
+        """
+        :param list<Model> objects: The objects successfully processed
+        :param OrderedDict errors: Maps the key of each failed object (or its
+                                   position, for bulk creation) to the
+                                   exception it raised
+        :param Type model: The Model class these instances belong to
+        """
+        self.objects = objects
+        self.errors = errors
+        self.model = model
+
+    def as_dict(self):
+        """
+        Index the successful results by key
+
+        :return: The objects keyed by their Riak key, in order
+        :rtype: OrderedDict
+        """
+        return OrderedDict((o.key, o) for o in self.objects)
+
+    def __iter__(self):
+        """
+        Allow the user to iterate over the successful results
+        """
+        return self.objects.__iter__()
+
+    def __getitem__(self, key):
+        """
+        Allow the user to index the results list directly from this class
+        """
+        return self.objects[key]
+
+    def __len__(self):
+        """
+        The length is the number of successful results
+        """
+        return len(self.objects)
+
+    def __repr__(self):
+        """
+        Customize the display of this object in the Python shell
+        """
+        list_repr = repr(self.objects)
+        if len(list_repr) > 100:
+            list_repr = list_repr[:96] + '...]'
+        return '<{} Bulk [{} ok/{} failed]: {}>'.format(
+            self.model.__name__,
+            len(self.objects),
+            len(self.errors),
+            list_repr
+        )
+
+
+class SearchStats(object):
+    """
+    Keeps a running estimate of how many Solr results are returned per unique
+    object (more than one when objects have siblings) so that searches can
+    request enough results to fill a page in a single query.
+    """
+    # weight given to the most recent search in the running average
+    SMOOTHING = 0.2
+
+    def __init__(self):
+        self.docs_per_key = 1.0
+        self._lock = Lock()
+
+    def overfetch(self, rows, docs_per_key=None):
+        """
+        :param int rows: The number of unique results wanted
+        :param float docs_per_key: The ratio to use rather than the running
+                                   estimate, if it is higher
+        :return: The number of Solr results to request
+        :rtype: int
+        """
+        factor = max(self.docs_per_key, docs_per_key)
+        return int(ceil(rows * min(factor, MAX_OVERFETCH)))
+
+    def record(self, docs, keys):
+        """
+        :param int docs: The number of Solr results consumed by a search
+        :param int keys: The number of unique keys they contained
+        """
+        if not keys:
+            return
+        with self._lock:
+            self.docs_per_key += \
+                self.SMOOTHING * (float(docs) / keys - self.docs_per_key)
+
+
 class QuerySetState(object):
     """
     Class that holds the instance state for a QuerySet object
@@ -265,41 +1509,131 @@ class QuerySetState(object):
     pass
 
 
-def validate_patch(patch, data):
+def same_vclock(a, b):
     """
-    We don't want to allow the "add" operation to replace existing elements
-    as this could clobber data that gets out of sync, clients should use the
-    "replace" operation to signify intent.
+    :param VClock a: A vector clock, or None
+    :param VClock b: A vector clock, or None
+    :return: True if both vector clocks are known and are identical
+    :rtype: bool
+    """
+    if a is None or b is None:
+        return False
+    return a.encode('binary') == b.encode('binary')
+
+
+def solr_quote(value):
+    """
+    Quote a value so that it is treated as a single term in a Solr query
+
+    :param str value: The value to quote
+    :return: The quoted value
+    :rtype: str
+    """
+    return u'"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
 
-    :param JsonPatch patch: The JsonPatch object to validate
-    :param data: The data the JsonPatch will be applied to
-    :raises InvalidPatch: If an "add" operation in the patch would clobber data
+
+def parse_sort(sort):
+    """
+    Split a Solr sort specification into its fields.  As a cursor must
+    identify exactly one position in the results, the object key is added
+    as a final tie breaker if it isn't already sorted on.
+
+    :param str sort: The Solr sort specification, e.g. "a desc, b asc"
+    :return: A list of (field, direction) tuples
+    :rtype: list<tuple>
+    :raises SearchError: If the sort specification is malformed
+    """
+    sort_fields = []
+    for clause in sort.split(','):
+        parts = clause.split()
+        if len(parts) != 2 or parts[1].lower() not in ('asc', 'desc'):
+            raise SearchError(u'Bad sort: {}'.format(sort))
+        sort_fields.append((parts[0], parts[1].lower()))
+
+    if '_yz_rk' not in [field for field, _ in sort_fields]:
+        sort_fields.append(('_yz_rk', 'asc'))
+
+    return sort_fields
+
+
+def format_sort(sort_fields):
+    """
+    :param list<tuple> sort_fields: A list of (field, direction) tuples
+    :return: The Solr sort specification
+    :rtype: str
+    """
+    return ', '.join('{} {}'.format(f, d) for f, d in sort_fields)
+
+
+def cursor_filter(sort_fields, values):
+    """
+    Build a Solr filter matching every result that sorts after the result
+    with the given sort values.
+
+    :param list<tuple> sort_fields: A list of (field, direction) tuples
+    :param list values: The sort values of the last result seen
+    :return: The Solr filter query
+    :rtype: unicode
+    """
+    clauses = []
+    for position, (field, direction) in enumerate(sort_fields):
+        terms = [
+            u'{}:{}'.format(f, solr_quote(v))
+            for (f, _), v in zip(sort_fields[:position], values)
+        ]
+        if direction == 'asc':
+            terms.append(u'{}:{{{} TO *]'.format(
+                field, solr_quote(values[position])))
+        else:
+            terms.append(u'{}:[* TO {}}}'.format(
+                field, solr_quote(values[position])))
+
+        if len(terms) == 1:
+            clauses.append(terms[0])
+        else:
+            clauses.append(u'({})'.format(u' AND '.join(terms)))
+
+    return u' OR '.join(clauses)
+
+
+def sort_values(doc, sort_fields):
+    """
+    :param dict doc: A Solr document
+    :param list<tuple> sort_fields: A list of (field, direction) tuples
+    :return: The document's values for each of the sort fields
+    :rtype: list
+    :raises SearchError: If the document is missing a sort field
     """
     try:
-        for action in patch:
-            if action['op'] != 'add':
-                continue
+        return [doc[field] for field, _ in sort_fields]
+    except KeyError as e:
+        raise SearchError(
+            u'Sort field {} must be stored in the index'.format(e.args[0]))
 
-            path = action['path'].split('/')[1:]
 
-            valid = False
-            ref = data
-            for entry in path:
-                unescaped_entry = entry.replace('~1', '/').replace('~0', '~')
-                try:
-                    ref = ref[unescaped_entry]
-                except (KeyError, IndexError):
-                    valid = True
-                    break
-
-            if not valid:
-                path = action['path']
-                if isinstance(path, unicode):
-                    path = path.encode('utf-8')
-
-                error_text = \
-                    'Cannot add a JSON key that already exists: {}'.format(
-                        path)
-                raise InvalidPatch(error_text)
-    except KeyError:
-        raise InvalidPatch('Missing required jsonpatch parameter')
+def encode_cursor(values):
+    """
+    :param list values: The sort values of the last result on a page
+    :return: An opaque cursor for the page that follows the result
+    :rtype: str
+    """
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor, sort_fields):
+    """
+    :param str cursor: A cursor created by encode_cursor
+    :param list<tuple> sort_fields: A list of (field, direction) tuples
+    :return: The sort values stored in the cursor
+    :rtype: list
+    :raises SearchError: If the cursor is invalid for the sort
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise SearchError(u'Bad cursor: {}'.format(cursor))
+
+    if not isinstance(values, list) or len(values) != len(sort_fields):
+        raise SearchError(u'Bad cursor: {}'.format(cursor))
+
+    return values
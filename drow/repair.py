@@ -0,0 +1,202 @@
+__author__ = 'max'
+
+import atexit
+from collections import OrderedDict
+from threading import Condition
+from threading import Lock
+from threading import Thread
+from time import time
+
+from pool import DEFAULT_CONCURRENCY
+from pool import run_concurrently
+
+
+class ReadRepair(object):
+    """
+    Writes objects back to Riak after their siblings were resolved on read,
+    so that later reads don't have to resolve the same siblings again.
+    Assign one (or True, for the defaults) to the "write_back_resolved"
+    option of a model's Meta class.
+
+    Each resolved object is stored in the background with the vector clock
+    it was read with.  A key is written back at most once every
+    ``min_interval`` seconds, resolutions of a key that is already waiting
+    to be written back replace the waiting one, and resolutions are dropped
+    while ``max_pending`` keys are waiting.
+    """
+    def __init__(self, min_interval=60.0, max_pending=1000,
+                 concurrency=DEFAULT_CONCURRENCY):
+        """
+        :param float min_interval: The fewest seconds between write backs of
+                                   the same key
+        :param int max_pending: The most keys waiting to be written back
+        :param int concurrency: The maximum number of keys written at once
+        """
+        self.min_interval = min_interval
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+
+        self.repairs = 0
+        self.skipped = 0
+
+        # Maps each key to the exception raised the last time it failed to
+        # be encoded or written back
+        self.errors = OrderedDict()
+
+        self._pending = OrderedDict()
+        self._repaired = {}
+        self._condition = Condition(Lock())
+        self._flush_lock = Lock()
+        self._thread = None
+        self._closed = False
+
+    def wrap(self, resolver):
+        """
+        :param function resolver: A sibling resolver
+        :return: A resolver that resolves siblings with the given resolver,
+                 then writes the resolved object back
+        :rtype: function
+        """
+        def resolve(riak_object):
+            resolver(riak_object)
+            self.add(riak_object)
+        return resolve
+
+    def add(self, riak_object):
+        """
+        Write a resolved object back, unless its key was written back too
+        recently
+
+        :param RiakObject riak_object: The object, with its siblings resolved
+        """
+        key = riak_object.key
+        if key is None or riak_object.vclock is None or \
+                len(riak_object.siblings) != 1:
+            return
+
+        # Models may share a ReadRepair, so keys are kept apart by bucket
+        ident = (riak_object.bucket, key)
+        with self._condition:
+            if not self._admit(ident, time()):
+                self.skipped += 1
+                return
+
+        # Encode now, so that changes the application goes on to make to
+        # the object's data aren't written back with it.  This happens
+        # during the read, which mustn't fail because of the write back.
+        resolution = riak_object.siblings[0]
+        try:
+            encoder = riak_object.bucket.get_encoder(resolution.content_type)
+            if encoder is None:
+                raise TypeError('No encoder for content type "{}"'.format(
+                    resolution.content_type))
+            entry = (riak_object.vclock, resolution,
+                     encoder(resolution.data))
+        except Exception as e:
+            self.errors[key] = e
+            return
+
+        with self._condition:
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.close)
+
+            self._pending[ident] = entry
+            self._condition.notify()
+
+    def _admit(self, key, now):
+        """
+        Decide whether a key may be written back, and if so count it as
+        written back from now.  Must be called holding the condition.
+
+        :param tuple key: The bucket and key
+        :param float now: The current time
+        :return: True if the key should be written back
+        :rtype: bool
+        """
+        if key in self._pending:
+            # Keep the later resolution, it has the later vector clock
+            return True
+        if len(self._pending) >= self.max_pending:
+            return False
+
+        last = self._repaired.get(key)
+        if last is not None and now - last < self.min_interval:
+            return False
+
+        if len(self._repaired) >= self.max_pending * 10:
+            cutoff = now - self.min_interval
+            for repaired_key, since in self._repaired.items():
+                if since < cutoff:
+                    del self._repaired[repaired_key]
+        self._repaired[key] = now
+        return True
+
+    def __len__(self):
+        """
+        :return: The number of keys waiting to be written back
+        :rtype: int
+        """
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Write back every waiting object now
+        """
+        with self._flush_lock:
+            with self._condition:
+                entries = self._pending.items()
+                self._pending.clear()
+
+            results = run_concurrently(
+                self._store, entries, self.concurrency)
+
+        for ((_, key), _), (_, error) in zip(entries, results):
+            if error is not None:
+                self.errors[key] = error
+            else:
+                self.repairs += 1
+                self.errors.pop(key, None)
+
+    def close(self):
+        """
+        Write back every waiting object and stop the background thread
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.flush()
+
+    @staticmethod
+    def _store(item):
+        """
+        Store a resolved object with the vector clock it was read with
+
+        :param tuple item: The bucket and key, and the vector clock,
+                           resolved sibling and encoded data to store
+        """
+        (bucket, key), (vclock, resolution, encoded_data) = item
+        riak_object = bucket.new(
+            key, content_type=resolution.content_type,
+            encoded_data=encoded_data)
+        riak_object.vclock = vclock
+        riak_object.usermeta = resolution.usermeta
+        riak_object.indexes = resolution.indexes
+        riak_object.links = resolution.links
+        riak_object.store(return_body=False)
+
+    def _run(self):
+        """
+        Write back objects as they are added, until closed
+        """
+        while True:
+            with self._condition:
+                while not self._pending:
+                    if self._closed:
+                        return
+                    self._condition.wait()
+                if self._closed:
+                    return
+            self.flush()
@@ -0,0 +1,229 @@
+__author__ = 'max'
+
+import json
+from threading import Lock
+from time import time
+
+# How deeply nested the data of siblings may be before they are resolved by
+# keeping the most recent sibling rather than merging them
+DEFAULT_MAX_DEPTH = 64
+
+# The most encoded bytes the siblings of an object may add up to before they
+# are resolved by keeping the most recent sibling rather than merging them
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+
+_SCALARS = (int, long, float, bool, type(None))
+
+
+class TooDeep(Exception):
+    pass
+
+
+def fingerprint(value):
+    """
+    Reduce a JSON value to something hashable, so that equal values (lists
+    and dictionaries included) can be deduplicated with a set
+
+    :param value: A decoded JSON value
+    :return: A hashable value that is only equal for equal JSON values
+    """
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, _SCALARS):
+        # Keep True and 1 apart
+        return type(value), value
+    return json.dumps(value, sort_keys=True, default=repr)
+
+
+class ResolverStats(object):
+    """
+    Thread-safe counters describing the sibling resolutions done for a model
+    """
+    def __init__(self):
+        self.resolutions = 0
+        self.siblings = 0
+        self.max_siblings = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+        self.max_bytes = 0
+        self.fallbacks = 0
+        self._lock = Lock()
+
+    def record(self, siblings, seconds, size, fallback=False):
+        """
+        Count a resolution
+
+        :param int siblings: The number of siblings resolved
+        :param float seconds: The time the resolution took
+        :param int size: The encoded size of the siblings, in bytes
+        :param bool fallback: True if the most recent sibling was kept
+                              rather than merging the siblings
+        """
+        with self._lock:
+            self.resolutions += 1
+            self.siblings += siblings
+            self.max_siblings = max(self.max_siblings, siblings)
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.bytes += size
+            self.max_bytes = max(self.max_bytes, size)
+            if fallback:
+                self.fallbacks += 1
+
+    def as_dict(self):
+        """
+        :return: A snapshot of the counters, by name
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'resolutions': self.resolutions,
+                'siblings': self.siblings,
+                'max_siblings': self.max_siblings,
+                'seconds': self.seconds,
+                'max_seconds': self.max_seconds,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'fallbacks': self.fallbacks
+            }
+
+
+class JsonResolver(object):
+    """
+    A Riak sibling resolver that merges JSON documents with the following
+    logic:
+
+        1) For any value other than a dictionary, the most recent version
+           of that value wins.
+        2) For dictionaries, all keys will be merged.  In the case of key
+           conflicts, rule (1) will apply for non-dictionary values.  For
+           dictionary values, rule (2) will be recursively applied.
+
+    If as_set is True, lists are also merged, as the union of their items
+    (deduplicated by value, so lists of dictionaries work too).
+
+    All siblings are merged in a single pass over the documents.  If the
+    siblings are nested more deeply than max_depth, or are larger than
+    max_bytes altogether, the most recent sibling is kept instead.
+    """
+    def __init__(self, as_set=False, max_depth=DEFAULT_MAX_DEPTH,
+                 max_bytes=DEFAULT_MAX_BYTES, stats=None):
+        """
+        :param bool as_set: Merge lists as sets
+        :param int max_depth: The deepest nesting that will be merged
+        :param int max_bytes: The largest total encoded size of the siblings
+                              that will be merged, None for no limit
+        :param ResolverStats stats: Where to record resolutions, if anywhere
+        """
+        self.as_set = as_set
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.stats = stats
+
+    def with_stats(self, stats):
+        """
+        :param ResolverStats stats: Where to record resolutions
+        :return: A resolver merging the same way, recording to stats
+        :rtype: JsonResolver
+        """
+        return JsonResolver(self.as_set, self.max_depth, self.max_bytes, stats)
+
+    def __call__(self, riak_object):
+        """
+        Resolve the siblings of a Riak object down to one
+
+        :param RiakObject riak_object: The Riak object to resolve
+        """
+        start = time()
+        oldest_version_first = sorted(
+            riak_object.siblings, key=lambda s: s.last_modified)
+
+        # Measure the raw values, the encoded_data property would re-encode
+        # any sibling that was already decoded
+        size = 0
+        for sibling in oldest_version_first:
+            encoded_data = getattr(sibling, '_encoded_data', None)
+            if isinstance(encoded_data, basestring):
+                size += len(encoded_data)
+
+        fallback = self.max_bytes is not None and size > self.max_bytes
+        if not fallback:
+            try:
+                merged = self.merge([s.data for s in oldest_version_first])
+            except TooDeep:
+                fallback = True
+
+        if fallback:
+            riak_object.siblings = [oldest_version_first[-1]]
+        else:
+            # The merged data may share parts of every sibling's data, so it
+            # is set on the oldest sibling only once it has been read from
+            resolution = oldest_version_first[0]
+            resolution.data = merged
+            riak_object.siblings = [resolution]
+
+        if self.stats is not None:
+            self.stats.record(
+                len(oldest_version_first), time() - start, size, fallback)
+
+    def merge(self, values, depth=0):
+        """
+        Merge several versions of a value
+
+        :param list values: The versions, oldest first
+        :param int depth: How deeply the values are nested in the document
+        :return: The merged value
+        :raises TooDeep: If the values are nested more deeply than max_depth
+        """
+        newest = values[-1]
+        if isinstance(newest, dict):
+            kind = dict
+        elif self.as_set and isinstance(newest, list):
+            kind = list
+        else:
+            return newest
+
+        # Only the most recent run of mergeable versions counts, anything
+        # older was replaced by the first version of the run
+        start = len(values) - 1
+        while start > 0 and isinstance(values[start - 1], kind):
+            start -= 1
+        if start == len(values) - 1:
+            return newest
+
+        if depth >= self.max_depth:
+            raise TooDeep()
+
+        if kind is list:
+            seen = set()
+            merged = []
+            for value in values[start:]:
+                for item in value:
+                    item_fingerprint = fingerprint(item)
+                    if item_fingerprint not in seen:
+                        seen.add(item_fingerprint)
+                        merged.append(item)
+            return merged
+
+        versions = {}
+        for value in values[start:]:
+            for key, item in value.iteritems():
+                key_versions = versions.get(key)
+                if key_versions is None:
+                    versions[key] = [item]
+                else:
+                    key_versions.append(item)
+
+        merged = {}
+        for key, key_versions in versions.iteritems():
+            if len(key_versions) == 1:
+                merged[key] = key_versions[0]
+            else:
+                merged[key] = self.merge(key_versions, depth + 1)
+        return merged
+
+
+resolve_json = JsonResolver()
+
+resolve_json_as_set = JsonResolver(as_set=True)
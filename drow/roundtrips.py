@@ -0,0 +1,185 @@
+__author__ = 'max'
+
+import os
+import traceback
+from collections import OrderedDict
+from functools import wraps
+from threading import local
+
+from errors import BudgetExceeded
+
+# The operations (see metrics.Event) that make a request to Riak
+ROUND_TRIPS = frozenset(
+    ['get', 'multiget', 'store', 'delete', 'search', 'keys', 'index'])
+
+# Frames in drow's own modules are left out of call sites
+_PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+_trackers = local()
+
+
+def current_trackers():
+    """
+    :return: The trackers open on this thread, outermost first
+    :rtype: list
+    """
+    return getattr(_trackers, 'stack', None) or ()
+
+
+def call_site(depth):
+    """
+    :param int depth: The number of frames to include
+    :return: The innermost frames of the current stack outside of drow, as
+             "file:line in function" strings, outermost first
+    :rtype: tuple
+    """
+    frames = []
+    for filename, line, function, _ in reversed(traceback.extract_stack()):
+        directory = os.path.dirname(os.path.abspath(filename))
+        if directory == _PACKAGE_DIRECTORY:
+            continue
+        frames.append('{}:{} in {}'.format(filename, line, function))
+        if len(frames) == depth:
+            break
+    return tuple(reversed(frames))
+
+
+class RoundTripTracker(object):
+    """
+    Counts the requests made to Riak on a thread while it is open, by
+    operation, and the lazy loads of instances' data by call site.  When the
+    same call site lazily loads several instances one at a time (typically
+    by reading ``.data`` in a loop), it is flagged as an N+1 pattern: the
+    instances should have been fetched together with ``get_many``.
+
+    Trackers can be nested; every tracker open on the thread counts the
+    requests.  Requests made on other threads, such as by ``aobjects`` or
+    the prefetching of ``search_iter``, are not counted.
+    """
+    def __init__(self, budget=None, n_plus_one_threshold=2,
+                 raise_on_n_plus_one=False, stack_depth=3):
+        """
+        :param budget: The most requests allowed, either in total (an int)
+                       or per operation (a dict mapping operations to ints),
+                       None for no limit
+        :param int n_plus_one_threshold: The number of lazy loads from one
+                                         call site flagged as an N+1 pattern
+        :param bool raise_on_n_plus_one: Raise BudgetExceeded rather than
+                                         make the lazy load completing an
+                                         N+1 pattern
+        :param int stack_depth: The number of frames kept of each call site
+        """
+        self.budget = budget
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.raise_on_n_plus_one = raise_on_n_plus_one
+        self.stack_depth = stack_depth
+        self.counts = {}
+        self.total = 0
+        self._lazy_loads = OrderedDict()
+
+    def __enter__(self):
+        """
+        Open the tracker on the current thread
+        """
+        if getattr(_trackers, 'stack', None) is None:
+            _trackers.stack = []
+        _trackers.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Close the tracker
+        """
+        _trackers.stack.remove(self)
+        return False
+
+    def round_trip(self, model, operation):
+        """
+        Count a request about to be made to Riak
+
+        :param str model: The name of the model making it
+        :param str operation: The kind of request, see ROUND_TRIPS
+        :raises BudgetExceeded: If the request would exceed the budget
+        """
+        count = self.counts[operation] = self.counts.get(operation, 0) + 1
+        self.total += 1
+
+        if isinstance(self.budget, dict):
+            limit = self.budget.get(operation)
+            kind = operation + ' '
+        else:
+            limit = self.budget
+            count = self.total
+            kind = ''
+        if limit is not None and count > limit:
+            raise BudgetExceeded(
+                '{} {} would exceed the budget of {} {}requests\n{}'.format(
+                    model, operation, limit, kind, self.report()), self)
+
+    def lazy_load(self, model):
+        """
+        Count an instance's data being fetched on first access
+
+        :param str model: The name of the instance's model
+        :raises BudgetExceeded: If the load completes an N+1 pattern and the
+                                tracker is set to raise
+        """
+        site = (model, call_site(self.stack_depth))
+        count = self._lazy_loads[site] = self._lazy_loads.get(site, 0) + 1
+        if self.raise_on_n_plus_one and count == self.n_plus_one_threshold:
+            raise BudgetExceeded('{} lazy loads of {} from one call site\n'
+                                 '{}'.format(count, model, self.report()),
+                                 self)
+
+    @property
+    def n_plus_one(self):
+        """
+        :return: The call sites flagged as N+1 patterns, as (model, call
+                 site, number of lazy loads) tuples, where the call site is
+                 a tuple of "file:line in function" strings
+        :rtype: list
+        """
+        return [
+            (model, site, count)
+            for (model, site), count in self._lazy_loads.iteritems()
+            if count >= self.n_plus_one_threshold
+        ]
+
+    def report(self):
+        """
+        :return: A description of the requests counted and the N+1 patterns
+                 found, for logging
+        :rtype: str
+        """
+        lines = ['{} Riak requests: {}'.format(self.total, ', '.join(
+            '{} {}'.format(count, operation)
+            for operation, count in sorted(self.counts.iteritems())))]
+        for model, site, count in self.n_plus_one:
+            lines.append('N+1: {} lazy loads of {} from'.format(count, model))
+            lines.extend('    ' + frame for frame in site)
+        return '\n'.join(lines)
+
+
+def track_round_trips(on_exit=None, **options):
+    """
+    Decorate a function (e.g. a request handler) so that every call of it is
+    tracked by its own RoundTripTracker
+
+    :param function on_exit: Given the tracker once each call returns or
+                             raises, e.g. to log its report
+    :param options: Passed on to RoundTripTracker
+    :return: The decorator
+    :rtype: function
+    """
+    def decorator(function):
+        @wraps(function)
+        def tracked(*args, **kwargs):
+            tracker = RoundTripTracker(**options)
+            try:
+                with tracker:
+                    return function(*args, **kwargs)
+            finally:
+                if on_exit is not None:
+                    on_exit(tracker)
+        return tracked
+    return decorator
@@ -0,0 +1,142 @@
+__author__ = 'max'
+
+from collections import OrderedDict
+from threading import local
+
+from errors import BulkError
+from pool import DEFAULT_CONCURRENCY
+from pool import run_concurrently
+
+_sessions = local()
+
+
+def current_session():
+    """
+    :return: The innermost session open on this thread, if any
+    :rtype: Session
+    """
+    stack = getattr(_sessions, 'stack', None)
+    if not stack:
+        return None
+    return stack[-1]
+
+
+class Session(object):
+    """
+    A unit of work.  While a session is open on a thread, every model
+    instance it creates for a key is the same instance (so each object is
+    fetched at most once), and saves, patches, puts and deletes are queued
+    rather than written.  When the session is closed, the queued writes are
+    flushed all at once, in parallel.  Creates are written right away, as
+    Riak only provides their keys once they are stored.
+    """
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        """
+        :param int concurrency: The maximum number of simultaneous writes
+                                made when flushing
+        """
+        self.concurrency = concurrency
+        self._instances = {}
+        self._pending = OrderedDict()
+
+    def __enter__(self):
+        """
+        Open the session on the current thread
+        """
+        if getattr(_sessions, 'stack', None) is None:
+            _sessions.stack = []
+        _sessions.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Close the session, flushing the queued writes unless an exception is
+        being raised, in which case they are discarded
+        """
+        _sessions.stack.remove(self)
+        if exc_type is None:
+            self.flush()
+        else:
+            self._pending.clear()
+        return False
+
+    def instance(self, model, key, riak_object=None):
+        """
+        Look up the session's instance for a key, creating it if need be
+
+        :param Type model: The Model class of the instance
+        :param str key: The key of the instance
+        :param RiakObject riak_object: The fetched object, used if the
+                                       session's instance hasn't been loaded
+        :return: The session's instance for the key
+        :rtype: Model
+        """
+        instance = self._instances.get((model, key))
+        if instance is None:
+            # Bypass the model's metaclass, which would come back here
+            instance = self._instances[(model, key)] = \
+                type.__call__(model, key, riak_object)
+        elif riak_object is not None and not instance._state.riak_object:
+            instance._state.riak_object = riak_object
+        return instance
+
+    def loaded(self, model, key):
+        """
+        :param Type model: The Model class of the instance
+        :param str key: The key of the instance
+        :return: The RiakObject already loaded by the session's instance for
+                 the key, if any
+        :rtype: RiakObject
+        """
+        instance = self._instances.get((model, key))
+        if instance is None:
+            return None
+        return instance._state.riak_object
+
+    def store(self, instance, check_conflict=None):
+        """
+        Queue an instance to be stored when the session is flushed, replacing
+        any write already queued for its key
+
+        :param Model instance: The instance to store
+        :param bool check_conflict: Passed on to the store
+        """
+        write_key = (type(instance), instance.key)
+        self._pending.pop(write_key, None)
+        self._pending[write_key] = (
+            lambda: instance._state.objects._store_instance(
+                instance, check_conflict, queue=False))
+
+    def delete(self, queryset, key):
+        """
+        Queue a key to be deleted when the session is flushed, replacing any
+        write already queued for it
+
+        :param QuerySet queryset: The QuerySet of the key's model
+        :param str key: The key to delete
+        """
+        write_key = (queryset._state.model, key)
+        self._pending.pop(write_key, None)
+        self._pending[write_key] = \
+            lambda: queryset.delete(key, queue=False)
+
+    def flush(self):
+        """
+        Make the queued writes, in parallel.  A failed write does not prevent
+        the others from being made.
+
+        :raises BulkError: If any writes failed, listing them by (model, key)
+        """
+        pending = self._pending
+        self._pending = OrderedDict()
+        results = run_concurrently(
+            lambda write: write(), pending.values(), self.concurrency)
+
+        errors = OrderedDict()
+        for write_key, (_, error) in zip(pending, results):
+            if error is not None:
+                errors[write_key] = error
+        if errors:
+            raise BulkError(
+                '{} of {} writes failed'.format(len(errors), len(pending)),
+                errors)
@@ -0,0 +1,401 @@
+__author__ = 'max'
+
+import argparse
+import gc
+import json
+import os
+import sys
+from timeit import default_timer
+
+from riak.content import RiakContent
+from riak.riak_object import RiakObject
+from drow import models
+from drow.backends import MemoryBackend
+from drow.fields import AutoDateField
+from drow.fields import DefaultFalseField
+from drow.patch import validate_patch
+from drow.resolvers import resolve_json
+from drow.resolvers import resolve_json_as_set
+
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# How much slower than the baseline a benchmark may get before it fails
+DEFAULT_TOLERANCE = 1.0
+
+# Rounds each benchmark is timed for, the fastest one counts
+DEFAULT_ROUNDS = 3
+
+# Calls made before timing starts, to warm up caches
+WARMUP = 20
+
+# The number of objects stored before the benchmarks that read them
+STORED_OBJECTS = 200
+
+# (siblings, keys per sibling) of the resolver benchmarks
+RESOLVER_SHAPES = [(2, 10), (8, 10), (2, 1000), (8, 1000)]
+
+
+def percentile(samples, fraction):
+    """
+    :param list<float> samples: Sorted samples
+    :param float fraction: The fraction of samples at or below the result
+    :return: The nearest-rank percentile of the samples
+    :rtype: float
+    """
+    rank = int(round(fraction * len(samples) + 0.5)) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+def document(i, size=10):
+    """
+    :param int i: The number of the document
+    :param int size: The number of keys in the document
+    :return: A document shaped like a typical model's data
+    :rtype: dict
+    """
+    data = {
+        'kind': 'plane',
+        'seats': (i * 7) % 400,
+        'tail': 'N{:05d}'.format(i),
+        'owner': {'name': 'Owner {}'.format(i % 50), 'country': 'US'}
+    }
+    for n in xrange(size - len(data)):
+        data['extra{}'.format(n)] = n * i
+    return data
+
+
+class Suite(object):
+    """
+    The benchmarks, run against models stored in a MemoryBackend.  Each
+    benchmark is a method taking the number of calls it will be timed for
+    and returning the function to time, which is passed the number of the
+    call.
+    """
+    def __init__(self, latency=0):
+        """
+        :param float latency: The seconds each request to the backend takes
+        """
+        self.backend = MemoryBackend(latency=latency)
+
+        class Airplane(models.Model):
+            class Meta:
+                bucket_type_name = 'benchmark'
+                bucket_name = 'airplanes'
+                backend = self.backend
+
+            createdTs = AutoDateField(only_on_creation=True)
+            modifiedTs = AutoDateField()
+            retired = DefaultFalseField()
+
+        self.model = Airplane
+
+        # Store the objects read by the benchmarks without any latency
+        self.backend.latency = 0
+        for i in xrange(STORED_OBJECTS):
+            Airplane.objects.put(str(i), document(i))
+        self.backend.latency = latency
+
+    def benchmarks(self):
+        """
+        :return: The (name, prepare) of every benchmark
+        :rtype: list<tuple>
+        """
+        benchmarks = [
+            ('get', self.get),
+            ('get_many', self.get_many),
+            ('put', self.put),
+            ('patch', self.patch),
+            ('create', self.create),
+            ('search', self.search),
+            ('search_fields', self.search_fields),
+            ('validate_patch', self.validate_patch),
+        ]
+        for operation in ('create', 'put', 'patch'):
+            benchmarks.append((
+                'fields_{}'.format(operation),
+                self.fields(operation)))
+        for siblings, size in RESOLVER_SHAPES:
+            for name, resolver in [('resolve_json', resolve_json),
+                                   ('resolve_json_as_set',
+                                    resolve_json_as_set)]:
+                benchmarks.append((
+                    '{}_{}x{}'.format(name, siblings, size),
+                    self.resolve(resolver, siblings, size)))
+        return benchmarks
+
+    def get(self, calls):
+        objects = self.model.objects
+        return lambda i: objects.get(str(i % STORED_OBJECTS), active=True)
+
+    def get_many(self, calls):
+        objects = self.model.objects
+
+        def get_many(i):
+            start = (i * 20) % STORED_OBJECTS
+            objects.get_many([str(k) for k in xrange(start, start + 20)])
+        return get_many
+
+    def put(self, calls):
+        objects = self.model.objects
+        return lambda i: objects.put('put-{}'.format(i), document(i))
+
+    def patch(self, calls):
+        objects = self.model.objects
+
+        def patch(i):
+            objects.patch(str(i % STORED_OBJECTS), [
+                {'op': 'replace', 'path': '/seats', 'value': i},
+                {'op': 'add', 'path': '/owner/phone', 'value': str(i)},
+                {'op': 'remove', 'path': '/owner/phone'}
+            ])
+        return patch
+
+    def create(self, calls):
+        objects = self.model.objects
+        return lambda i: objects.create(document(i))
+
+    def search(self, calls):
+        objects = self.model.objects
+        return lambda i: objects.search(
+            'kind:plane AND seats:[100 TO *]', rows=20, sort='seats desc')
+
+    def search_fields(self, calls):
+        objects = self.model.objects
+        return lambda i: objects.search(
+            'owner.name:"Owner 7"', rows=20, fields=['tail'])
+
+    def validate_patch(self, calls):
+        data = document(1, size=50)
+        patch = [
+            {'op': 'replace', 'path': '/seats', 'value': 1},
+            {'op': 'add', 'path': '/owner/phone', 'value': '555'},
+            {'op': 'remove', 'path': '/extra10'},
+            {'op': 'copy', 'from': '/tail', 'path': '/tail2'},
+            {'op': 'test', 'path': '/kind', 'value': 'plane'}
+        ]
+        return lambda i: validate_patch(patch, data)
+
+    def fields(self, operation):
+        def prepare(calls):
+            plan = self.model._meta.field_plans[operation]
+            old_values = {'createdTs': '2015-01-01T00:00:00Z'}
+            data = [document(i) for i in xrange(calls)]
+            return lambda i: plan.apply(data[i], old_values)
+        return prepare
+
+    def resolve(self, resolver, siblings, size):
+        def prepare(calls):
+            bucket = self.backend.bucket('siblings', 'benchmark')
+            riak_objects = []
+            for i in xrange(calls):
+                riak_object = RiakObject(self.backend, bucket, str(i))
+                riak_object.siblings = [
+                    self.sibling(riak_object, n, size, i)
+                    for n in xrange(siblings)
+                ]
+                riak_objects.append(riak_object)
+            return lambda i: resolver(riak_objects[i])
+        return prepare
+
+    @staticmethod
+    def sibling(riak_object, n, size, i):
+        """
+        :return: A sibling sharing most of its keys with the others, with a
+                 list that differs between siblings
+        :rtype: RiakContent
+        """
+        data = document(i, size)
+        data['seats'] = n
+        data['tags'] = [{'tag': t} for t in xrange(n, n + 5)]
+        return RiakContent(
+            riak_object, encoded_data=json.dumps(data),
+            content_type='application/json', last_modified=1000 + n,
+            exists=True)
+
+
+def calibrate(rounds=DEFAULT_ROUNDS):
+    """
+    Time a fixed amount of plain Python work, so that results can be
+    compared across machines (or a machine whose speed varies) relative to
+    how fast the machine ran it
+
+    :param int rounds: The number of rounds, the fastest counts
+    :return: The milliseconds the work took
+    :rtype: float
+    """
+    best = None
+    for _ in xrange(rounds):
+        start = default_timer()
+        data = {}
+        for i in xrange(5000):
+            data[str(i)] = [i, {'i': i}]
+        json.loads(json.dumps(data))
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+
+def measure(prepare, calls, rounds=DEFAULT_ROUNDS):
+    """
+    Time a benchmark over several rounds, keeping the fastest round
+    relative to the calibration work timed just before it, as slower rounds
+    only measure interference from the rest of the machine
+
+    :param function prepare: A benchmark
+    :param int calls: The number of calls to time per round
+    :param int rounds: The number of rounds
+    :return: The throughput (calls per second) and median and 99th
+             percentile latencies (in milliseconds) of the calls, and the
+             calibration time (see calibrate) they were measured at
+    :rtype: dict
+    """
+    run = prepare(calls * rounds + WARMUP)
+    for i in xrange(WARMUP):
+        run(calls * rounds + i)
+
+    best = None
+    for first in xrange(0, calls * rounds, calls):
+        calibration_ms = calibrate()
+        # Collections would land on whichever calls happen to trigger
+        # them, as with timeit they are kept out of the timings
+        samples = []
+        gc.collect()
+        gc.disable()
+        try:
+            started = default_timer()
+            for i in xrange(first, first + calls):
+                start = default_timer()
+                run(i)
+                samples.append(default_timer() - start)
+            elapsed = default_timer() - started
+        finally:
+            gc.enable()
+
+        if best is None or \
+                elapsed / calibration_ms < best[0] / best[2]:
+            best = (elapsed, samples, calibration_ms)
+
+    elapsed, samples, calibration_ms = best
+    samples.sort()
+    return {
+        'ops_per_sec': calls / elapsed,
+        'p50_ms': percentile(samples, 0.5) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'calibration_ms': calibration_ms
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Find the benchmarks that got slower than the baseline allows.  Only the
+    throughput and median are compared, the 99th percentile is too noisy to
+    fail a check on.  The baseline is first scaled by how much faster or
+    slower the machine ran the calibration work than it did for the
+    baseline.
+
+    :param dict results: The results of each benchmark, by name
+    :param dict baseline: The baseline results of each benchmark, by name
+    :param float tolerance: How much slower a benchmark may get, 1.0 for
+                            twice as slow
+    :return: A description of each regression
+    :rtype: list<str>
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        result = results[name]
+        expected = baseline[name]
+        slowdown = 1.0
+        if result.get('calibration_ms') and expected.get('calibration_ms'):
+            slowdown = result['calibration_ms'] / expected['calibration_ms']
+        ops_per_sec = expected['ops_per_sec'] / slowdown
+        p50_ms = expected['p50_ms'] * slowdown
+
+        if result['ops_per_sec'] * (1 + tolerance) < ops_per_sec:
+            regressions.append('{}: {:.0f} ops/s, baseline {:.0f}'.format(
+                name, result['ops_per_sec'], ops_per_sec))
+        elif result['p50_ms'] > p50_ms * (1 + tolerance):
+            regressions.append('{}: p50 {:.3f}ms, baseline {:.3f}ms'.format(
+                name, result['p50_ms'], p50_ms))
+    return regressions
+
+
+def run(calls, latency=0, only=None, rounds=DEFAULT_ROUNDS, out=sys.stdout):
+    """
+    :param int calls: The number of calls to time per round
+    :param float latency: The seconds each request to the backend takes
+    :param str only: Only run the benchmarks whose name contains this
+    :param int rounds: The number of rounds each benchmark is timed for
+    :param file out: Where to report the results as they come in
+    :return: The results of each benchmark, by name
+    :rtype: dict
+    """
+    suite = Suite(latency)
+    results = {}
+    out.write('{:<28} {:>12} {:>10} {:>10}\n'.format(
+        'benchmark', 'ops/s', 'p50 ms', 'p99 ms'))
+    for name, prepare in suite.benchmarks():
+        if only is not None and only not in name:
+            continue
+        result = results[name] = measure(prepare, calls, rounds)
+        out.write('{:<28} {:>12.0f} {:>10.3f} {:>10.3f}\n'.format(
+            name, result['ops_per_sec'], result['p50_ms'],
+            result['p99_ms']))
+    return results
+
+
+def main(argv=None):
+    """
+    Run the benchmarks, comparing them with (or saving them as) a baseline
+
+    :return: The exit status, 1 if any benchmark regressed
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark drow against an in-memory backend')
+    parser.add_argument('--calls', type=int, default=300,
+                        help='calls timed per round')
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS,
+                        help='rounds per benchmark, the fastest counts')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds each backend request takes')
+    parser.add_argument('--only', help='run the benchmarks matching this')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='the baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed slowdown, 1.0 for twice as slow')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    args = parser.parse_args(argv)
+
+    results = run(
+        args.calls, args.latency / 1000.0, args.only, args.rounds)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'latency_ms': args.latency, 'results': results}, f,
+                      indent=2, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print 'No baseline at {}, run with --save'.format(args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['latency_ms'] != args.latency:
+        print 'The baseline was run with {}ms latency, not compared'.format(
+            baseline['latency_ms'])
+        return 2
+
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print 'REGRESSION', regression
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,10 @@
 __author__ = 'max'
 
+import json
+from copy import deepcopy
 from mock import MagicMock
+from riak.riak_object import RiakObject
+from riak.riak_object import VClock
 from time import time
 
 
@@ -68,3 +72,107 @@ def create_mock_riak_client():
     riak_client.bucket.return_value = bucket
 
     return riak_client
+
+
+def use_real_riak_objects(bucket, stored):
+    """
+    Make a mock bucket deal in real RiakObjects, backed by the stored dict
+    """
+    bucket.get_encoder.return_value = json.dumps
+    bucket.get_decoder.return_value = json.loads
+
+    def new_riak_object(key=None, data=None, content_type=None,
+                        encoded_data=None):
+        riak_object = RiakObject(None, bucket, key)
+        riak_object.content_type = content_type or 'application/json'
+        if data is not None:
+            riak_object.data = data
+        if encoded_data is not None:
+            riak_object.encoded_data = encoded_data
+        def store(**kwargs):
+            riak_object.siblings[0].exists = True
+            return riak_object
+
+        riak_object.store = MagicMock(side_effect=store)
+        riak_object.delete = MagicMock(return_value=riak_object)
+        return riak_object
+
+    def get_side_effect(key):
+        if key not in stored:
+            return new_riak_object(key)
+        riak_object = new_riak_object(key, data=deepcopy(stored[key]))
+        riak_object.siblings[0].exists = True
+        riak_object.vclock = VClock('vclock-' + key, 'binary')
+        return riak_object
+
+    bucket.new.side_effect = new_riak_object
+    bucket.get.side_effect = get_side_effect
+    bucket.multiget.side_effect = \
+        lambda keys: [get_side_effect(k) for k in keys]
+
+
+def _apply_map_ops(value, ops):
+    """
+    Apply the operations staged on a Riak map to its value, as Riak would
+    """
+    for op in ops:
+        if op[0] == 'remove':
+            value.pop(op[1], None)
+            continue
+        _, key, sub_op = op
+        kind = key[1]
+        if kind == 'register':
+            value[key] = sub_op[1]
+        elif kind == 'flag':
+            value[key] = sub_op == 'enable'
+        elif kind == 'counter':
+            value[key] = value.get(key, 0) + sub_op[1]
+        elif kind == 'set':
+            elements = set(value.get(key, ()))
+            elements.update(sub_op.get('adds', ()))
+            elements.difference_update(sub_op.get('removes', ()))
+            value[key] = frozenset(elements)
+        else:
+            value[key] = _apply_map_ops(dict(value.get(key, {})), sub_op)
+    return value
+
+
+def use_real_riak_maps(bucket, stored):
+    """
+    Make a mock bucket deal in real Riak maps, backed by the stored dict of
+    map values.  Each update's operations are recorded in bucket.updates as
+    a tuple of (key, operations, context).
+    """
+    from riak.datatypes import Map
+
+    bucket.updates = []
+    contexts = {}
+
+    def fetch(key=None):
+        if key not in stored:
+            return Map(bucket, key)
+        return Map(bucket, key, value=deepcopy(stored[key]),
+                   context=contexts.get(key, 'context-' + key))
+
+    def update_datatype(datatype, **params):
+        bucket.updates.append(
+            (datatype.key, datatype.to_op(), datatype.context))
+        if datatype.key is None:
+            datatype.key = 'autogen_key'
+        stored[datatype.key] = _apply_map_ops(
+            deepcopy(stored.get(datatype.key, {})), datatype.to_op())
+        # Every update moves the map's causal context on
+        contexts[datatype.key] = 'context-{}-{}'.format(
+            datatype.key, len(bucket.updates))
+        if params.get('return_body'):
+            datatype._set_value(deepcopy(stored[datatype.key]))
+            datatype._context = contexts[datatype.key]
+
+    def delete(datatype, **params):
+        stored.pop(datatype.key, None)
+
+    bucket._client.update_datatype.side_effect = update_datatype
+    bucket._client.delete.side_effect = delete
+    bucket.new.side_effect = lambda key=None: Map(bucket, key)
+    bucket.get.side_effect = fetch
+    bucket.multiget.side_effect = lambda keys: [fetch(k) for k in keys]
@@ -0,0 +1,89 @@
+__author__ = 'max'
+
+from threading import Event
+from unittest import TestCase
+from mock import patch
+from mockriak import create_mock_riak_client
+from mockriak import use_real_riak_objects
+from drow import models
+from drow.asyncqueryset import default_executor
+from drow.errors import DeadlineExceeded
+from drow.errors import DoesNotExist
+from drow.pool import Executor
+from drow.pool import gather
+
+
+class TestAsyncQuerySet(TestCase):
+    def setUp(self):
+        self.patcher = patch.object(models, 'settings')
+        settings = self.patcher.start()
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+        self.model = MyModel
+        self.bucket = MyModel.objects._state.bucket
+        self.stored = {'a': {'n': 1}, 'b': {'n': 2}}
+        use_real_riak_objects(self.bucket, self.stored)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_calls(self):
+        MyModel = self.model
+        self.assertIs(MyModel.aobjects.objects, MyModel.objects)
+        self.assertIs(MyModel.aobjects.executor, default_executor)
+        self.assertIsNone(MyModel('a').aobjects)
+
+        instance = MyModel.aobjects.get('a').result(5)
+        self.assertIsInstance(instance, MyModel)
+        self.assertEqual(instance.data, {'n': 1})
+
+        with self.assertRaises(DoesNotExist):
+            MyModel.aobjects.get('missing').result(5)
+
+        results = MyModel.aobjects.get_many(['a', 'b']).result(5)
+        self.assertEqual([i.data for i in results], [{'n': 1}, {'n': 2}])
+
+        instance = MyModel.aobjects.put('c', {'n': 3}).result(5)
+        self.assertEqual(instance.data, {'n': 3})
+        self.assertEqual(MyModel.aobjects.patch('a', [
+            {'op': 'replace', 'path': '/n', 'value': 5}]).result(5).data,
+            {'n': 5})
+        MyModel.aobjects.delete('a').result(5)
+        self.bucket.new.assert_called_with('a')
+
+    def test_fan_out(self):
+        MyModel = self.model
+        started = []
+        release = Event()
+        get_side_effect = self.bucket.get.side_effect
+
+        def slow_get(key):
+            started.append(key)
+            release.wait(5)
+            return get_side_effect(key)
+
+        self.bucket.get.side_effect = slow_get
+        futures = [MyModel.aobjects.get(k) for k in ('a', 'b')]
+        with self.assertRaises(DeadlineExceeded):
+            gather(futures, timeout=0.05)
+        self.assertEqual(sorted(started), ['a', 'b'])
+
+        release.set()
+        self.assertEqual(
+            [i.key for i in gather(futures, timeout=5)], ['a', 'b'])
+
+    def test_model_executor(self):
+        executor = Executor(max_workers=1)
+
+        class OtherModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+        OtherModel._meta.executor = executor
+        self.assertIs(OtherModel.aobjects.executor, executor)
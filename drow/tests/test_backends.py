@@ -0,0 +1,185 @@
+__author__ = 'max'
+
+from unittest import TestCase
+from riak import RiakError
+from drow import models
+from drow.backends import MemoryBackend
+from drow.backends import SolrQuery
+from drow.errors import DoesNotExist
+from drow.errors import SearchError
+
+
+def create_model(backend, bucket_type_name='test_type'):
+    class Person(models.Model):
+        class Meta:
+            bucket_name = 'people'
+
+        Meta.bucket_type_name = bucket_type_name
+        Meta.backend = backend
+
+    return Person
+
+
+class TestMemoryBackend(TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.Person = create_model(self.backend)
+
+    def test_round_trip(self):
+        created = self.Person.objects.create({'name': 'Ann'})
+        self.assertIsNotNone(created.key)
+
+        person = self.Person.objects.get(created.key)
+        self.assertEqual(person.data, {'name': 'Ann'})
+        self.assertIsNotNone(person._state.riak_object.last_modified)
+
+        self.Person.objects.put('b', {'name': 'Bob'})
+        self.assertEqual(self.Person.objects.get('b').data, {'name': 'Bob'})
+        self.assertEqual(
+            sorted(self.Person.objects.keys()), sorted([created.key, 'b']))
+
+        self.Person.objects.delete('b')
+        with self.assertRaises(DoesNotExist):
+            self.Person.objects.get('b').data
+
+    def test_put_replaces_the_stored_object(self):
+        self.Person.objects.put('k', {'a': 1})
+        self.Person.objects.put('k', {'b': 2})
+        self.assertEqual(self.Person.objects.get('k').data, {'b': 2})
+
+    def test_concurrent_writes_become_siblings(self):
+        bucket = self.Person.objects._state.bucket
+        bucket.new('a', {'name': 'Ann'}).store()
+        bucket.new('a', {'age': 30}).store()
+
+        riak_object = self.Person.objects._state.bucket.new('a')
+        riak_object.resolver = lambda o: None
+        riak_object.reload()
+        self.assertEqual(len(riak_object.siblings), 2)
+
+        person = self.Person.objects.get('a', active=True)
+        self.assertEqual(person.data, {'name': 'Ann', 'age': 30})
+        # Once when the second store returned both siblings, once on get
+        self.assertEqual(self.Person.objects.resolver_stats.resolutions, 2)
+
+        # Writing with the vector clock that was read replaces the siblings
+        person.data['age'] = 31
+        person.save()
+        riak_object.reload()
+        self.assertEqual(len(riak_object.siblings), 1)
+        self.assertEqual(riak_object.data, {'name': 'Ann', 'age': 31})
+
+    def test_last_write_wins_in_default_bucket_type(self):
+        Person = create_model(self.backend, 'default')
+        Person.objects.put('a', {'name': 'Ann'})
+        Person.objects.put('a', {'age': 30})
+        self.assertEqual(Person.objects.get('a').data, {'age': 30})
+
+    def test_if_none_match(self):
+        bucket = self.Person.objects._state.bucket
+        bucket.new('a', {'name': 'Ann'}).store(if_none_match=True)
+        with self.assertRaises(RiakError):
+            bucket.new('a', {'name': 'Bob'}).store(if_none_match=True)
+
+    def test_secondary_indexes(self):
+        bucket = self.Person.objects._state.bucket
+        for key, age in [('a', 30), ('b', 40), ('c', 50)]:
+            riak_object = bucket.new(key, {'age': age})
+            riak_object.add_index('age_int', age)
+            riak_object.add_index('team_bin', 'red')
+            riak_object.store()
+
+        self.assertEqual(
+            list(self.Person.objects.index_keys('age_int', 35, 60)),
+            ['b', 'c'])
+        self.assertEqual(
+            list(self.Person.objects.index_keys('team_bin', 'red')),
+            ['a', 'b', 'c'])
+
+        page = self.Person.objects.index_keys('team_bin', 'red', max_results=2)
+        self.assertEqual(list(page), ['a', 'b'])
+        page = self.Person.objects.index_keys(
+            'team_bin', 'red', max_results=2, continuation=page.continuation)
+        self.assertEqual(list(page), ['c'])
+        self.assertIsNone(page.continuation)
+
+    def test_search(self):
+        for i in range(5):
+            self.Person.objects.put(
+                str(i), {'age': i * 10, 'address': {'city': 'Paris'}})
+        self.Person.objects.put('x', {'age': 99, 'address': {'city': 'Rome'}})
+
+        self.assertEqual(self.Person.objects.count('*:*'), 6)
+        self.assertEqual(
+            self.Person.objects.count('address.city:Paris AND age:[10 TO *]'),
+            4)
+
+        results = self.Person.objects.search(
+            'address.city:Paris', rows=2, sort='age desc')
+        self.assertEqual([p.key for p in results], ['4', '3'])
+        results = self.Person.objects.search(
+            'address.city:Paris', rows=2, sort='age desc',
+            cursor=results.cursor)
+        self.assertEqual([p.key for p in results], ['2', '1'])
+
+        rows = self.Person.objects.search('age:99', fields=['address.city'])
+        self.assertEqual(rows[0]['address.city'], 'Rome')
+
+        with self.assertRaises(SearchError):
+            self.Person.objects.search('age:(')
+
+    def test_search_cursor_after_overfetch(self):
+        for i in range(3):
+            self.Person.objects.put('k{}'.format(i), {'n': i})
+        # Overfetching gets every result, but only 2 of the 3 fill the page
+        self.Person.objects._state.search_stats.docs_per_key = 2
+
+        results = self.Person.objects.search('*:*', rows=2, sort='n asc')
+        self.assertEqual([p.key for p in results], ['k0', 'k1'])
+        self.assertIsNotNone(results.cursor)
+
+        results = self.Person.objects.search(
+            '*:*', rows=2, sort='n asc', cursor=results.cursor)
+        self.assertEqual([p.key for p in results], ['k2'])
+        self.assertIsNone(results.cursor)
+
+    def test_latency(self):
+        round_trips = []
+        self.backend.latency = lambda: round_trips.append(1) or 0
+
+        self.Person.objects.put('a', {'name': 'Ann'})
+        self.Person.objects.get_many(['a', 'b', 'c'], must_exist=False)
+        # The put fetches and stores, the get_many is a single multiget
+        self.assertEqual(len(round_trips), 3)
+
+
+class TestSolrQuery(TestCase):
+    def test_matching(self):
+        doc = {'name': 'Ann Lee', 'age': 30, 'tags': ['a', 'b'],
+               'active': True}
+        cases = [
+            ('*:*', True),
+            ('name:"Ann Lee"', True),
+            ('name:Ann*', True),
+            ('name:Bob*', False),
+            ('age:30', True),
+            ('age:[30 TO 40]', True),
+            ('age:{30 TO 40]', False),
+            ('tags:b', True),
+            ('tags:c OR age:30', True),
+            ('tags:c age:30', True),
+            ('tags:c AND age:30', False),
+            ('NOT tags:c', True),
+            ('-tags:a', False),
+            ('(tags:c OR tags:a) AND active:true', True),
+            ('missing:*', False),
+        ]
+        for query, expected in cases:
+            self.assertEqual(
+                SolrQuery(query).matches(doc), expected, query)
+
+    def test_bad_queries(self):
+        for query in ['name:', '(age:1', 'age:1)', 'AND']:
+            with self.assertRaises(RiakError):
+                SolrQuery(query)
+
@@ -0,0 +1,74 @@
+__author__ = 'max'
+
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+from mock import patch
+from drow.tests import benchmarks
+
+
+class TestBenchmarks(TestCase):
+    def test_every_benchmark_runs(self):
+        out = StringIO()
+        results = benchmarks.run(2, rounds=1, out=out)
+
+        self.assertIn('get', results)
+        self.assertIn('resolve_json_as_set_8x1000', results)
+        for name, result in results.items():
+            self.assertIn(name, out.getvalue())
+            self.assertGreater(result['ops_per_sec'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_compare(self):
+        baseline = {
+            'get': {'ops_per_sec': 1000, 'p50_ms': 1.0, 'p99_ms': 2.0},
+            'put': {'ops_per_sec': 1000, 'p50_ms': 1.0, 'p99_ms': 2.0},
+            'search': {'ops_per_sec': 1000, 'p50_ms': 1.0, 'p99_ms': 2.0}
+        }
+        results = {
+            'get': {'ops_per_sec': 900, 'p50_ms': 1.1, 'p99_ms': 9.0},
+            'put': {'ops_per_sec': 500, 'p50_ms': 1.0, 'p99_ms': 2.0},
+            'search': {'ops_per_sec': 1000, 'p50_ms': 1.6, 'p99_ms': 2.0},
+            'create': {'ops_per_sec': 1, 'p50_ms': 1000, 'p99_ms': 1000}
+        }
+
+        regressions = benchmarks.compare(results, baseline, tolerance=0.5)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('put:'))
+        self.assertTrue(regressions[1].startswith('search:'))
+
+    def test_compare_scales_by_calibration(self):
+        baseline = {'get': {
+            'ops_per_sec': 1000, 'p50_ms': 1.0, 'calibration_ms': 10.0}}
+        slower_machine = {'get': {
+            'ops_per_sec': 400, 'p50_ms': 2.5, 'calibration_ms': 25.0}}
+        slower_code = {'get': {
+            'ops_per_sec': 400, 'p50_ms': 2.5, 'calibration_ms': 10.0}}
+
+        self.assertEqual(
+            benchmarks.compare(slower_machine, baseline, tolerance=0.5), [])
+        self.assertEqual(
+            len(benchmarks.compare(slower_code, baseline, tolerance=0.5)), 1)
+
+    def test_baseline_gate(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'baseline.json')
+        args = ['--calls', '2', '--only', 'validate', '--baseline', path]
+
+        with patch.object(benchmarks, 'run') as run:
+            run.return_value = {
+                'validate_patch': {
+                    'ops_per_sec': 1000, 'p50_ms': 1.0, 'p99_ms': 1.0}
+            }
+            self.assertEqual(benchmarks.main(args + ['--save']), 0)
+            with open(path) as f:
+                self.assertEqual(json.load(f)['latency_ms'], 0)
+            self.assertEqual(benchmarks.main(args), 0)
+
+            run.return_value['validate_patch']['ops_per_sec'] = 100
+            self.assertEqual(benchmarks.main(args), 1)
+            self.assertEqual(benchmarks.main(args + ['--latency', '5']), 2)
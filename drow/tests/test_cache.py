@@ -0,0 +1,69 @@
+__author__ = 'max'
+
+from unittest import TestCase
+from mock import patch
+from drow import cache
+from drow.cache import ObjectCache
+
+
+class TestObjectCache(TestCase):
+    def test_lru_eviction(self):
+        object_cache = ObjectCache(max_entries=2)
+        object_cache.set('a', 1)
+        object_cache.set('b', 2)
+        self.assertEqual(object_cache.get('a'), (1, False))
+        object_cache.set('c', 3)
+
+        # 'b' was the least recently used
+        self.assertNotIn('b', object_cache)
+        self.assertIn('a', object_cache)
+        self.assertIn('c', object_cache)
+        self.assertIsNone(object_cache.get('b'))
+        self.assertEqual(object_cache.hits, 1)
+        self.assertEqual(object_cache.misses, 1)
+        self.assertEqual(object_cache.hit_rate, 0.5)
+        self.assertEqual(ObjectCache().hit_rate, 0.0)
+
+    def test_size_eviction(self):
+        object_cache = ObjectCache(max_entries=None, max_bytes=10)
+        object_cache.set('a', 'a', 4)
+        object_cache.set('b', 'b', 4)
+        object_cache.set('a', 'a', 5)
+        self.assertEqual(object_cache.size, 9)
+        object_cache.set('c', 'c', 3)
+        self.assertEqual(list(object_cache._entries), ['a', 'c'])
+        self.assertEqual(object_cache.size, 8)
+
+        # Values larger than the whole cache are never stored
+        object_cache.set('a', 'a', 11)
+        self.assertNotIn('a', object_cache)
+        self.assertEqual(object_cache.size, 3)
+
+        object_cache.invalidate('c')
+        object_cache.invalidate('missing')
+        self.assertEqual(object_cache.size, 0)
+        self.assertEqual(len(object_cache), 0)
+
+    @patch.object(cache, 'time')
+    def test_ttl(self, time):
+        time.return_value = 100
+        object_cache = ObjectCache(ttl=10)
+        object_cache.set('a', 1, 1)
+
+        time.return_value = 105
+        object_cache.touch('a')
+        time.return_value = 112
+        self.assertEqual(object_cache.get('a'), (1, False))
+        self.assertEqual(object_cache.get('a', include_expired=True),
+                         (1, False))
+
+        time.return_value = 116
+        self.assertEqual(object_cache.get('a', include_expired=True),
+                         (1, True))
+        self.assertIsNone(object_cache.get('a'))
+        self.assertNotIn('a', object_cache)
+        self.assertEqual(object_cache.size, 0)
+
+        object_cache.set('b', 1)
+        object_cache.clear()
+        self.assertEqual(len(object_cache), 0)
@@ -5,9 +5,12 @@ from mock import patch
 from mock import MagicMock
 import jsonpatch
 from mockriak import create_mock_riak_client
+from drow import fields
 from drow import models
 from drow.fields import AutoDateField
 from drow.fields import DefaultFalseField
+from drow.fields import FieldPlan
+from drow.fields import ModelField
 
 
 class FakeModelContext(object):
@@ -66,6 +69,7 @@ class TestFields(TestCase):
             old_update = instance.data['update_date2']
             old_create = instance.data['create_date']
 
+            instance.data['a'] = 'a'
             instance.save()
 
             self.assertEqual(instance.data['create_date'], old_create)
@@ -95,3 +99,48 @@ class TestFields(TestCase):
             self.assertEqual(result.data['create_date'], old_create)
             self.assertNotEqual(result.data['update_date2'], old_update)
             self.assertNotEqual(result.data['update_date2'], 'asdf')
+
+    def test_field_plans(self):
+        class UpperField(ModelField):
+            def new_value(self, operation, proposed_value=None,
+                          old_value=None):
+                return '{}:{}'.format(operation, proposed_value)
+
+        model_fields = {
+            'created': AutoDateField(only_on_creation=True),
+            'modified': AutoDateField(),
+            'flag': DefaultFalseField(),
+            'custom': UpperField()
+        }
+        with patch.object(fields, 'solr_now') as solr_now:
+            solr_now.return_value = 'now'
+            plan = FieldPlan(model_fields, 'put')
+            self.assertTrue(plan.needs_time)
+            data = {'created': 'x', 'modified': 'x', 'custom': 'x'}
+            plan.apply(data, {'created': 'then'})
+            self.assertEqual(data, {
+                'created': 'then', 'modified': 'now', 'flag': False,
+                'custom': 'put:x'})
+
+            plan.apply(data, now='shared')
+            self.assertEqual(data['modified'], 'shared')
+            self.assertEqual(solr_now.call_count, 1)
+
+        del model_fields['modified']
+        plan = FieldPlan(model_fields, 'patch')
+        self.assertFalse(plan.needs_time)
+        self.assertIsNone(plan.timestamp())
+
+    def test_shared_timestamps(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            with patch.object(fields, 'solr_now') as solr_now:
+                solr_now.side_effect = ['first', 'second']
+                instance = MyModel.objects.create({})
+                self.assertEqual(instance.data['create_date'], 'first')
+                self.assertEqual(instance.data['update_date2'], 'first')
+
+                results = MyModel.objects.create_many([{}, {}])
+                for instance in results:
+                    self.assertEqual(instance.data['create_date'], 'second')
+                    self.assertEqual(instance.data['update_date2'], 'second')
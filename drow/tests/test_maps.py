@@ -0,0 +1,244 @@
+__author__ = 'max'
+
+from unittest import TestCase
+from mock import MagicMock
+from mock import patch
+from mockriak import create_mock_riak_client
+from mockriak import use_real_riak_maps
+from drow import models
+from drow.cache import ObjectCache
+from drow.errors import DoesNotExist
+from drow.errors import InvalidConfig
+from drow.errors import InvalidMapData
+from drow.errors import WriteConflict
+from drow.fields import AutoDateField
+from drow.fields import DefaultFalseField
+from drow.fields import ModelField
+from drow.maps import MapObject
+
+
+class TestMaps(TestCase):
+    def setUp(self):
+        self.patcher = patch.object(models, 'settings')
+        settings = self.patcher.start()
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def create_model(self, stored):
+        class Profile(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                map_schema = {
+                    'name': 'register',
+                    'views': 'counter',
+                    'tags': 'set',
+                    'address': {'city': 'register', 'verified': 'flag'}
+                }
+
+            created = AutoDateField(only_on_creation=True)
+            modified = AutoDateField()
+            active = DefaultFalseField()
+
+        bucket = Profile.objects._state.bucket
+        use_real_riak_maps(bucket, stored)
+        return Profile, bucket
+
+    def stored_profile(self):
+        return {
+            ('name', 'register'): 'max',
+            ('views', 'counter'): 3,
+            ('tags', 'set'): frozenset(['b', 'a']),
+            ('active', 'flag'): True,
+            ('address', 'map'): {('city', 'register'): 'Bath'},
+            ('created', 'register'): '2016-01-01T00:00:00Z'
+        }
+
+    def test_schema(self):
+        Profile, _ = self.create_model({})
+        self.assertEqual(Profile._meta.map_schema['created'], 'register')
+        self.assertEqual(Profile._meta.map_schema['active'], 'flag')
+        self.assertTrue(Profile._meta.put_needs_read)
+
+    def test_get(self):
+        Profile, _ = self.create_model({'a': self.stored_profile()})
+
+        instance = Profile.objects.get('a', active=True)
+        self.assertIsInstance(instance._state.riak_object, MapObject)
+        self.assertEqual(instance.data, {
+            'name': 'max',
+            'views': 3,
+            'tags': ['a', 'b'],
+            'active': True,
+            'address': {'city': 'Bath', 'verified': False},
+            'created': '2016-01-01T00:00:00Z'
+        })
+
+        results = Profile.objects.get_many(['a', 'b'], must_exist=False)
+        self.assertEqual(results[0].data['name'], 'max')
+        self.assertIsNone(results[1].data)
+
+    def test_instrumented(self):
+        stored = {'a': self.stored_profile()}
+        Profile, _ = self.create_model(stored)
+        Profile._meta.instrumentation = instrumentation = MagicMock()
+
+        Profile.objects.get('a', active=True)
+        with self.assertRaises(DoesNotExist):
+            Profile.objects.get('b').data
+        Profile.objects.get_many(['a', 'b'], must_exist=False)
+        Profile.objects.patch('a', [{'op': 'remove', 'path': '/tags/0'}])
+
+        events = [c[0][0] for c in instrumentation.record.call_args_list]
+        self.assertEqual(
+            [(e.operation, e.keys, e.siblings, e.outcome) for e in events],
+            [('get', 1, None, 'ok'), ('get', 1, None, 'not_found'),
+             ('multiget', 2, None, 'ok'), ('get', 1, None, 'ok'),
+             ('store', 1, None, 'ok')])
+
+    def test_blind_patch(self):
+        stored = {'a': self.stored_profile()}
+        Profile, bucket = self.create_model(stored)
+
+        instance = Profile.objects.patch('a', [
+            {'op': 'replace', 'path': '/name', 'value': 'maxwell'},
+            {'op': 'increment', 'path': '/views', 'value': 2},
+            {'op': 'add', 'path': '/tags/-', 'value': 'c'},
+            {'op': 'replace', 'path': '/address/verified', 'value': True}
+        ])
+
+        self.assertEqual(bucket.get.call_count, 0)
+        self.assertEqual(len(bucket.updates), 1)
+        key, _, context = bucket.updates[0]
+        self.assertEqual(key, 'a')
+        self.assertIsNone(context)
+
+        self.assertEqual(instance.data['name'], 'maxwell')
+        self.assertEqual(instance.data['views'], 5)
+        self.assertEqual(instance.data['tags'], ['a', 'b', 'c'])
+        self.assertEqual(instance.data['address'],
+                         {'city': 'Bath', 'verified': True})
+        self.assertEqual(instance.data['created'], '2016-01-01T00:00:00Z')
+        self.assertIn('modified', instance.data)
+
+    def test_patch_needing_read(self):
+        stored = {'a': self.stored_profile()}
+        Profile, bucket = self.create_model(stored)
+
+        instance = Profile.objects.patch('a', [
+            {'op': 'remove', 'path': '/tags/0'},
+            {'op': 'increment', 'path': '/views', 'value': 1},
+            {'op': 'replace', 'path': '/active', 'value': False},
+            {'op': 'remove', 'path': '/address'}
+        ])
+
+        self.assertEqual(bucket.get.call_count, 1)
+        self.assertEqual(len(bucket.updates), 1)
+        key, operations, context = bucket.updates[0]
+        self.assertEqual(context, 'context-a')
+        self.assertIn(('remove', ('address', 'map')), operations)
+        self.assertIn(
+            ('update', ('views', 'counter'), ('increment', 1)), operations)
+        self.assertNotIn(('name', 'register'), [o[1] for o in operations])
+
+        self.assertEqual(instance.data['tags'], ['b'])
+        self.assertEqual(instance.data['views'], 4)
+        self.assertFalse(instance.data['active'])
+        self.assertNotIn('address', instance.data)
+
+    def test_save_sends_changes(self):
+        stored = {'a': self.stored_profile()}
+        Profile, bucket = self.create_model(stored)
+
+        instance = Profile.objects.get('a')
+        instance.data['views'] = 10
+        instance.data['tags'].append('z')
+        instance.save()
+
+        _, operations, _ = bucket.updates[0]
+        self.assertEqual(sorted(o[1] for o in operations), [
+            ('modified', 'register'), ('tags', 'set'), ('views', 'counter')])
+        self.assertIn(
+            ('update', ('views', 'counter'), ('increment', 7)), operations)
+        self.assertEqual(stored['a'][('views', 'counter')], 10)
+        self.assertFalse(instance.is_dirty)
+
+    def test_check_conflicts(self):
+        stored = {'a': self.stored_profile()}
+        Profile, bucket = self.create_model(stored)
+
+        instance = Profile.objects.get('a')
+        instance.data['views'] = 10
+        instance.save(check_conflict=True)
+        instance.patch([{'op': 'replace', 'path': '/name', 'value': 'al'}],
+                       check_conflict=True)
+        self.assertEqual(len(bucket.updates), 2)
+
+        Profile.objects.get('a').save(force=True)
+        instance.data['views'] = 11
+        with self.assertRaises(WriteConflict):
+            instance.save(check_conflict=True)
+
+        Profile._meta.check_conflicts = True
+        instance = Profile.objects.get('a')
+        instance.data['views'] = 12
+        instance.save()
+        self.assertEqual(stored['a'][('views', 'counter')], 12)
+
+    def test_create_and_put(self):
+        stored = {}
+        Profile, bucket = self.create_model(stored)
+
+        instance = Profile.objects.create({'name': 'max', 'tags': ['a']})
+        self.assertEqual(instance.key, 'autogen_key')
+        self.assertEqual(instance.data['name'], 'max')
+        self.assertIn('created', instance.data)
+        self.assertFalse(instance.data['active'])
+
+        instance = Profile.objects.put('autogen_key', {'views': 1})
+        self.assertEqual(instance.data['views'], 1)
+        self.assertNotIn('name', instance.data)
+        self.assertEqual(instance.data['created'],
+                         stored['autogen_key'][('created', 'register')])
+
+    def test_invalid_data(self):
+        Profile, bucket = self.create_model({})
+
+        with self.assertRaises(InvalidMapData):
+            Profile.objects.patch(
+                'a', [{'op': 'replace', 'path': '/name', 'value': 1}])
+        with self.assertRaises(InvalidMapData):
+            Profile.objects.patch(
+                'a', [{'op': 'replace', 'path': '/other', 'value': 'x'}])
+        with self.assertRaises(InvalidMapData):
+            Profile.objects.create({'views': 'many'})
+        self.assertEqual(bucket.updates, [])
+
+    def test_invalid_config(self):
+        with self.assertRaises(InvalidConfig):
+            class BadType(models.Model):
+                class Meta:
+                    bucket_name = 'test_bucket'
+                    bucket_type_name = 'test_type'
+                    map_schema = {'a': 'list'}
+
+        with self.assertRaises(InvalidConfig):
+            class Cached(models.Model):
+                class Meta:
+                    bucket_name = 'test_bucket'
+                    bucket_type_name = 'test_type'
+                    map_schema = {}
+                    cache = ObjectCache()
+
+        field = ModelField()
+        field.name = 'custom'
+        with self.assertRaises(InvalidConfig):
+            class CustomField(models.Model):
+                class Meta:
+                    bucket_name = 'test_bucket'
+                    bucket_type_name = 'test_type'
+                    map_schema = {}
+
+                custom = field
@@ -0,0 +1,143 @@
+__author__ = 'max'
+
+from unittest import TestCase
+from drow import models
+from drow.backends import MemoryBackend
+from drow.errors import DoesNotExist
+from drow.metrics import Histogram
+from drow.metrics import MetricsAggregator
+
+
+class Recorder(object):
+    def __init__(self):
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+
+def require_name(data):
+    if 'name' not in data:
+        raise ValueError('name is required')
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        self.recorder = Recorder()
+
+        class Person(models.Model):
+            class Meta:
+                bucket_type_name = 'test_type'
+                bucket_name = 'people'
+                backend = MemoryBackend()
+                instrumentation = self.recorder
+                storage_validator = require_name
+
+        self.Person = Person
+
+    def operations(self):
+        return [e.operation for e in self.recorder.events]
+
+    def test_riak_calls(self):
+        self.Person.objects.put('a', {'name': 'Ann'})
+        self.assertEqual(
+            self.operations(), ['get', 'validate_storage', 'store'])
+        store = self.recorder.events[2]
+        self.assertEqual(store.model, 'Person')
+        self.assertEqual(store.keys, 1)
+        self.assertEqual(store.encoded_bytes, len('{"name": "Ann"}'))
+        self.assertEqual(store.outcome, 'ok')
+        self.assertGreaterEqual(store.seconds, 0)
+
+        del self.recorder.events[:]
+        self.Person.objects.get('a', active=True)
+        with self.assertRaises(DoesNotExist):
+            self.Person.objects.get('b').data
+        self.assertEqual(
+            [(e.operation, e.outcome, e.siblings)
+             for e in self.recorder.events],
+            [('get', 'ok', 1), ('get', 'not_found', 0)])
+
+        del self.recorder.events[:]
+        self.Person.objects.get_many(['a', 'b'], must_exist=False)
+        self.Person.objects.search('name:Ann')
+        self.Person.objects.delete('a')
+        # The search results are fetched with a multiget of their own
+        self.assertEqual(
+            self.operations(), ['multiget', 'search', 'multiget', 'delete'])
+        self.assertEqual(self.recorder.events[0].keys, 2)
+        self.assertEqual(self.recorder.events[1].keys, 1)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.Person.objects.put('a', {'age': 30})
+        self.assertEqual(self.operations(), ['get', 'validate_storage'])
+        event = self.recorder.events[1]
+        self.assertEqual(event.operation, 'validate_storage')
+        self.assertEqual(event.outcome, 'error')
+        self.assertIsInstance(event.error, ValueError)
+
+    def test_resolutions(self):
+        bucket = self.Person.objects._state.bucket
+        bucket.new('a', {'name': 'Ann'}).store(return_body=False)
+        bucket.new('a', {'age': 30}).store(return_body=False)
+        del self.recorder.events[:]
+
+        self.Person.objects.get('a', active=True)
+        self.assertEqual(self.operations(), ['resolve', 'get'])
+        resolve = self.recorder.events[0]
+        self.assertEqual(resolve.siblings, 2)
+        self.assertEqual(resolve.outcome, 'ok')
+
+    def test_not_instrumented(self):
+        class Person(models.Model):
+            class Meta:
+                bucket_type_name = 'test_type'
+                bucket_name = 'people'
+                backend = MemoryBackend()
+
+        Person.objects.put('a', {'name': 'Ann'})
+        Person.objects.get('a', active=True)
+        self.assertEqual(self.recorder.events, [])
+
+
+class TestMetricsAggregator(TestCase):
+    def test_snapshot(self):
+        metrics = MetricsAggregator()
+
+        class Person(models.Model):
+            class Meta:
+                bucket_type_name = 'test_type'
+                bucket_name = 'people'
+                backend = MemoryBackend()
+                instrumentation = metrics
+
+        Person.objects.put('a', {'name': 'Ann'})
+        for key in ['a', 'a', 'b']:
+            Person.objects._fetch(key)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(
+            sorted(snapshot), [('Person', 'get'), ('Person', 'store')])
+        get = snapshot[('Person', 'get')]
+        # The put fetched the missing key first
+        self.assertEqual(get['calls'], 4)
+        self.assertEqual(get['not_found'], 2)
+        self.assertEqual(get['keys'], 4)
+        self.assertLessEqual(get['p50'], get['p99'])
+        self.assertLessEqual(get['p99'], get['max'])
+        self.assertEqual(metrics.snapshot('Other'), {})
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram(bounds=(1, 2, 4, 8))
+        self.assertIsNone(histogram.percentile(0.5))
+        for value in [0.5] * 50 + [3] * 49 + [20]:
+            histogram.add(value)
+
+        self.assertEqual(histogram.percentile(0.5), 1)
+        self.assertEqual(histogram.percentile(0.99), 4)
+        self.assertEqual(histogram.percentile(1), 20)
+        self.assertEqual(histogram.total, 25 + 147 + 20)
@@ -0,0 +1,91 @@
+__author__ = 'max'
+
+import jsonpatch
+from copy import deepcopy
+from unittest import TestCase
+from drow.errors import InvalidPatch
+from drow.patch import apply_patch
+from drow.patch import compile_patch
+from drow.patch import parse_pointer
+from drow.patch import validate_patch
+
+
+class TestPatch(TestCase):
+    def test_parse_pointer(self):
+        self.assertEqual(parse_pointer(''), ())
+        self.assertEqual(
+            parse_pointer('/a~1b/~0c/0/01/-'),
+            (('a/b', None), ('~c', None), ('0', 0), ('01', None),
+             ('-', None)))
+        with self.assertRaises(InvalidPatch):
+            parse_pointer('a')
+
+    def test_shapes_are_compiled_once(self):
+        first = compile_patch(
+            [{'op': 'replace', 'path': '/count', 'value': 1}])
+        second = compile_patch(jsonpatch.JsonPatch(
+            [{'op': 'replace', 'path': '/count', 'value': 2}]))
+        self.assertIs(first.steps, second.steps)
+        self.assertEqual(second.values, [2])
+        self.assertIs(compile_patch(first), first)
+
+    def test_apply(self):
+        data = {'a': 1, 'b': {'c': [1, 2]}, 'd': 'd'}
+        operations = [
+            {'op': 'add', 'path': '/b/c/1', 'value': 5},
+            {'op': 'add', 'path': '/b/c/-', 'value': 6},
+            {'op': 'replace', 'path': '/a', 'value': 2},
+            {'op': 'remove', 'path': '/d'},
+            {'op': 'copy', 'from': '/b/c', 'path': '/e'},
+            {'op': 'move', 'from': '/b/c/0', 'path': '/f'},
+            {'op': 'test', 'path': '/a', 'value': 2}
+        ]
+        expected = jsonpatch.JsonPatch(operations).apply(deepcopy(data))
+
+        result = apply_patch(operations, data)
+        self.assertIs(result, data)
+        self.assertEqual(data, expected)
+        self.assertIsNot(data['e'], data['b']['c'])
+
+        self.assertEqual(
+            apply_patch([{'op': 'replace', 'path': '', 'value': [1]}], data),
+            [1])
+
+    def test_failed_patch_is_undone(self):
+        data = {'a': 1, 'b': {'c': [1, 2]}, 'd': 'd'}
+        original = deepcopy(data)
+
+        bad_patches = [
+            [{'op': 'add', 'path': '/a', 'value': 2}],
+            [{'op': 'remove', 'path': '/missing'}],
+            [{'op': 'replace', 'path': '/b/c/5', 'value': 1}],
+            [{'op': 'test', 'path': '/a', 'value': 5}],
+            [{'op': 'add', 'path': '/a/b', 'value': 1}],
+            [{'op': 'bad', 'path': '/a'}],
+            [{'op': 'add', 'path': '/x'}],
+            [{'op': 'move', 'path': '/x'}],
+            [{'op': 'remove', 'path': ''}]
+        ]
+        for operations in bad_patches:
+            operations = [
+                {'op': 'add', 'path': '/b/c/0', 'value': 0},
+                {'op': 'replace', 'path': '/a', 'value': 3},
+                {'op': 'remove', 'path': '/d'},
+                {'op': 'move', 'from': '/b/c/1', 'path': '/b/x'}
+            ] + operations
+            with self.assertRaises(InvalidPatch):
+                apply_patch(operations, data)
+            self.assertEqual(data, original)
+
+    def test_validate(self):
+        validate_patch([{'op': 'add', 'path': '/b/c', 'value': 1}], {'b': {}})
+        validate_patch([{'op': 'add', 'path': '/b/0', 'value': 1}], {'b': []})
+        with self.assertRaises(InvalidPatch):
+            validate_patch(
+                [{'op': 'add', 'path': '/b/c', 'value': 1}], {'b': {'c': 1}})
+        validate_patch([{'op': 'add', 'path': '/b/0', 'value': 1}],
+                       {'b': ['x']})
+        with self.assertRaises(InvalidPatch):
+            validate_patch([{'op': 'add', 'path': '', 'value': 1}], {})
+        with self.assertRaises(InvalidPatch):
+            validate_patch('not a patch', {})
@@ -0,0 +1,149 @@
+__author__ = 'max'
+
+from threading import Event
+from threading import Thread
+from time import sleep
+from time import time
+from unittest import TestCase
+from drow.errors import CancelledError
+from drow.errors import DeadlineExceeded
+from drow.pool import Executor
+from drow.pool import gather
+from drow.pool import run_concurrently
+from drow.pool import SingleFlight
+
+
+class TestRunConcurrently(TestCase):
+    def test_results_are_ordered(self):
+        def square(value):
+            if value == 3:
+                raise ValueError(value)
+            return value * value
+
+        for concurrency in (1, 4, 100):
+            results = run_concurrently(square, range(6), concurrency)
+            self.assertEqual(
+                [r for r, e in results], [0, 1, 4, None, 16, 25])
+            self.assertIsInstance(results[3][1], ValueError)
+            self.assertEqual(
+                [e for r, e in results if e is not None], [results[3][1]])
+
+    def test_empty(self):
+        self.assertEqual(run_concurrently(abs, []), [])
+
+
+class TestSingleFlight(TestCase):
+    def test_concurrent_calls_are_shared(self):
+        single_flight = SingleFlight()
+        started = Event()
+        release = Event()
+        calls = []
+
+        def slow_fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        results = []
+        leader = Thread(
+            target=lambda: results.append(single_flight.do('k', slow_fetch)))
+        leader.start()
+        started.wait(5)
+
+        followers = [
+            Thread(target=lambda: results.append(
+                single_flight.do('k', slow_fetch)))
+            for _ in range(3)
+        ]
+        for follower in followers:
+            follower.start()
+        while single_flight.shared < 3:
+            sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results),
+                         [('value', False)] + [('value', True)] * 3)
+
+        # Once finished, the next call does its own work
+        self.assertEqual(single_flight.do('k', lambda: 'new'), ('new', False))
+
+    def test_errors_are_shared(self):
+        single_flight = SingleFlight()
+        call, leader = single_flight.claim('k')
+        self.assertTrue(leader)
+        follower_call, leader = single_flight.claim('k')
+        self.assertFalse(leader)
+        self.assertIs(call, follower_call)
+
+        single_flight.finish('k', call, error=ValueError('failed'))
+        with self.assertRaises(ValueError):
+            follower_call.wait()
+
+        def fail():
+            raise KeyError('k')
+
+        with self.assertRaises(KeyError):
+            single_flight.do('k', fail)
+
+
+class TestExecutor(TestCase):
+    def test_calls_run_concurrently(self):
+        executor = Executor(max_workers=4)
+        release = Event()
+        futures = [executor.submit(release.wait, 5) for _ in range(4)]
+        self.assertFalse(any(f.done() for f in futures))
+        release.set()
+        self.assertEqual(gather(futures, timeout=5), [True] * 4)
+        self.assertLessEqual(len(executor._threads), 4)
+
+    def test_results_and_errors(self):
+        executor = Executor(max_workers=2)
+        future = executor.submit(int, '3')
+        self.assertEqual(future.result(5), 3)
+        self.assertTrue(future.done())
+
+        future = executor.submit(int, 'x')
+        with self.assertRaises(ValueError):
+            future.result(5)
+        self.assertIsInstance(future.exception(), ValueError)
+
+        done = []
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future])
+
+        results = gather([executor.submit(int, 'x'), executor.submit(abs, -1)],
+                         timeout=5, return_exceptions=True)
+        self.assertIsInstance(results[0], ValueError)
+        self.assertEqual(results[1], 1)
+
+    def test_cancel_and_deadlines(self):
+        executor = Executor(max_workers=1)
+        release = Event()
+        calls = []
+        blocker = executor.submit(release.wait, 5)
+        waiting = executor.submit(calls.append, 1)
+        expiring = executor.submit_before(time() + 0.01, calls.append, 2)
+
+        while not blocker.running():
+            sleep(0.001)
+        self.assertTrue(waiting.cancel())
+        self.assertTrue(waiting.cancelled())
+        with self.assertRaises(CancelledError):
+            waiting.result()
+        self.assertFalse(blocker.cancel())
+
+        with self.assertRaises(DeadlineExceeded):
+            blocker.result(timeout=0.01)
+        with self.assertRaises(DeadlineExceeded):
+            gather([blocker, expiring], timeout=0.01)
+
+        release.set()
+        self.assertTrue(blocker.result(5))
+        with self.assertRaises((DeadlineExceeded, CancelledError)):
+            expiring.result(5)
+        executor.submit(calls.append, 3).result(5)
+        self.assertEqual(calls, [3])
@@ -1,17 +1,27 @@
 __author__ = 'max'
 
 from riak import RiakError
+from riak.riak_object import VClock
 from unittest import TestCase
 from mock import patch
 from mock import MagicMock
 import jsonpatch
 from copy import deepcopy
+from threading import Event
+from threading import Thread
+from time import sleep
 from mockriak import create_mock_riak_client
 from mockriak import create_mock_riak_object
+from mockriak import use_real_riak_objects
+from drow import cache
 from drow import models
+from drow.cache import ObjectCache
 from drow.errors import DoesNotExist
 from drow.errors import InvalidPatch
+from drow.fields import AutoDateField
+from drow.fields import DefaultFalseField
 from drow.queryset import validate_patch
+from drow.queryset import solr_quote
 
 
 def get_nonexistant_object(key):
@@ -233,7 +243,9 @@ class TestQuerySet(TestCase):
 
             bucket.get.assert_called_with('test_key')
             self.assertEqual(MyModel._meta.creation_validator.call_count, 1)
-            self.assertEqual(bucket.get.call_count, 2)
+            # No field needs the stored object, so only the instance's own
+            # lazy load fetches it
+            self.assertEqual(bucket.get.call_count, 1)
             self.assertIs(result.data, data_to_store)
             MyModel._meta.storage_validator.assert_called_once_with(
                 data_to_store)
@@ -255,7 +267,7 @@ class TestQuerySet(TestCase):
 
             bucket.get.assert_called_with('test_key')
             MyModel._meta.creation_validator.called_once_with(data_to_store)
-            self.assertEqual(bucket.get.call_count, 2)
+            self.assertEqual(bucket.get.call_count, 1)
             self.assertIs(result.data, data_to_store)
             MyModel._meta.storage_validator.assert_called_once_with(
                 data_to_store)
@@ -288,3 +300,773 @@ class TestQuerySet(TestCase):
             instance.save()
             instance.delete()
             self.assertEqual(instance._state.riak_object.delete.call_count, 1)
+
+    def test_get_many(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+
+            def get_side_effect(key):
+                if key == 'missing':
+                    return get_nonexistant_object(key)
+                return create_mock_riak_object(key)
+
+            def multiget_side_effect(keys):
+                # Riak returns results in completion order, with failures
+                # reported as tuples
+                results = [get_side_effect(k) for k in reversed(keys)
+                           if k != 'broken']
+                if 'broken' in keys:
+                    results.append(
+                        ('type', 'bucket', 'broken', RiakError('timeout')))
+                return results
+
+            bucket.get.side_effect = get_side_effect
+            bucket.multiget.side_effect = multiget_side_effect
+
+            results = MyModel.objects.get_many(
+                ['a', 'missing', 'b', 'broken', 'a'])
+
+            self.assertEqual(bucket.multiget.call_count, 1)
+            self.assertEqual(bucket.get.call_count, 0)
+            self.assertEqual([o.key for o in results], ['a', 'b'])
+            self.assertEqual(list(results.errors), ['missing', 'broken'])
+            self.assertIsInstance(results.errors['missing'], DoesNotExist)
+            self.assertIsInstance(results.errors['broken'], RiakError)
+            self.assertEqual(list(results.as_dict()), ['a', 'b'])
+            repr(results)
+
+            results = MyModel.objects.get_many(
+                ['a', 'missing', 'b'], must_exist=False, concurrency=2)
+            self.assertEqual(bucket.multiget.call_count, 1)
+            self.assertEqual(bucket.get.call_count, 3)
+            self.assertEqual(
+                [o.key for o in results], ['a', 'missing', 'b'])
+            self.assertFalse(results.errors)
+
+    def test_create_many(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+            keys = iter(['k1', 'k2', 'k3'])
+
+            def new_side_effect(key=None, data=None, *args, **kwargs):
+                riak_object = create_mock_riak_object(next(keys))
+                riak_object.data = data
+                if data.get('fail_store'):
+                    riak_object.store.side_effect = RiakError('store failed')
+                return riak_object
+
+            def creation_validator(data):
+                if data.get('invalid'):
+                    raise ValueError('invalid')
+
+            bucket.new.side_effect = new_side_effect
+            MyModel._meta.creation_validator.side_effect = creation_validator
+
+            data = [
+                {'a': 1},
+                {'invalid': True},
+                {'fail_store': True},
+                {'a': 2}
+            ]
+            results = MyModel.objects.create_many(data, concurrency=2)
+
+            # Validation happens for everything before any object is created
+            self.assertEqual(MyModel._meta.creation_validator.call_count, 4)
+            self.assertEqual(bucket.new.call_count, 3)
+            self.assertEqual([o.key for o in results], ['k1', 'k3'])
+            self.assertEqual([o.data for o in results], [{'a': 1}, {'a': 2}])
+            self.assertEqual(list(results.errors), [1, 2])
+            self.assertIsInstance(results.errors[1], ValueError)
+            self.assertIsInstance(results.errors[2], RiakError)
+
+    def test_put_many(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+
+            def get_side_effect(key):
+                if key == 'new':
+                    return get_nonexistant_object(key)
+                riak_object = create_mock_riak_object(key)
+                riak_object.data = {'old': True}
+                if key == 'fail_store':
+                    riak_object.store.side_effect = RiakError('store failed')
+                return riak_object
+
+            def creation_validator(data):
+                if data.get('invalid'):
+                    raise ValueError('invalid')
+
+            bucket.multiget.side_effect = \
+                lambda keys: [get_side_effect(k) for k in keys]
+            MyModel._meta.creation_validator.side_effect = creation_validator
+
+            results = MyModel.objects.put_many([
+                ('existing', {'a': 1}),
+                ('invalid', {'invalid': True}),
+                ('fail_store', {'a': 2}),
+                ('new', {'a': 3})
+            ])
+
+            self.assertEqual(bucket.multiget.call_count, 1)
+            self.assertEqual(
+                sorted(bucket.multiget.call_args[0][0]),
+                ['existing', 'fail_store', 'new'])
+            self.assertEqual(bucket.get.call_count, 0)
+            self.assertEqual([o.key for o in results], ['existing', 'new'])
+            self.assertEqual([o.data for o in results], [{'a': 1}, {'a': 3}])
+            self.assertEqual(results[0]._state.riak_object.store.call_count, 1)
+            self.assertEqual(
+                results[1]._state.riak_object.content_type,
+                'application/x.content')
+            self.assertEqual(list(results.errors), ['invalid', 'fail_store'])
+
+            results = MyModel.objects.put_many({'x': {'a': 1}})
+            self.assertEqual([o.key for o in results], ['x'])
+
+    def test_delete_many(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+            old_new_side_effect = bucket.new.side_effect
+
+            def new_side_effect(key=None, *args, **kwargs):
+                riak_object = old_new_side_effect(key, *args, **kwargs)
+                if key == 'fail':
+                    riak_object.delete.side_effect = RiakError('failed')
+                else:
+                    riak_object.delete.return_value = riak_object
+                return riak_object
+
+            bucket.new.side_effect = new_side_effect
+
+            results = MyModel.objects.delete_many(
+                ['a', 'fail', 'b', 'a'], concurrency=3)
+
+            self.assertEqual([o.key for o in results], ['a', 'b'])
+            self.assertEqual(list(results.errors), ['fail'])
+            for key in ('a', 'b', 'fail'):
+                self.assertEqual(
+                    bucket._get_record[key].delete.call_count, 1)
+
+    def test_delete_where(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+            # 'c' has a sibling, so it is indexed twice
+            indexed = ['a', 'b', 'c', 'c', 'd', 'e']
+
+            def search_side_effect(query, index=None, **params):
+                self.assertEqual(params['sort'], '_yz_rk asc')
+                self.assertEqual(params['fl'], '_yz_rk')
+                self.assertNotIn('start', params)
+                docs = indexed
+                if 'filter' in params:
+                    last = params['filter'].split('"')[1]
+                    docs = [k for k in indexed if k > last]
+                return {
+                    'num_found': len(docs),
+                    'docs': [{'_yz_rk': k} for k in docs[:params['rows']]]
+                }
+
+            bucket.search.side_effect = search_side_effect
+
+            deleted = MyModel.objects.delete_where('expired:true', page_size=2)
+
+            self.assertEqual(deleted, 5)
+            self.assertEqual(bucket.search.call_count, 4)
+            self.assertEqual(
+                bucket.search.call_args_list[1][1]['filter'],
+                u'_yz_rk:{"b" TO *]')
+            for key in ('a', 'b', 'c', 'd', 'e'):
+                self.assertEqual(
+                    bucket._get_record[key].delete.call_count, 1)
+
+            bucket._get_record['b'].delete.side_effect = RiakError('failed')
+            with self.assertRaises(MyModel.BulkError) as raised:
+                MyModel.objects.delete_where('expired:true', page_size=2)
+            self.assertEqual(list(raised.exception.errors), ['b'])
+            self.assertEqual(bucket._get_record['e'].delete.call_count, 2)
+
+    def test_solr_quote(self):
+        self.assertEqual(solr_quote('a"b\\c'), u'"a\\"b\\\\c"')
+
+    def test_search_iter(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+            indexed = ['a', 'b', 'b', 'c', 'd', 'gone']
+
+            def search_side_effect(query, index=None, **params):
+                docs = indexed
+                if 'filter' in params:
+                    last = params['filter'].split('"')[1]
+                    docs = [k for k in indexed if k > last]
+                return {
+                    'num_found': len(docs),
+                    'docs': [{'_yz_rk': k} for k in docs[:params['rows']]]
+                }
+
+            second_page_fetched = Event()
+
+            def multiget_side_effect(keys):
+                if 'c' in keys:
+                    second_page_fetched.set()
+                return [get_nonexistant_object(k) if k == 'gone'
+                        else create_mock_riak_object(k) for k in keys]
+
+            bucket.search.side_effect = search_side_effect
+            bucket.multiget.side_effect = multiget_side_effect
+
+            results = MyModel.objects.search_iter('query', page_size=2)
+            self.assertEqual(bucket.search.call_count, 0)
+
+            first = next(results)
+            self.assertEqual(first.key, 'a')
+            # The next page is fetched while the first is being consumed
+            self.assertTrue(second_page_fetched.wait(5))
+
+            self.assertEqual([o.key for o in results], ['b', 'c', 'd'])
+            self.assertEqual(bucket.search.call_count, 3)
+
+            bucket.multiget.side_effect = lambda keys: [
+                ('type', 'bucket', k, RiakError('timeout')) for k in keys]
+            with self.assertRaises(RiakError):
+                list(MyModel.objects.search_iter('query', page_size=2))
+
+    def test_search_cursor(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+
+            def search_side_effect(*args, **kwargs):
+                docs = [
+                    {'_yz_rk': 'b', 'age': u'7'},
+                    {'_yz_rk': 'a', 'age': u'5'},
+                    {'_yz_rk': 'a', 'age': u'5'},
+                ]
+                if 'filter' in kwargs:
+                    docs = []
+                return {'num_found': 10, 'docs': docs[:kwargs['rows']]}
+
+            bucket.search.side_effect = search_side_effect
+
+            results = MyModel.objects.search('q', rows=2, sort='age desc')
+            bucket.search.assert_called_once_with(
+                'q', index='my_search_index', start=0, rows=2,
+                sort='age desc, _yz_rk asc')
+            # Solr order is kept
+            self.assertEqual([o.key for o in results], ['b', 'a'])
+            self.assertTrue(results.cursor)
+
+            MyModel.objects.search(
+                'q', rows=2, sort='age desc', cursor=results.cursor)
+            self.assertEqual(
+                bucket.search.call_args[1]['filter'],
+                u'age:[* TO "5"} OR (age:"5" AND _yz_rk:{"a" TO *])')
+
+            # A short page has no following page
+            results = MyModel.objects.search('q', rows=4, sort='age desc')
+            self.assertIsNone(results.cursor)
+            self.assertIsNone(MyModel.objects.search('q', rows=3).cursor)
+
+            with self.assertRaises(MyModel.SearchError):
+                MyModel.objects.search('q', cursor='abc')
+            with self.assertRaises(MyModel.SearchError):
+                MyModel.objects.search(
+                    'q', start=3, sort='age desc', cursor='abc')
+            with self.assertRaises(MyModel.SearchError):
+                MyModel.objects.search('q', sort='age desc', cursor='!!')
+            with self.assertRaises(MyModel.SearchError):
+                MyModel.objects.search('q', sort='age sideways')
+            with self.assertRaises(MyModel.SearchError):
+                MyModel.objects.search('q', rows=1, sort='name asc')
+
+    def test_search_fields(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+
+            def search_side_effect(*args, **kwargs):
+                docs = [
+                    {'_yz_rk': 'b', 'name': u'bob', 'age': u'7'},
+                    {'_yz_rk': 'a', 'name': u'al', 'age': u'5'},
+                    {'_yz_rk': 'a', 'name': u'al2', 'age': u'5'},
+                ]
+                if 'filter' in kwargs:
+                    docs = []
+                return {'num_found': 3, 'docs': docs[:kwargs['rows']]}
+
+            bucket.search.side_effect = search_side_effect
+
+            results = MyModel.objects.search('q', fields=['name', 'missing'])
+            bucket.search.assert_called_once_with(
+                'q', index='my_search_index', start=0, rows=20,
+                fl='_yz_rk,name,missing')
+            self.assertEqual(bucket.multiget.call_count, 0)
+            self.assertEqual([r.key for r in results], ['b', 'a'])
+            self.assertEqual(results[1]['name'], u'al')
+            self.assertEqual(dict(results[0].items()), {'name': u'bob'})
+            self.assertNotIn('age', results[0])
+            self.assertIsNone(results[0].get('missing'))
+            with self.assertRaises(AttributeError):
+                results[0].data = {}
+            repr(results)
+
+            results = MyModel.objects.search(
+                'q', rows=2, fields=['name'], sort='age asc')
+            self.assertEqual(
+                bucket.search.call_args[1]['fl'], '_yz_rk,name,age')
+            self.assertTrue(results.cursor)
+
+    def test_count(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+            bucket.search.return_value = {'num_found': 42, 'docs': []}
+            bucket.search.side_effect = None
+
+            self.assertEqual(MyModel.objects.count('q'), 42)
+            bucket.search.assert_called_once_with(
+                'q', index='my_search_index', rows=0)
+            self.assertEqual(bucket.multiget.call_count, 0)
+
+    def test_search_overfetch(self):
+        with FakeModelContext() as context:
+            MyModel, settings = context
+            bucket = MyModel.objects._state.bucket
+            # Every object has a sibling, so is indexed twice
+            indexed = [k for k in 'abcdefghij' for _ in range(2)]
+
+            def search_side_effect(query, index=None, start=0, rows=10,
+                                   **kwargs):
+                return {
+                    'num_found': len(indexed),
+                    'docs': [{'_yz_rk': k} for k in indexed[start:][:rows]]
+                }
+
+            bucket.search.side_effect = search_side_effect
+
+            results = MyModel.objects.search('q', rows=3)
+            self.assertEqual([o.key for o in results], ['a', 'b', 'c'])
+            self.assertEqual(results.next_start, 5)
+            self.assertEqual(results.num_found, 20)
+            self.assertEqual(
+                [c[1]['start'] for c in bucket.search.call_args_list],
+                [0, 3])
+            self.assertEqual(
+                [c[1]['rows'] for c in bucket.search.call_args_list],
+                [3, 2])
+
+            # Having seen siblings, the next search asks for more results
+            # up front
+            stats = MyModel.objects._state.search_stats
+            self.assertEqual(stats.overfetch(3), 4)
+            bucket.search.reset_mock()
+            results = MyModel.objects.search('q', start=6, rows=3)
+            self.assertEqual([o.key for o in results], ['d', 'e', 'f'])
+            self.assertEqual(results.next_start, 12)
+            self.assertEqual(bucket.search.call_count, 2)
+
+            # Running out of results ends the search early
+            bucket.search.reset_mock()
+            results = MyModel.objects.search('q', start=16, rows=3)
+            self.assertEqual([o.key for o in results], ['i', 'j'])
+            self.assertEqual(results.next_start, 20)
+            self.assertEqual(
+                [c[1]['start'] for c in bucket.search.call_args_list],
+                [16, 20])
+
+    @patch.object(models, 'settings')
+    def test_cache(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+        object_cache = ObjectCache(ttl=60, revalidate=True)
+
+        class CachedModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                cache = object_cache
+
+        bucket = CachedModel.objects._state.bucket
+        stored = {}
+        use_real_riak_objects(bucket, stored)
+
+        stored['a'] = {'value': 1}
+        stored['b'] = {'value': 2}
+
+        first = CachedModel.objects.get('a', active=True)
+        first.data['value'] = 'unsaved change'
+        second = CachedModel.objects.get('a', active=True)
+        self.assertEqual(bucket.get.call_count, 1)
+        self.assertEqual(second.data, {'value': 1})
+        self.assertIsNot(second._state.riak_object, first._state.riak_object)
+        self.assertEqual(
+            second._state.riak_object.vclock.encode('binary'), 'vclock-a')
+
+        results = CachedModel.objects.get_many(['a', 'b'])
+        self.assertEqual([o.data for o in results], [{'value': 1},
+                                                      {'value': 2}])
+        bucket.multiget.assert_called_once_with(['b'])
+        CachedModel('b').data
+        self.assertEqual(bucket.get.call_count, 1)
+
+        # Writes go through to the cache
+        CachedModel.objects.put('a', {'value': 3})
+        self.assertEqual(CachedModel('a').data, {'value': 3})
+        self.assertEqual(bucket.get.call_count, 1)
+
+        # Deletes invalidate it
+        CachedModel.objects.delete('a')
+        self.assertNotIn('a', object_cache)
+
+        # Expired entries are revalidated by vclock
+        with patch.object(cache, 'time') as time:
+            time.return_value = 10 ** 10
+            self.assertEqual(CachedModel('b').data, {'value': 2})
+            self.assertEqual(bucket.get.call_count, 2)
+            self.assertEqual(object_cache.get('b')[1], False)
+
+    @patch.object(models, 'settings')
+    def test_negative_cache(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                negative_cache = ObjectCache(ttl=5)
+
+        negative_cache = MyModel._meta.negative_cache
+        bucket = MyModel.objects._state.bucket
+        stored = {'b': {'value': 2}}
+        use_real_riak_objects(bucket, stored)
+
+        for _ in range(3):
+            with self.assertRaises(DoesNotExist):
+                MyModel.objects.get('a', active=True)
+        self.assertEqual(bucket.get.call_count, 1)
+        self.assertEqual(negative_cache.hits, 2)
+
+        results = MyModel.objects.get_many(['a', 'b'])
+        self.assertEqual(list(results.errors), ['a'])
+        bucket.multiget.assert_called_once_with(['b'])
+
+        # Storing the key removes it from the negative cache
+        MyModel.objects.put('a', {'value': 1})
+        self.assertNotIn('a', negative_cache)
+        self.assertEqual(bucket.get.call_count, 1)
+
+        # Deleting it puts it back
+        MyModel.objects.delete('b')
+        self.assertIn('b', negative_cache)
+        instance = MyModel.objects.get('b', active=True, must_exist=False)
+        self.assertFalse(instance._state.riak_object.exists)
+        self.assertEqual(bucket.get.call_count, 1)
+
+    @patch.object(models, 'settings')
+    def test_blind_put(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+            modified = AutoDateField()
+            flag = DefaultFalseField()
+
+        bucket = MyModel.objects._state.bucket
+        stored = {'a': {'value': 1}}
+        use_real_riak_objects(bucket, stored)
+
+        self.assertFalse(MyModel._meta.put_needs_read)
+        vclock = VClock('vclock-a', 'binary')
+        instance = MyModel.objects.put('a', {'value': 2}, vclock=vclock)
+        self.assertEqual(bucket.get.call_count, 0)
+        self.assertIs(instance._state.riak_object.vclock, vclock)
+        self.assertEqual(instance.data['value'], 2)
+        self.assertIn('modified', instance.data)
+        self.assertIs(instance.data['flag'], False)
+
+        # Without a known vclock, the stored object is fetched so that the
+        # write replaces it rather than becoming a sibling
+        instance = MyModel.objects.put('a', {'value': 3})
+        self.assertEqual(bucket.get.call_count, 1)
+        self.assertEqual(
+            instance._state.riak_object.vclock.encode('binary'), 'vclock-a')
+        results = MyModel.objects.put_many({'a': {'value': 3}})
+        self.assertEqual(bucket.multiget.call_count, 1)
+        self.assertEqual(results[0].data['value'], 3)
+
+        MyModel._meta.blind_puts = True
+        results = MyModel.objects.put_many({'a': {'value': 4}})
+        MyModel.objects.put('a', {'value': 4})
+        self.assertEqual(bucket.multiget.call_count, 1)
+        self.assertEqual(bucket.get.call_count, 1)
+        self.assertIsNone(results[0]._state.riak_object.vclock)
+        MyModel._meta.blind_puts = False
+
+        # save passes on the vclock of the version it loaded
+        instance = MyModel('a')
+        instance.data['value'] = 4
+        result = instance.save()
+        self.assertEqual(bucket.get.call_count, 2)
+        self.assertEqual(
+            result._state.riak_object.vclock.encode('binary'), 'vclock-a')
+
+        # A cached object's vclock is used too
+        MyModel._meta.cache = ObjectCache()
+        MyModel.objects.get('a', active=True)
+        instance = MyModel.objects.put('a', {'value': 5})
+        self.assertEqual(bucket.get.call_count, 3)
+        self.assertEqual(
+            instance._state.riak_object.vclock.encode('binary'), 'vclock-a')
+
+    @patch.object(models, 'settings')
+    def test_put_needing_read(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+            created = AutoDateField(only_on_creation=True)
+
+        bucket = MyModel.objects._state.bucket
+        stored = {'a': {'value': 1, 'created': 'then'}}
+        use_real_riak_objects(bucket, stored)
+
+        self.assertTrue(MyModel._meta.put_needs_read)
+        instance = MyModel.objects.put('a', {'value': 2})
+        self.assertEqual(bucket.get.call_count, 1)
+        self.assertEqual(instance.data, {'value': 2, 'created': 'then'})
+
+        results = MyModel.objects.put_many({'a': {'value': 3}})
+        self.assertEqual(bucket.multiget.call_count, 1)
+        self.assertEqual(results[0].data, {'value': 3, 'created': 'then'})
+
+    @patch.object(models, 'settings')
+    def test_instance_save_and_patch(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+            created = AutoDateField(only_on_creation=True)
+
+        bucket = MyModel.objects._state.bucket
+        stored = {'a': {'value': 1, 'created': 'then'}}
+        use_real_riak_objects(bucket, stored)
+
+        instance = MyModel.objects.get('a', active=True)
+        instance.data['value'] = 2
+        instance.data['created'] = 'now'
+        self.assertIs(instance.save(), instance)
+        self.assertEqual(instance.data, {'value': 2, 'created': 'then'})
+
+        patch = jsonpatch.make_patch(instance.data, {'value': 3})
+        self.assertIs(instance.patch(patch), instance)
+        self.assertEqual(instance.data, {'value': 3, 'created': 'then'})
+
+        # Neither needed to fetch the object again
+        self.assertEqual(bucket.get.call_count, 1)
+        self.assertEqual(instance._state.riak_object.store.call_count, 2)
+        self.assertEqual(
+            instance._state.riak_object.vclock.encode('binary'), 'vclock-a')
+
+        # A new object is saved as a creation
+        instance = MyModel('b')
+        instance.data = {'value': 1}
+        instance.save()
+        self.assertNotEqual(instance.data['created'], None)
+        self.assertEqual(bucket.get.call_count, 2)
+
+    @patch.object(models, 'settings')
+    def test_save_conflict(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                check_conflicts = True
+
+        bucket = MyModel.objects._state.bucket
+        stored = {'a': {'value': 1}}
+        use_real_riak_objects(bucket, stored)
+
+        # Unchanged since it was loaded
+        instance = MyModel('a')
+        instance.data['value'] = 2
+        instance.save()
+        self.assertEqual(bucket.get.call_count, 2)
+        self.assertEqual(instance._state.riak_object.store.call_count, 1)
+
+        # Changed by someone else since it was loaded
+        get_side_effect = bucket.get.side_effect
+
+        def changed_get(key):
+            riak_object = get_side_effect(key)
+            riak_object.vclock = VClock('changed', 'binary')
+            return riak_object
+
+        bucket.get.side_effect = changed_get
+        instance.data['value'] = 3
+        with self.assertRaises(MyModel.WriteConflict):
+            instance.save()
+        self.assertEqual(instance._state.riak_object.store.call_count, 1)
+        instance.save(check_conflict=False)
+        self.assertEqual(instance._state.riak_object.store.call_count, 2)
+
+        # Created by someone else since it was found not to exist
+        instance = MyModel('b')
+        instance.data = {'value': 1}
+        instance._state.riak_object.store.side_effect = \
+            RiakError('match_found')
+        with self.assertRaises(MyModel.WriteConflict):
+            instance.save()
+        instance._state.riak_object.store.assert_called_once_with(
+            if_none_match=True)
+
+    @patch.object(models, 'settings')
+    def test_dirty_tracking(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+        bucket = MyModel.objects._state.bucket
+        stored = {'a': {'same': 1, 'changed': {'x': 1}, 'removed': 1}}
+        use_real_riak_objects(bucket, stored)
+
+        instance = MyModel('a')
+        self.assertFalse(instance.is_dirty)
+        instance.save()
+        self.assertFalse(instance.is_dirty)
+        self.assertEqual(instance._state.riak_object.store.call_count, 0)
+
+        instance.data['changed']['x'] = 2
+        del instance.data['removed']
+        instance.data['added/key'] = 1
+        self.assertTrue(instance.is_dirty)
+        self.assertEqual(
+            instance.changed_keys, {'changed', 'removed', 'added/key'})
+        self.assertEqual(instance.changes(), [
+            {'op': 'add', 'path': '/added~1key', 'value': 1},
+            {'op': 'replace', 'path': '/changed', 'value': {'x': 2}},
+            {'op': 'remove', 'path': '/removed'}
+        ])
+
+        instance.save()
+        self.assertEqual(instance._state.riak_object.store.call_count, 1)
+        self.assertFalse(instance.is_dirty)
+        self.assertEqual(instance.changed_keys, set())
+        instance.save(force=True)
+        self.assertEqual(instance._state.riak_object.store.call_count, 2)
+
+        # Changes made through a reference held from before a save count
+        data = instance.data
+        data['same'] = 2
+        instance.save()
+        data['same'] = 3
+        self.assertTrue(instance.is_dirty)
+        self.assertEqual(instance.changed_keys, {'same'})
+        instance.save()
+        self.assertEqual(instance._state.riak_object.store.call_count, 4)
+
+        # Objects that don't exist yet are always saved
+        instance = MyModel('b')
+        self.assertFalse(instance.is_dirty)
+        instance.data = {}
+        self.assertTrue(instance.is_dirty)
+        instance.save()
+        self.assertEqual(instance._state.riak_object.store.call_count, 1)
+
+        MyModel._meta.track_changes = False
+        instance = MyModel.objects.get('a', active=True)
+        self.assertTrue(instance.is_dirty)
+        self.assertEqual(instance.changed_keys, set())
+
+    @patch.object(models, 'settings')
+    def test_coalesced_fetches(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                coalesce_fetches = True
+                copy_coalesced_fetches = True
+
+        bucket = MyModel.objects._state.bucket
+        stored = {'a': {'value': 1}, 'b': {'value': 2}}
+        use_real_riak_objects(bucket, stored)
+        single_flight = MyModel.objects._state.single_flight
+
+        # Pretend another caller is already fetching 'a'
+        call, leader = single_flight.claim('a')
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(
+                MyModel.objects.get('a', active=True))),
+            Thread(target=lambda: results.extend(
+                MyModel.objects.get_many(['a', 'b'])))
+        ]
+        for thread in threads:
+            thread.start()
+        while single_flight.shared < 2:
+            sleep(0.001)
+
+        fetched = bucket.get('a')
+        single_flight.finish('a', call, fetched)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(bucket.get.call_count, 1)
+        bucket.multiget.assert_called_once_with(['b'])
+        self.assertEqual(
+            sorted((o.key, o.data) for o in results),
+            [('a', {'value': 1}), ('a', {'value': 1}), ('b', {'value': 2})])
+        # Each caller got its own copy
+        for instance in results:
+            self.assertIsNot(instance._state.riak_object, fetched)
+            self.assertTrue(instance._state.riak_object.exists)
+        self.assertEqual(
+            results[0]._state.riak_object.vclock.encode('binary'),
+            'vclock-a')
+
+        # Fetches are no longer shared once they are done
+        MyModel.objects.get('a', active=True)
+        self.assertEqual(bucket.get.call_count, 2)
+
+    @patch.object(models, 'settings')
+    def test_coalesced_multiget_failure_releases_waiters(self, settings):
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                coalesce_fetches = True
+
+        use_real_riak_objects(MyModel.objects._state.bucket, {'a': {}})
+        single_flight = MyModel.objects._state.single_flight
+
+        with patch.object(MyModel.objects, '_cache_update') as cache_update:
+            cache_update.side_effect = ValueError('cache failed')
+            with self.assertRaises(ValueError):
+                MyModel.objects.get_many(['a', 'b'])
+
+        # Both calls were finished, so new fetches lead again
+        for key in ['a', 'b']:
+            call, leader = single_flight.claim(key)
+            self.assertTrue(leader)
+            single_flight.finish(key, call)
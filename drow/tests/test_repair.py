@@ -0,0 +1,159 @@
+__author__ = 'max'
+
+from time import sleep
+from time import time
+from unittest import TestCase
+from mock import patch
+from riak.content import RiakContent
+from riak.riak_object import RiakObject
+from riak.riak_object import VClock
+from mockriak import create_mock_riak_client
+from mockriak import use_real_riak_objects
+from drow import models
+from drow.repair import ReadRepair
+from drow.resolvers import JsonResolver
+
+
+def wait_for(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            raise AssertionError('Timed out')
+        sleep(0.001)
+
+
+class TestReadRepair(TestCase):
+    def setUp(self):
+        self.patcher = patch.object(models, 'settings')
+        settings = self.patcher.start()
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def create_model(self, read_repair):
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                write_back_resolved = read_repair
+
+        bucket = MyModel.objects._state.bucket
+        use_real_riak_objects(bucket, {})
+        bucket.stored = []
+        new_side_effect = bucket.new.side_effect
+
+        def recording_new(*args, **kwargs):
+            riak_object = new_side_effect(*args, **kwargs)
+            bucket.stored.append(riak_object)
+            return riak_object
+
+        bucket.new.side_effect = recording_new
+        return MyModel, bucket
+
+    def read_siblings(self, bucket, key='a'):
+        """
+        Decode an object with siblings the way the Riak client does
+        """
+        riak_object = RiakObject(None, bucket, key)
+        riak_object.vclock = VClock('vclock-' + key, 'binary')
+        siblings = []
+        for i, data in enumerate([{'a': 1}, {'b': 2}]):
+            sibling = RiakContent(riak_object)
+            sibling.content_type = 'application/json'
+            sibling.last_modified = 1000 + i
+            sibling.data = data
+            sibling.usermeta = {'i': str(i)}
+            siblings.append(sibling)
+        riak_object.siblings = siblings
+        riak_object.resolver(riak_object)
+        return riak_object
+
+    def test_resolved_objects_are_written_back(self):
+        read_repair = ReadRepair()
+        MyModel, bucket = self.create_model(read_repair)
+
+        riak_object = self.read_siblings(bucket)
+        self.assertEqual(riak_object.data, {'a': 1, 'b': 2})
+        wait_for(lambda: read_repair.repairs)
+
+        self.assertEqual(len(bucket.stored), 1)
+        stored = bucket.stored[0]
+        self.assertIsNot(stored, riak_object)
+        self.assertEqual(stored.key, 'a')
+        self.assertEqual(stored.data, {'a': 1, 'b': 2})
+        self.assertEqual(stored.vclock.encode('binary'), 'vclock-a')
+        self.assertEqual(stored.usermeta, {'i': '0'})
+        stored.store.assert_called_once_with(return_body=False)
+        self.assertEqual(MyModel.objects.resolver_stats.resolutions, 1)
+
+    def test_rate_limited_per_key(self):
+        read_repair = ReadRepair(min_interval=60)
+        MyModel, bucket = self.create_model(read_repair)
+
+        self.read_siblings(bucket, 'a')
+        wait_for(lambda: read_repair.repairs)
+        self.read_siblings(bucket, 'a')
+        self.read_siblings(bucket, 'b')
+        wait_for(lambda: read_repair.repairs == 2)
+
+        self.assertEqual(read_repair.skipped, 1)
+        self.assertEqual([o.key for o in bucket.stored], ['a', 'b'])
+
+    def test_deduplicated_while_pending(self):
+        read_repair = ReadRepair()
+        MyModel, bucket = self.create_model(read_repair)
+
+        with read_repair._flush_lock:
+            self.read_siblings(bucket, 'a')
+            riak_object = self.read_siblings(bucket, 'a')
+            riak_object.data['c'] = 3
+            self.assertEqual(len(read_repair), 1)
+
+        wait_for(lambda: read_repair.repairs)
+        read_repair.close()
+        self.assertEqual(len(bucket.stored), 1)
+        self.assertEqual(bucket.stored[0].data, {'a': 1, 'b': 2})
+
+    def test_errors(self):
+        read_repair = ReadRepair()
+        MyModel, bucket = self.create_model(read_repair)
+        bucket.new.side_effect = ValueError('down')
+
+        self.read_siblings(bucket, 'a')
+        wait_for(lambda: read_repair.errors)
+        self.assertIsInstance(read_repair.errors['a'], ValueError)
+        self.assertEqual(read_repair.repairs, 0)
+
+    def test_encoding_errors_dont_fail_reads(self):
+        read_repair = ReadRepair()
+        MyModel, bucket = self.create_model(read_repair)
+
+        bucket.get_encoder.return_value = None
+        riak_object = self.read_siblings(bucket, 'a')
+        self.assertEqual(riak_object.data, {'a': 1, 'b': 2})
+        self.assertIsInstance(read_repair.errors['a'], TypeError)
+
+        bucket.get_encoder.return_value = lambda data: 1 / 0
+        self.read_siblings(bucket, 'b')
+        self.assertIsInstance(read_repair.errors['b'], ZeroDivisionError)
+
+        self.assertEqual(len(read_repair), 0)
+        self.assertEqual(bucket.stored, [])
+
+    def test_configuration(self):
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                write_back_resolved = True
+
+        self.assertIsInstance(MyModel._meta.write_back_resolved, ReadRepair)
+
+        class OtherModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+        self.assertIsInstance(
+            OtherModel.objects._state.bucket.resolver, JsonResolver)
@@ -3,6 +3,30 @@ __author__ = 'max'
 from unittest import TestCase
 from time import time
 from mockriak import create_mock_riak_object
+from mockriak import create_mock_riak_client
+from mock import patch
+from drow import models
+from drow.resolvers import JsonResolver
+from drow.resolvers import ResolverStats
+
+
+def create_siblings(*versions):
+    """
+    :param versions: The data of each sibling, oldest first
+    :return: A mock Riak object with the siblings
+    """
+    root_object = create_mock_riak_object()
+    now = time()
+    siblings = []
+    for i, data in enumerate(versions):
+        sibling = create_mock_riak_object()
+        sibling.last_modified = now + i
+        sibling.data = data
+        sibling._encoded_data = None
+        siblings.append(sibling)
+    # most recent first tests sort
+    root_object.siblings = list(reversed(siblings))
+    return root_object
 
 
 class TestDefaultResolver(TestCase):
@@ -204,3 +228,102 @@ class TestSetResolver(TestCase):
         # Combining a bunch of empty dictionaries should yield an empty
         # dictionary
         self.assertEqual(r, {})
+
+
+class TestJsonResolver(TestCase):
+    def test_set_of_dictionaries(self):
+        root_object = create_siblings(
+            {'i': [{'a': 1}, {'b': [1, 2]}]},
+            {'i': [{'b': [1, 2]}, {'a': True}, 1]},
+            {'i': [True, {'a': 1}]})
+
+        JsonResolver(as_set=True)(root_object)
+
+        self.assertEqual(len(root_object.siblings), 1)
+        self.assertEqual(
+            root_object.siblings[0].data,
+            {'i': [{'a': 1}, {'b': [1, 2]}, {'a': True}, 1, True]})
+
+    def test_newer_value_replaces_older_types(self):
+        root_object = create_siblings(
+            {'a': {'b': 1}, 'c': [1], 'd': 1},
+            {'a': 'scalar', 'c': {'x': 1}, 'd': {'y': 1}},
+            {'a': {'e': 2}, 'c': {'z': 1}})
+
+        JsonResolver(as_set=True)(root_object)
+
+        self.assertEqual(root_object.siblings[0].data, {
+            'a': {'e': 2},
+            'c': {'x': 1, 'z': 1},
+            'd': {'y': 1}
+        })
+
+    def test_depth_guard(self):
+        stats = ResolverStats()
+        root_object = create_siblings(
+            {'a': {'b': {'c': 1}}, 'old': 1},
+            {'a': {'b': {'d': 2}}})
+        newest = root_object.siblings[0]
+
+        JsonResolver(max_depth=2, stats=stats)(root_object)
+
+        self.assertEqual(root_object.siblings, [newest])
+        self.assertEqual(newest.data, {'a': {'b': {'d': 2}}})
+        self.assertEqual(stats.fallbacks, 1)
+
+        root_object = create_siblings(
+            {'a': {'b': {'c': 1}}, 'old': 1},
+            {'a': {'b': {'d': 2}}})
+        JsonResolver(max_depth=3, stats=stats)(root_object)
+        self.assertEqual(root_object.siblings[0].data,
+                         {'a': {'b': {'c': 1, 'd': 2}}, 'old': 1})
+        self.assertEqual(stats.fallbacks, 1)
+
+    def test_size_guard(self):
+        stats = ResolverStats()
+        root_object = create_siblings({'a': 1}, {'b': 2})
+        for sibling in root_object.siblings:
+            sibling._encoded_data = '{"x": 1}'
+        newest = root_object.siblings[0]
+
+        JsonResolver(max_bytes=10, stats=stats)(root_object)
+
+        self.assertEqual(root_object.siblings, [newest])
+        self.assertEqual(newest.data, {'b': 2})
+        self.assertEqual(stats.as_dict()['fallbacks'], 1)
+        self.assertEqual(stats.as_dict()['bytes'], 16)
+
+    def test_stats(self):
+        stats = ResolverStats()
+        resolver = JsonResolver(stats=stats)
+        resolver(create_siblings({'a': 1}, {'b': 1}))
+        resolver(create_siblings({'a': 1}, {'b': 1}, {'c': 1}))
+
+        counters = stats.as_dict()
+        self.assertEqual(counters['resolutions'], 2)
+        self.assertEqual(counters['siblings'], 5)
+        self.assertEqual(counters['max_siblings'], 3)
+        self.assertEqual(counters['fallbacks'], 0)
+        self.assertGreaterEqual(counters['seconds'], counters['max_seconds'])
+
+    def test_stats_per_model(self):
+        with patch.object(models, 'settings') as settings:
+            settings.RIAK_CLIENT = create_mock_riak_client()
+
+            class MyModel(models.Model):
+                class Meta:
+                    bucket_name = 'test_bucket'
+                    bucket_type_name = 'test_type'
+
+            class MySetModel(models.Model):
+                class Meta:
+                    bucket_name = 'test_bucket'
+                    bucket_type_name = 'test_type'
+                    resolver = JsonResolver(as_set=True)
+
+        resolver = MySetModel.objects._state.bucket.resolver
+        self.assertTrue(resolver.as_set)
+        resolver(create_siblings({'a': [1]}, {'a': [2]}))
+
+        self.assertEqual(MySetModel.objects.resolver_stats.resolutions, 1)
+        self.assertEqual(MyModel.objects.resolver_stats.resolutions, 0)
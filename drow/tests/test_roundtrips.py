@@ -0,0 +1,92 @@
+__author__ = 'max'
+
+from unittest import TestCase
+from drow import models
+from drow.backends import MemoryBackend
+from drow.errors import BudgetExceeded
+from drow.roundtrips import RoundTripTracker
+from drow.roundtrips import track_round_trips
+
+
+class TestRoundTripTracker(TestCase):
+    def setUp(self):
+        class Person(models.Model):
+            class Meta:
+                bucket_type_name = 'test_type'
+                bucket_name = 'people'
+                backend = MemoryBackend()
+
+        self.Person = Person
+        for key in 'abc':
+            Person.objects.put(key, {'name': key})
+
+    def test_counts_round_trips(self):
+        with RoundTripTracker() as tracker:
+            self.Person.objects.get('a', active=True)
+            self.Person.objects.get_many(['a', 'b'])
+            self.Person.objects.put('d', {'name': 'd'})
+            self.Person.objects.delete('d')
+
+        # The put fetches the object it replaces
+        self.assertEqual(tracker.counts, {
+            'get': 2, 'multiget': 1, 'store': 1, 'delete': 1})
+        self.assertEqual(tracker.total, 5)
+        self.assertEqual(tracker.n_plus_one, [])
+
+        self.Person.objects.get('a', active=True)
+        self.assertEqual(tracker.total, 5)
+
+    def test_flags_n_plus_one(self):
+        with RoundTripTracker() as tracker:
+            for person in [self.Person.objects.get(k) for k in 'abc']:
+                person.data
+            self.Person.objects.get('a').data
+
+        (model, site, count), = tracker.n_plus_one
+        self.assertEqual(model, 'Person')
+        self.assertEqual(count, 3)
+        self.assertEqual(len(site), 3)
+        self.assertIn('test_roundtrips.py', site[-1])
+        self.assertIn('in test_flags_n_plus_one', site[-1])
+        self.assertIn('N+1: 3 lazy loads of Person', tracker.report())
+
+    def test_budget(self):
+        with RoundTripTracker(budget=2):
+            self.Person.objects.get('a').data
+            self.Person.objects.get('b').data
+            with self.assertRaises(BudgetExceeded) as raised:
+                self.Person.objects.get('c').data
+        self.assertEqual(raised.exception.tracker.total, 3)
+
+        with RoundTripTracker(budget={'get': 1}):
+            self.Person.objects.get_many(['a', 'b'])
+            self.Person.objects.get('a').data
+            with self.assertRaises(BudgetExceeded):
+                self.Person.objects.get('b').data
+
+    def test_raise_on_n_plus_one(self):
+        loaded = []
+        with RoundTripTracker(raise_on_n_plus_one=True):
+            with self.assertRaises(BudgetExceeded):
+                for key in 'abc':
+                    loaded.append(self.Person.objects.get(key).data)
+        self.assertEqual(loaded, [{'name': 'a'}])
+
+    def test_nested(self):
+        with RoundTripTracker() as outer:
+            self.Person.objects.get('a', active=True)
+            with RoundTripTracker() as inner:
+                self.Person.objects.get('b', active=True)
+        self.assertEqual(outer.total, 2)
+        self.assertEqual(inner.total, 1)
+
+    def test_track_round_trips(self):
+        trackers = []
+
+        @track_round_trips(on_exit=trackers.append, budget=1)
+        def handler(key):
+            return self.Person.objects.get(key).data
+
+        self.assertEqual(handler('a'), {'name': 'a'})
+        self.assertEqual(handler('b'), {'name': 'b'})
+        self.assertEqual([t.total for t in trackers], [1, 1])
@@ -0,0 +1,181 @@
+__author__ = 'max'
+
+from riak import RiakError
+from unittest import TestCase
+from mock import patch
+from mockriak import create_mock_riak_client
+from mockriak import use_real_riak_objects
+from drow import models
+from drow.errors import BulkError
+from drow.session import current_session
+from drow.session import Session
+
+
+class SessionTestCase(TestCase):
+    def setUp(self):
+        self.patcher = patch.object(models, 'settings')
+        settings = self.patcher.start()
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+        self.model = MyModel
+        self.bucket = MyModel.objects._state.bucket
+        self.stored = {'a': {'value': 1}, 'b': {'value': 2}}
+        use_real_riak_objects(self.bucket, self.stored)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+
+class TestIdentityMap(SessionTestCase):
+    def test_one_instance_per_key(self):
+        MyModel = self.model
+
+        with Session() as session:
+            self.assertIs(current_session(), session)
+            instance = MyModel('a')
+            self.assertIs(MyModel.objects.get('a', active=True), instance)
+            self.assertIs(MyModel('a'), instance)
+
+            results = MyModel.objects.get_many(['a', 'b'])
+            self.assertIs(results[0], instance)
+            self.assertIs(MyModel('b'), results[1])
+
+        self.assertIsNone(current_session())
+        self.assertEqual(self.bucket.get.call_count, 1)
+        self.bucket.multiget.assert_called_once_with(['b'])
+        self.assertIsNot(MyModel('a'), instance)
+
+    def test_missing_keys(self):
+        MyModel = self.model
+
+        with Session():
+            instance = MyModel.objects.get('c', active=True, must_exist=False)
+            with self.assertRaises(MyModel.DoesNotExist):
+                MyModel.objects.get('c', active=True)
+            self.assertIs(MyModel('c'), instance)
+
+        self.assertEqual(self.bucket.get.call_count, 1)
+
+    def test_put_replaces_loaded_data(self):
+        MyModel = self.model
+
+        with Session():
+            instance = MyModel.objects.get('a', active=True)
+            result = MyModel.objects.put('a', {'value': 3})
+            self.assertIs(result, instance)
+            self.assertEqual(instance.data, {'value': 3})
+
+        # The put replaced the loaded version, without fetching it again
+        self.assertEqual(self.bucket.get.call_count, 1)
+        self.assertEqual(
+            instance._state.riak_object.vclock.encode('binary'), 'vclock-a')
+        self.assertEqual(instance._state.riak_object.store.call_count, 1)
+
+
+class TestQueuedWrites(SessionTestCase):
+    def test_writes_are_flushed_on_exit(self):
+        MyModel = self.model
+
+        with Session():
+            a = MyModel('a')
+            a.data['value'] = 10
+            a.save()
+            a.data['value'] = 11
+            a.save()
+            MyModel('b').delete()
+            c = MyModel('c')
+            c.data = {'value': 3}
+            c.save()
+
+            self.assertEqual(a._state.riak_object.store.call_count, 0)
+            self.assertEqual(c._state.riak_object.store.call_count, 0)
+            self.assertEqual(self.bucket.new.call_count, 0)
+
+        self.assertEqual(a._state.riak_object.store.call_count, 1)
+        self.assertEqual(a._state.riak_object.data, {'value': 11})
+        self.assertEqual(c._state.riak_object.store.call_count, 1)
+        self.bucket.new.assert_called_once_with('b')
+        self.assertFalse(a.is_dirty)
+
+    def test_later_write_replaces_earlier(self):
+        MyModel = self.model
+
+        with Session():
+            a = MyModel('a')
+            a.data['value'] = 10
+            a.save()
+            a.delete()
+
+        self.assertEqual(a._state.riak_object.store.call_count, 0)
+        self.bucket.new.assert_called_once_with('a')
+
+    def test_puts_are_queued(self):
+        MyModel = self.model
+
+        with Session():
+            a = MyModel('a')
+            a.data['value'] = 10
+            a.save()
+            loaded = a._state.riak_object
+            self.assertIs(MyModel.objects.put('a', {'value': 20}), a)
+            b = MyModel.objects.put_many({'b': {'value': 30}})[0]
+            self.assertIs(b, MyModel('b'))
+            self.assertEqual(a._state.riak_object.store.call_count, 0)
+            self.assertEqual(b._state.riak_object.store.call_count, 0)
+
+            created = MyModel.objects.create({'value': 40})
+            self.assertEqual(created._state.riak_object.store.call_count, 1)
+
+        # The put replaced the queued save, so the key is written once
+        self.assertEqual(loaded.store.call_count, 0)
+        self.assertEqual(a._state.riak_object.store.call_count, 1)
+        self.assertEqual(a._state.riak_object.data, {'value': 20})
+        self.assertEqual(b._state.riak_object.store.call_count, 1)
+
+    def test_delete_many_is_queued(self):
+        MyModel = self.model
+
+        with Session():
+            results = MyModel.objects.delete_many(['a'])
+            self.assertEqual([o.key for o in results], ['a'])
+            results = MyModel.objects.delete_many(['a', 'b'])
+            self.assertEqual([o.key for o in results], ['a', 'b'])
+            self.assertEqual(self.bucket.new.call_count, 0)
+
+        self.assertEqual(
+            sorted(c[0][0] for c in self.bucket.new.call_args_list),
+            ['a', 'b'])
+
+    def test_writes_discarded_on_error(self):
+        MyModel = self.model
+
+        with self.assertRaises(ValueError):
+            with Session():
+                a = MyModel('a')
+                a.data['value'] = 10
+                a.save()
+                raise ValueError()
+
+        self.assertEqual(a._state.riak_object.store.call_count, 0)
+        self.assertIsNone(current_session())
+
+    def test_failed_writes(self):
+        MyModel = self.model
+
+        with self.assertRaises(BulkError) as context:
+            with Session():
+                a = MyModel('a')
+                a.data['value'] = 10
+                a._state.riak_object.store.side_effect = RiakError('failed')
+                a.save()
+                b = MyModel('b')
+                b.data['value'] = 20
+                b.save()
+
+        self.assertEqual(list(context.exception.errors), [(MyModel, 'a')])
+        self.assertEqual(b._state.riak_object.store.call_count, 1)
@@ -0,0 +1,158 @@
+__author__ = 'max'
+
+import jsonpatch
+from time import sleep
+from time import time
+from unittest import TestCase
+from mock import patch
+from mockriak import create_mock_riak_client
+from mockriak import use_real_riak_objects
+from drow import models
+from drow.errors import BulkError
+from drow.errors import InvalidConfig
+from drow.errors import InvalidPatch
+from drow.fields import AutoDateField
+from drow.writebehind import WriteBehind
+
+
+def wait_for(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            raise AssertionError('Timed out')
+        sleep(0.001)
+
+
+class TestWriteBehind(TestCase):
+    def setUp(self):
+        self.patcher = patch.object(models, 'settings')
+        settings = self.patcher.start()
+        settings.RIAK_CLIENT = create_mock_riak_client()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def create_model(self, write_behind):
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+
+            modified = AutoDateField()
+
+        MyModel._meta.write_behind = write_behind
+        write_behind.bind(MyModel.objects._apply_patches)
+
+        bucket = MyModel.objects._state.bucket
+        stored = {'a': {'count': 0, 'feed': {}}}
+        use_real_riak_objects(bucket, stored)
+        bucket.stored = []
+        get_side_effect = bucket.get.side_effect
+
+        def recording_get(key):
+            riak_object = get_side_effect(key)
+            store = riak_object.store.side_effect
+
+            def record_store(*args, **kwargs):
+                bucket.stored.append(riak_object.data)
+                return store(*args, **kwargs)
+
+            riak_object.store.side_effect = record_store
+            return riak_object
+
+        bucket.get.side_effect = recording_get
+        return MyModel, bucket
+
+    def test_patches_are_coalesced(self):
+        write_behind = WriteBehind(window=60)
+        MyModel, bucket = self.create_model(write_behind)
+
+        for i in range(1, 4):
+            result = MyModel.objects.patch('a', jsonpatch.JsonPatch([
+                {'op': 'replace', 'path': '/count', 'value': i},
+                {'op': 'add', 'path': '/feed/%d' % i, 'value': i}
+            ]))
+            self.assertIsNone(result)
+        self.assertEqual(len(write_behind), 1)
+        self.assertEqual(bucket.get.call_count, 0)
+
+        write_behind.flush()
+        self.assertEqual(len(write_behind), 0)
+        self.assertEqual(bucket.get.call_count, 1)
+        self.assertEqual(len(bucket.stored), 1)
+        self.assertEqual(bucket.stored[0]['count'], 3)
+        self.assertEqual(
+            bucket.stored[0]['feed'], {'1': 1, '2': 2, '3': 3})
+        self.assertIn('modified', bucket.stored[0])
+
+    def test_failed_patches_are_skipped(self):
+        write_behind = WriteBehind(window=60)
+        MyModel, bucket = self.create_model(write_behind)
+
+        MyModel.objects.patch('a', jsonpatch.JsonPatch([
+            {'op': 'add', 'path': '/feed/1', 'value': 1}]))
+        MyModel.objects.patch('a', jsonpatch.JsonPatch([
+            {'op': 'add', 'path': '/feed/2', 'value': 2},
+            {'op': 'add', 'path': '/count', 'value': 2}]))
+        MyModel.objects.patch('a', jsonpatch.JsonPatch([
+            {'op': 'add', 'path': '/feed/3', 'value': 3},
+            {'op': 'remove', 'path': '/missing'}]))
+        MyModel.objects.patch('a', jsonpatch.JsonPatch([
+            {'op': 'replace', 'path': '/count', 'value': 4}]))
+        MyModel.objects.patch('b', jsonpatch.JsonPatch([
+            {'op': 'replace', 'path': '/count', 'value': 1}]))
+
+        with self.assertRaises(BulkError) as context:
+            write_behind.flush()
+
+        errors = context.exception.errors
+        self.assertEqual(sorted(errors), ['a', 'b'])
+        self.assertEqual(len(errors['a']), 2)
+        self.assertIsInstance(errors['a'][0], InvalidPatch)
+        self.assertIsInstance(errors['b'][0], MyModel.DoesNotExist)
+        self.assertEqual(len(bucket.stored), 1)
+        self.assertEqual(bucket.stored[0]['count'], 4)
+        self.assertEqual(bucket.stored[0]['feed'], {'1': 1})
+        self.assertEqual(sorted(write_behind.errors), ['a', 'b'])
+
+    def test_flush_after_window(self):
+        write_behind = WriteBehind(window=0.01)
+        MyModel, bucket = self.create_model(write_behind)
+
+        MyModel.objects.patch('a', jsonpatch.JsonPatch([
+            {'op': 'replace', 'path': '/count', 'value': 1}]))
+        wait_for(lambda: bucket.stored)
+        self.assertEqual(bucket.stored[0]['count'], 1)
+        write_behind.close()
+
+    def test_flush_when_full(self):
+        write_behind = WriteBehind(window=60, max_patches=2)
+        MyModel, bucket = self.create_model(write_behind)
+
+        for i in range(2):
+            MyModel.objects.patch('a', jsonpatch.JsonPatch([
+                {'op': 'replace', 'path': '/count', 'value': i}]))
+        wait_for(lambda: bucket.stored)
+        self.assertEqual(bucket.get.call_count, 1)
+
+        MyModel.objects.patch('a', jsonpatch.JsonPatch([
+            {'op': 'replace', 'path': '/count', 'value': 5}]))
+        write_behind.close()
+        self.assertEqual(len(bucket.stored), 2)
+        self.assertEqual(bucket.stored[1]['count'], 5)
+
+    def test_cannot_be_shared(self):
+        class MyModel(models.Model):
+            class Meta:
+                bucket_name = 'test_bucket'
+                bucket_type_name = 'test_type'
+                write_behind = WriteBehind()
+
+        self.assertTrue(MyModel._meta.write_behind.bound)
+
+        with self.assertRaises(InvalidConfig):
+            class OtherModel(models.Model):
+                class Meta:
+                    bucket_name = 'test_bucket'
+                    bucket_type_name = 'test_type'
+                    write_behind = MyModel._meta.write_behind
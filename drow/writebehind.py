@@ -0,0 +1,181 @@
+__author__ = 'max'
+
+import atexit
+from collections import OrderedDict
+from threading import Condition
+from threading import Lock
+from threading import Thread
+from time import time
+
+from errors import BulkError
+from pool import DEFAULT_CONCURRENCY
+from pool import run_concurrently
+
+
+class WriteBehind(object):
+    """
+    Buffers the patches made to a model through QuerySet.patch, so that
+    every patch made to a key within a short window is applied with a single
+    fetch and store.  Assign one to the "write_behind" option of a model's
+    Meta class; each model needs its own.
+
+    Buffered patches are applied once the oldest patch for their key is
+    ``window`` seconds old, once ``max_patches`` patches are buffered for
+    their key, when flush is called, or when the interpreter exits.
+    """
+    def __init__(self, window=1.0, max_patches=100,
+                 concurrency=DEFAULT_CONCURRENCY):
+        """
+        :param float window: The most seconds a patch is buffered for
+        :param int max_patches: The most patches buffered per key
+        :param int concurrency: The maximum number of keys patched at once
+        """
+        self.window = window
+        self.max_patches = max_patches
+        self.concurrency = concurrency
+
+        # Maps each key to the exception raised the last time its patches
+        # failed to apply in the background
+        self.errors = OrderedDict()
+
+        self._apply = None
+        self._pending = OrderedDict()
+        self._condition = Condition(Lock())
+        self._flush_lock = Lock()
+        self._thread = None
+        self._closed = False
+
+    def bind(self, apply_patches):
+        """
+        Set the function that applies the buffered patches
+
+        :param function apply_patches: A function taking a key and a list of
+                                       patches, returning a list of the
+                                       exceptions raised by the patches that
+                                       could not be applied
+        """
+        self._apply = apply_patches
+
+    @property
+    def bound(self):
+        """
+        :return: True if the buffer is already in use by a model
+        :rtype: bool
+        """
+        return self._apply is not None
+
+    def add(self, key, patch):
+        """
+        Buffer a patch
+
+        :param str key: The key the patch is for
+        :param patch: A JsonPatch, or a list of JSON patch operations
+        """
+        with self._condition:
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.close)
+
+            entry = self._pending.get(key)
+            if entry is None:
+                entry = self._pending[key] = (time(), [])
+            entry[1].append(patch)
+            if len(entry[1]) == 1 or len(entry[1]) >= self.max_patches:
+                self._condition.notify()
+
+    def __len__(self):
+        """
+        :return: The number of keys with buffered patches
+        :rtype: int
+        """
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Apply every buffered patch now
+
+        :raises BulkError: If any patches could not be applied, listing the
+                           exceptions they raised by key
+        """
+        with self._condition:
+            keys = list(self._pending)
+        errors = self._flush(keys)
+        if errors:
+            raise BulkError(
+                'Patches for {} keys failed'.format(len(errors)), errors)
+
+    def close(self):
+        """
+        Apply every buffered patch and stop the background thread
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        with self._condition:
+            keys = list(self._pending)
+        self._flush(keys)
+
+    def _flush(self, keys):
+        """
+        Apply the patches buffered for the given keys
+
+        :param list keys: The keys to apply the patches of
+        :return: A dict mapping each key whose patches failed to a list of
+                 the exceptions they raised
+        :rtype: OrderedDict
+        """
+        with self._flush_lock:
+            with self._condition:
+                batches = [(k, self._pending.pop(k)[1])
+                           for k in keys if k in self._pending]
+
+            results = run_concurrently(
+                lambda batch: self._apply(*batch), batches, self.concurrency)
+
+        errors = OrderedDict()
+        for (key, _), (failed, error) in zip(batches, results):
+            if error is not None:
+                failed = [error]
+            if failed:
+                errors[key] = failed
+                self.errors[key] = failed[-1]
+            else:
+                self.errors.pop(key, None)
+        return errors
+
+    def _due(self, now):
+        """
+        :param float now: The current time
+        :return: The keys whose patches should be applied now, and the time
+                 at which the next key will be due (if any)
+        :rtype: tuple
+        """
+        due = []
+        next_due = None
+        for key, (since, patches) in self._pending.iteritems():
+            deadline = since + self.window
+            if deadline <= now or len(patches) >= self.max_patches:
+                due.append(key)
+            elif next_due is None or deadline < next_due:
+                next_due = deadline
+        return due, next_due
+
+    def _run(self):
+        """
+        Apply the buffered patches as they become due, until closed
+        """
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    due, next_due = self._due(time())
+                    if due:
+                        break
+                    timeout = None
+                    if next_due is not None:
+                        timeout = max(next_due - time(), 0)
+                    self._condition.wait(timeout)
+            self._flush(due)